@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+    Gateway hot path benchmark
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Drives Payments.setupRedirect and Payments.authorise through full Express
+    and Direct flows against a local NVP stub, at each of a set of
+    concurrency levels, and reports throughput with p50/p95/p99 latency per
+    flow.
+
+    With --simulated the flows go to the in process Simulated gateway
+    instead, to measure the extension on its own with no sockets at all.
+
+    It also reports the memory each flow costs in this process, measured
+    single threaded: the gc tracked objects left behind per flow (anything
+    above zero in a steady state is a leak or an unbounded cache) and, where
+    tracemalloc is importable, the peak bytes allocated during a flow.
+
+    Run from the top of the checkout::
+
+        python benchmarks/gateway.py --concurrency 1,8,32 --flows 2000 \\
+            --latency 0.02 --jitter 0.005 --error-rate 0.01
+"""
+
+import gc, optparse, os, sys, threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from flask import Flask
+from flaskext.payments import Payments, Transaction
+from nvpstub import NVPStub
+
+def make_payments(endpoint, pool_size, simulated=None):
+    app = Flask(__name__)
+    if simulated is not None:
+        latency, jitter, error_rate = simulated
+        app.config.update(TESTING=True, PAYMENT_API='Simulated',
+                          PAYMENT_SIMULATED_LATENCY=latency,
+                          PAYMENT_SIMULATED_JITTER=jitter,
+                          PAYMENT_SIMULATED_ERRORS={'10001': error_rate})
+        return Payments(app)
+    app.config.update(
+        TESTING=True,
+        PAYMENT_API='PayPal',
+        PAYMENT_POOL_SIZE=pool_size,
+        PAYMENT_READ_TIMEOUT=30,
+        PAYPAL_API_ENDPOINT=endpoint,
+        PAYPAL_API_URL='https://www.sandbox.paypal.com/webscr'
+                       '&cmd=_express-checkout&token=',
+        PAYPAL_API_USER='bench',
+        PAYPAL_API_PWD='bench',
+        PAYPAL_API_SIGNATURE='bench',
+    )
+    return Payments(app)
+
+def express_flow(payments):
+    trans = Transaction()
+    trans.type = 'Express'
+    trans.amount = 100
+    trans.return_url = 'http://www.example.com/paypal-express-complete'
+    trans.cancel_url = 'http://www.example.com/confirm'
+    trans = payments.setupRedirect(trans)
+    trans.pay_id = 'QWERTY123456'
+    return payments.authorise(trans)
+
+def direct_flow(payments):
+    trans = Transaction()
+    trans.type = 'Direct'
+    trans.amount = 100
+    trans.ipaddress = '127.0.0.1'
+    trans.acct = '4111111111111111'
+    trans.expdate = '122030'
+    trans.cvv2 = '123'
+    trans.firstname = 'Test'
+    trans.lastname = 'User'
+    trans.cctype = 'Visa'
+    trans.street = '1 Main St'
+    trans.city = 'San Jose'
+    trans.state = 'CA'
+    trans.zipcode = '95131'
+    return payments.authorise(trans)
+
+FLOWS = {'express': express_flow, 'direct': direct_flow}
+
+def succeeded(trans):
+    """ whether the payment went through, a declined one, ACK=Failure,
+    counting as failed
+    """
+    return bool(trans.authorised)
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def run(payments, flow, concurrency, flows):
+    """Runs `flows` flows spread over `concurrency` threads, returning the
+    wall clock time taken, the latency of each flow and the failure count
+    """
+    latencies = []
+    failures = [0]
+    remaining = [flows]
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            with lock:
+                if not remaining[0]:
+                    return
+                remaining[0] -= 1
+            started = time.time()
+            try:
+                ok = succeeded(flow(payments))
+            except Exception:
+                ok = False
+            elapsed = time.time() - started
+            with lock:
+                latencies.append(elapsed)
+                if not ok:
+                    failures[0] += 1
+
+    threads = [threading.Thread(target=work) for i in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - started, latencies, failures[0]
+
+def memory_per_flow(payments, flow, flows=200):
+    """gc tracked objects left behind, and peak bytes allocated where
+    tracemalloc is available, per flow
+    """
+    for i in range(20):
+        flow(payments) # warm the pool and any caches
+    gc.collect()
+    before = len(gc.get_objects())
+    for i in range(flows):
+        flow(payments)
+    gc.collect()
+    retained = (len(gc.get_objects()) - before) / float(flows)
+    try:
+        import tracemalloc
+    except ImportError:
+        return retained, None
+    tracemalloc.start()
+    try:
+        flow(payments)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return retained, peak
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--flow', default='express,direct',
+                      help='comma separated flows to run [%default]')
+    parser.add_option('--concurrency', default='1,8,32',
+                      help='comma separated thread counts [%default]')
+    parser.add_option('--flows', type='int', default=1000,
+                      help='flows per concurrency level [%default]')
+    parser.add_option('--latency', type='float', default=0.0,
+                      help='stub response time, seconds [%default]')
+    parser.add_option('--jitter', type='float', default=0.0,
+                      help='stub latency variation, seconds [%default]')
+    parser.add_option('--error-rate', type='float', default=0.0,
+                      help='share of stub calls that fail [%default]')
+    parser.add_option('--simulated', action='store_true', default=False,
+                      help='use the Simulated gateway rather than the stub')
+    options, args = parser.parse_args()
+
+    levels = [int(level) for level in options.concurrency.split(',')]
+    settings = (options.latency, options.jitter, options.error_rate)
+    if options.simulated:
+        stub = None
+        payments = make_payments(None, max(levels), settings)
+    else:
+        stub = NVPStub(*settings)
+        stub.start()
+        payments = make_payments(stub.endpoint, max(levels))
+    try:
+        print '%-8s %6s %7s %6s %10s %9s %9s %9s' % ('flow', 'conc', 'flows',
+                'fails', 'flows/s', 'p50 ms', 'p95 ms', 'p99 ms')
+        for name in options.flow.split(','):
+            flow = FLOWS[name]
+            for concurrency in levels:
+                wall, latencies, failures = run(payments, flow, concurrency,
+                                                options.flows)
+                latencies.sort()
+                print '%-8s %6d %7d %6d %10.1f %9.2f %9.2f %9.2f' % (name,
+                        concurrency, len(latencies), failures,
+                        len(latencies) / wall,
+                        percentile(latencies, 0.50) * 1000,
+                        percentile(latencies, 0.95) * 1000,
+                        percentile(latencies, 0.99) * 1000)
+        print
+        for name in options.flow.split(','):
+            retained, peak = memory_per_flow(payments, FLOWS[name])
+            if peak is None:
+                peak = 'no tracemalloc for peak bytes'
+            else:
+                peak = '%d bytes peak' % peak
+            print '%-8s %6.2f objects retained per flow, %s' % (name,
+                    retained, peak)
+    finally:
+        payments.gateway.transport.close()
+        if stub is not None:
+            stub.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+    Micro-benchmark of NVP request encoding
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Compares building the params dict and urlencoding all of it onto the
+    signature on every call, as the gateway methods used to, with the
+    NVPTemplates PayPalGateway now builds once, checking first that both
+    give exactly the same bytes.
+
+    Run from the top of the checkout::
+
+        python benchmarks/nvp_encode.py [calls]
+"""
+
+import os, sys, timeit, urllib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from flask import Flask
+from flaskext.payments import Payments
+
+def legacy_express(signature, amount, return_url, cancel_url):
+    params = {
+        'METHOD' : "SetExpressCheckout",
+        'NOSHIPPING' : 1,
+        'PAYMENTACTION' : 'Authorization',
+        'RETURNURL' : return_url,
+        'CANCELURL' : cancel_url,
+        'AMT' : amount,
+    }
+    return signature + urllib.urlencode(params)
+
+def legacy_details(signature, tx_id):
+    params = {
+        'METHOD' : "GetTransactionDetails",
+        'TRANSACTIONID' : tx_id,
+    }
+    return signature + urllib.urlencode(params)
+
+def legacy_direct(signature, amt, ipaddress, acct, expdate, cvv2, firstname,
+                  lastname, cctype, street, city, state, zipcode):
+    params = {
+        'METHOD' : "DoDirectPayment",
+        'PAYMENTACTION' : 'Sale',
+        'AMT' : amt,
+        'IPADDRESS' : ipaddress,
+        'ACCT': acct,
+        'EXPDATE' : expdate,
+        'CVV2' : cvv2,
+        'FIRSTNAME' : firstname,
+        'LASTNAME': lastname,
+        'CREDITCARDTYPE': cctype,
+        'STREET': street,
+        'CITY': city,
+        'STATE': state,
+        'ZIP':zipcode,
+        'COUNTRY' : 'United States',
+        'COUNTRYCODE': 'US',
+        'RETURNURL' : 'http://www.yoursite.com/returnurl', #why needed?
+        'CANCELURL' : 'http://www.yoursite.com/cancelurl', # ditto
+        'L_DESC0' : "Desc: ",
+        'L_NAME0' : "Name: ",
+    }
+    return signature + urllib.urlencode(params)
+
+CASES = [
+    ('SetExpressCheckout', legacy_express,
+     ('100.00', 'http://www.example.com/paypal-express-complete?order=42',
+      'http://www.example.com/confirm')),
+    ('GetTransactionDetails', legacy_details, ('8VF51385W1287451J',)),
+    ('DoDirectPayment', legacy_direct,
+     ('100.00', '127.0.0.1', '4111111111111111', '122030', '123', 'Test',
+      'User', 'Visa', '1 Main St', 'San Jose', 'CA', '95131')),
+]
+
+def gateway():
+    app = Flask(__name__)
+    app.config.update(PAYMENT_API='PayPal', TESTING=True,
+        PAYPAL_API_ENDPOINT='https://api-3t.sandbox.paypal.com/nvp',
+        PAYPAL_API_URL='https://www.sandbox.paypal.com/webscr&token=',
+        PAYPAL_API_USER='bench_api1.example.com',
+        PAYPAL_API_PWD='QFZCWN5HZM8VBG7Q',
+        PAYPAL_API_SIGNATURE='A-IzJhZZjhg29XQ2qnhapuwxIDzyAZQ92FRP5dqBzVesOk'
+                             'zbdUONzmOU')
+    return Payments(app).gateway
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    paypal = gateway()
+    signature, templates = paypal.signature, paypal.templates
+    print '%-22s %12s %12s %8s' % ('method', 'legacy us', 'template us',
+                                   'speedup')
+    for method, legacy, args in CASES:
+        template = templates[method]
+        assert legacy(signature, *args) == template.encode(*args), method
+        old = min(timeit.repeat(lambda: legacy(signature, *args),
+                                number=calls, repeat=3))
+        new = min(timeit.repeat(lambda: template.encode(*args),
+                                number=calls, repeat=3))
+        print '%-22s %12.2f %12.2f %7.1fx' % (method, old / calls * 1e6,
+                                              new / calls * 1e6, old / new)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+    Micro-benchmark of NVP response parsing
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Compares the split/unquote loops the gateway methods used to carry with
+    NVPResponse and the nvp_fields fast path, on a GetTransactionDetails
+    sized response with a lot of line items.
+
+    Run from the top of the checkout::
+
+        python benchmarks/nvp_parse.py [line items]
+"""
+
+import os, sys, timeit, urllib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from flaskext.payments import NVPResponse, nvp_fields
+
+def legacy_parse(response):
+    """ the loop DoExpressCheckoutPayment, GetTransactionDetails and
+    DoDirectPayment each had
+    """
+    response_tokens = {}
+    for token in response.split('&'):
+        response_tokens[token.split("=")[0]] = token.split("=")[1]
+    for key in response_tokens.keys():
+        response_tokens[key] = urllib.unquote(response_tokens[key])
+    return response_tokens
+
+def legacy_token(response):
+    """ the loop SetExpressCheckout had """
+    response_token = ""
+    for token in response.split('&'):
+        if token.find("TOKEN=") != -1:
+            response_token = token[ (token.find("TOKEN=")+6):]
+    return response_token
+
+def transaction_details(items):
+    fields = [
+        ('TIMESTAMP', '2010-08-01T12:32:01Z'),
+        ('CORRELATIONID', 'a1b2c3d4e5f6'),
+        ('ACK', 'Success'),
+        ('VERSION', '54.0'),
+        ('BUILD', '1420052'),
+        ('RECEIVEREMAIL', 'seller@example.com'),
+        ('PAYERID', 'QWERTY123456'),
+        ('PAYERSTATUS', 'verified'),
+        ('FIRSTNAME', 'Test'),
+        ('LASTNAME', 'User'),
+        ('TRANSACTIONID', '8RD88262A9563843B'),
+        ('TRANSACTIONTYPE', 'cart'),
+        ('PAYMENTTYPE', 'instant'),
+        ('ORDERTIME', '2010-08-01T12:30:00Z'),
+        ('AMT', '%d.00' % (items * 10)),
+        ('FEEAMT', '3.20'),
+        ('PAYMENTSTATUS', 'Completed'),
+        ('PENDINGREASON', 'None'),
+        ('REASONCODE', 'None'),
+    ]
+    for i in range(items):
+        fields.extend([
+            ('L_NAME%d' % i, 'Widget number %d, blue/large' % i),
+            ('L_NUMBER%d' % i, 'SKU-%06d' % i),
+            ('L_QTY%d' % i, '1'),
+            ('L_AMT%d' % i, '10.00'),
+            ('L_CURRENCYCODE%d' % i, 'USD'),
+        ])
+    return urllib.urlencode(fields)
+
+def run(name, func, number):
+    best = min(timeit.repeat(func, number=number, repeat=5))
+    print '%-44s %8.2f us/call' % (name, best / number * 1e6)
+
+def main(items=200):
+    response = transaction_details(items)
+    number = max(10, 20000 / items)
+    print 'GetTransactionDetails response, %d line items, %d bytes' % (
+            items, len(response))
+    run('legacy split/unquote loop',
+            lambda: legacy_parse(response), number)
+    run('NVPResponse, read every field',
+            lambda: dict(NVPResponse(response)), number)
+    run('NVPResponse, read ACK and TRANSACTIONID',
+            lambda: [NVPResponse(response)[k]
+                     for k in ('ACK', 'TRANSACTIONID')], number)
+    run('NVPResponse.lists()',
+            lambda: NVPResponse(response).lists(), number)
+    run('nvp_fields ACK and TRANSACTIONID',
+            lambda: nvp_fields(response, 'ACK', 'TRANSACTIONID'), number)
+    token = 'TOKEN=EC%2d8RD88262A9563843B&' + response
+    run('legacy TOKEN scan',
+            lambda: legacy_token(token), number)
+    run('nvp_fields TOKEN',
+            lambda: nvp_fields(token, 'TOKEN'), number)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+    Local stand-in for the PayPal NVP endpoint
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Answers SetExpressCheckout, DoExpressCheckoutPayment, DoDirectPayment and
+    GetTransactionDetails with PayPal shaped responses over keep-alive
+    HTTP/1.1, after a configurable delay, failing a configurable share of
+    calls with ACK=Failure.
+
+    NVPStub serves each connection on a thread of its own, which is plenty
+    for a few hundred at once. GreenNVPStub serves them from gevent's
+    WSGIServer instead, for benchmarks keeping thousands in flight, rather
+    than a thread and its stack for every one of them.
+
+    Used by the benchmarks, or run it on its own and point
+    PAYPAL_API_ENDPOINT at it::
+
+        python benchmarks/nvpstub.py [port] [latency] [jitter] [error rate] \\
+            [threads or gevent]
+"""
+
+import itertools, random, sys, threading, time, urllib, urlparse
+import BaseHTTPServer, SocketServer
+
+class NVPStubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        params = dict(urlparse.parse_qsl(body))
+        stub = self.server
+        delay = stub.delay()
+        if delay > 0:
+            time.sleep(delay)
+        response = stub.respond(params)
+        # in one write, so Nagle doesn't hold the body back
+        self.wfile.write('HTTP/1.1 200 OK\r\n'
+                         'Content-Type: text/plain\r\n'
+                         'Content-Length: %d\r\n\r\n%s'
+                         % (len(response), response))
+
+    def log_message(self, *args):
+        pass
+
+class NVPAnswers(object):
+    """What the stubs answer with, whichever way they serve it.
+
+    :param latency: seconds each call takes to answer
+    :param jitter: seconds either side of latency it varies by
+    :param error_rate: share of calls, 0 to 1, answered with ACK=Failure
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.calls = 0
+        self._ids = itertools.count(1)
+
+    def delay(self):
+        return self.latency + random.uniform(-self.jitter, self.jitter)
+
+    def respond(self, params):
+        self.calls += 1
+        method = params.get('METHOD')
+        fields = [('TIMESTAMP', time.strftime('%Y-%m-%dT%H:%M:%SZ')),
+                  ('CORRELATIONID', '%012x' % random.getrandbits(48)),
+                  ('VERSION', params.get('VERSION', '54.0')),
+                  ('BUILD', '1420052')]
+        if random.random() < self.error_rate:
+            fields[:0] = [('ACK', 'Failure')]
+            fields += [('L_ERRORCODE0', '10001'),
+                       ('L_SHORTMESSAGE0', 'Internal Error'),
+                       ('L_LONGMESSAGE0', 'Timeout processing request'),
+                       ('L_SEVERITYCODE0', 'Error')]
+            return urllib.urlencode(fields)
+        fields[:0] = [('ACK', 'Success')]
+        answer = getattr(self, 'answer' + str(method), None)
+        if answer is None:
+            return urllib.urlencode([('ACK', 'Failure'),
+                    ('L_ERRORCODE0', '81002'),
+                    ('L_SHORTMESSAGE0', 'Unspecified Method')])
+        return urllib.urlencode(fields + answer(params))
+
+    def next_id(self):
+        return '%017X' % next(self._ids)
+
+    def answerSetExpressCheckout(self, params):
+        return [('TOKEN', 'EC-' + self.next_id())]
+
+    def answerDoExpressCheckoutPayment(self, params):
+        return [('TOKEN', params.get('TOKEN', '')),
+                ('TRANSACTIONID', self.next_id()),
+                ('TRANSACTIONTYPE', 'expresscheckout'),
+                ('PAYMENTTYPE', 'instant'),
+                ('AMT', params.get('AMT', '')),
+                ('CURRENCYCODE', 'USD'),
+                ('PAYMENTSTATUS', 'Completed'),
+                ('PENDINGREASON', 'None')]
+
+    def answerDoDirectPayment(self, params):
+        return [('TRANSACTIONID', self.next_id()),
+                ('AMT', params.get('AMT', '')),
+                ('AVSCODE', 'X'),
+                ('CVV2MATCH', 'M')]
+
+    def answerGetTransactionDetails(self, params):
+        return [('TRANSACTIONID', params.get('TRANSACTIONID', '')),
+                ('PAYERID', 'QWERTY123456'),
+                ('PAYERSTATUS', 'verified'),
+                ('TRANSACTIONTYPE', 'cart'),
+                ('PAYMENTTYPE', 'instant'),
+                ('AMT', '100.00'),
+                ('PAYMENTSTATUS', 'Completed'),
+                ('L_NAME0', 'Widget'),
+                ('L_QTY0', '1'),
+                ('L_AMT0', '100.00')]
+
+class NVPStub(NVPAnswers, SocketServer.ThreadingMixIn,
+              BaseHTTPServer.HTTPServer):
+    """Threaded local NVP server.
+
+    :param port: port to listen on, any free one by default
+    """
+
+    daemon_threads = True
+    request_queue_size = 1024
+    allow_reuse_address = True
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, port=0):
+        NVPAnswers.__init__(self, latency, jitter, error_rate)
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           NVPStubHandler)
+        self._thread = None
+
+    @property
+    def endpoint(self):
+        return 'http://127.0.0.1:%d/nvp' % self.server_port
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class GreenNVPStub(NVPAnswers):
+    """Local NVP server on gevent's WSGIServer, every call answered on a
+    greenlet of its own, so the delays of thousands of calls in flight
+    overlap rather than each taking up a thread. Only for running in a
+    process of its own, with serve_forever.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, port=0):
+        from gevent.pywsgi import WSGIServer
+        NVPAnswers.__init__(self, latency, jitter, error_rate)
+        self.server = WSGIServer(('127.0.0.1', port), self.app, log=None,
+                                 backlog=4096)
+        self.server.init_socket()
+
+    @property
+    def endpoint(self):
+        return 'http://127.0.0.1:%d/nvp' % self.server.server_port
+
+    def app(self, environ, start_response):
+        import gevent
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        params = dict(urlparse.parse_qsl(environ['wsgi.input'].read(length)))
+        delay = self.delay()
+        if delay > 0:
+            gevent.sleep(delay)
+        response = self.respond(params)
+        start_response('200 OK', [('Content-Type', 'text/plain'),
+                                  ('Content-Length', str(len(response)))])
+        return [response]
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+if __name__ == '__main__':
+    port, latency, jitter, error_rate, mode = \
+            (sys.argv[1:] + [0, 0, 0, 0, 'threads'][len(sys.argv) - 1:])[:5]
+    stub_class = GreenNVPStub if mode == 'gevent' else NVPStub
+    stub = stub_class(float(latency), float(jitter), float(error_rate),
+                      int(port))
+    print 'NVP stub listening on', stub.endpoint
+    stub.serve_forever()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+    Startup cost benchmark
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Measures what an app configuring one gateway out of many pays at startup:
+    the time to import flaskext.payments and to run Payments.init_app, and
+    the modules each leaves imported. Every run is in a fresh interpreter.
+
+    Alongside PayPal it registers a number of generated stand-in gateways,
+    each a module big enough to cost something to import, and compares the
+    registry's lazy loading with importing every registered gateway up
+    front, as the hard coded gateway dict used to.
+
+    Run from the top of the checkout::
+
+        python benchmarks/startup.py --gateways 20 --runs 10
+"""
+
+import optparse, os, shutil, subprocess, sys, tempfile
+
+TOP = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+GATEWAY = '''
+class Gateway(object):
+    def __init__(self, app):
+        pass
+%s
+'''
+
+# runs in the child, printing import ms, init ms, modules after import,
+# modules after init
+CHILD = '''
+import sys, time
+sys.path[:0] = [%(top)r, %(fakes)r]
+started = time.time()
+import flaskext.payments
+imported = time.time()
+modules = len(sys.modules)
+from flask import Flask
+from flaskext.payments import Payments, gateways
+for i in range(%(gateways)d):
+    gateways.register('Fake%%d' %% i, 'fake_gateway_%%d:Gateway' %% i)
+app = Flask('startup')
+app.config.update(PAYMENT_API='PayPal', TESTING=True,
+    PAYPAL_API_ENDPOINT='https://api-3t.sandbox.paypal.com/nvp',
+    PAYPAL_API_URL='https://www.sandbox.paypal.com/webscr&token=',
+    PAYPAL_API_USER='u', PAYPAL_API_PWD='p', PAYPAL_API_SIGNATURE='s')
+configured = time.time()
+if %(eager)r:
+    for name in gateways.names():
+        gateways.load(name)
+Payments(app)
+done = time.time()
+print (imported - started) * 1000, (done - configured) * 1000, \\
+      modules, len(sys.modules)
+'''
+
+def write_gateways(directory, count, functions):
+    body = '\n'.join('def f%d(x):\n    return x + %d\n' % (i, i)
+                     for i in range(functions))
+    for i in range(count):
+        with open(os.path.join(directory, 'fake_gateway_%d.py' % i),
+                  'w') as module:
+            module.write(GATEWAY % body)
+
+def measure(fakes, gateways, eager, runs):
+    script = CHILD % dict(top=TOP, fakes=fakes, gateways=gateways,
+                          eager=eager)
+    results = []
+    for i in range(runs):
+        output = subprocess.check_output([sys.executable, '-B', '-c',
+                                          script])
+        results.append([float(value) for value in output.split()])
+    results.sort()
+    return results[len(results) // 2] # median run, by import time
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--gateways', type='int', default=20,
+                      help='stand-in gateways registered [%default]')
+    parser.add_option('--functions', type='int', default=2000,
+                      help='functions in each stand-in module [%default]')
+    parser.add_option('--runs', type='int', default=10,
+                      help='interpreters started for each mode [%default]')
+    options, args = parser.parse_args()
+
+    fakes = tempfile.mkdtemp()
+    try:
+        write_gateways(fakes, options.gateways, options.functions)
+        print '%-6s %10s %10s %16s %14s' % ('mode', 'import ms', 'init ms',
+                'modules import', 'modules init')
+        for mode, eager in (('lazy', False), ('eager', True)):
+            imported, init, after_import, after_init = measure(fakes,
+                    options.gateways, eager, options.runs)
+            print '%-6s %10.1f %10.1f %16d %14d' % (mode, imported, init,
+                    after_import, after_init)
+    finally:
+        shutil.rmtree(fakes)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+    Transaction memory and session size
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Compares the slotted Transaction and its to_bytes encoding with the plain
+    object it replaced, pickled into the session with the raw
+    DoExpressCheckoutPayment response attached as the example app used to.
+
+    Run from the top of the checkout::
+
+        python benchmarks/transaction_size.py
+"""
+
+import os, sys, timeit, cPickle as pickle
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from flaskext.payments import Transaction, NVPResponse
+
+class LegacyTransaction(object):
+    """ the Transaction as it was, a bare object """
+    def __init__(self):
+        self.authorised = False
+
+RAW = ('TOKEN=EC%2d5TH61788EV812450X&TIMESTAMP=2010%2d08%2d01T12%3a32%3a01Z'
+       '&CORRELATIONID=a1b2c3d4e5f6&ACK=Success&VERSION=54%2e0&BUILD=1420052'
+       '&TRANSACTIONID=8RD88262A9563843B&TRANSACTIONTYPE=expresscheckout'
+       '&PAYMENTTYPE=instant&ORDERTIME=2010%2d08%2d01T12%3a32%3a00Z'
+       '&AMT=100%2e00&FEEAMT=3%2e20&TAXAMT=0%2e00&CURRENCYCODE=USD'
+       '&PAYMENTSTATUS=Pending&PENDINGREASON=authorization&REASONCODE=None')
+
+def fill(trans, raw):
+    trans.type = 'Express'
+    trans.amount = 100
+    trans.return_url = 'http://www.example.com/paypal-express-complete'
+    trans.cancel_url = 'http://www.example.com/confirm'
+    trans.paypal_express_token = 'EC-5TH61788EV812450X'
+    trans.redirect_url = ('https://www.sandbox.paypal.com/webscr'
+            '&cmd=_express-checkout&token=EC-5TH61788EV812450X')
+    trans.pay_id = 'QWERTY123456'
+    trans._raw = raw
+    trans.authorised = True
+    return trans
+
+def footprint(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    else:
+        size += sys.getsizeof(obj.extensions)
+    return size
+
+def main():
+    legacy_raw = dict(NVPResponse(RAW))
+    legacy = fill(LegacyTransaction(), legacy_raw)
+    slotted = fill(Transaction(), NVPResponse(RAW))
+
+    print 'object footprint, excluding values'
+    print '  legacy object         %5d bytes' % footprint(legacy)
+    print '  slotted Transaction   %5d bytes' % footprint(slotted)
+    print
+    print 'serialised for the session'
+    for name, data in [
+            ('legacy, pickled', pickle.dumps(legacy)),
+            ('legacy, pickled (protocol 2)', pickle.dumps(legacy, 2)),
+            ('to_bytes()', slotted.to_bytes()),
+            ('to_bytes(include_raw=True)', slotted.to_bytes(True))]:
+        print '  %-30s %5d bytes' % (name, len(data))
+    print
+    print 'round trip'
+    for name, func in [
+            ('legacy, pickle',
+                lambda: pickle.loads(pickle.dumps(legacy))),
+            ('to_bytes/from_bytes',
+                lambda: Transaction.from_bytes(slotted.to_bytes()))]:
+        best = min(timeit.repeat(func, number=10000, repeat=3)) / 10000
+        print '  %-30s %7.2f us' % (name, best * 1e6)
+
+if __name__ == '__main__':
+    main()
@@ -20,18 +20,22 @@ def paypal_express_checkout():
     trans.cancel_url = url_for('confirm', _external=True)
 
     trans = payments.setupRedirect(trans)
-    session['trans'] = trans
+    # only the token goes in the session, the transaction stays on the server
+    # in the PAYMENT_CHECKOUT_STORE, see hello.cfg for why that's SQLite
+    session['checkout'] = payments.save_checkout(trans)
     
     return redirect(trans.redirect_url)
 
 @app.route('/paypal-express-complete')
 def paypal_express_complete():
-    trans = session['trans']
+    trans = payments.resume_checkout(session['checkout'])
+    if trans is None: # expired, start again
+        return redirect(url_for('show_all'))
     payerid = request.values['PayerID'] 
     trans.pay_id = payerid
 
     trans = payments.authorise(trans)
-    session['trans'] = trans
+    payments.save_checkout(trans)
 
     return redirect('/confirm')
 
@@ -41,7 +45,7 @@ def paypal_direct_payments():
 
 @app.route('/confirm')
 def confirm():
-    trans = session['trans']
+    trans = payments.resume_checkout(session['checkout'])
     return render_template('confirmation.html', trans=trans)
 
 if __name__ == '__main__':
@@ -0,0 +1,986 @@
+# -*- coding: utf-8 -*-
+"""
+    flaskext.payments
+    ~~~~~~~~~~~~~~~~~
+
+    Generic Payment gateway classes for Flask Payment
+    May be dirtied with Paypal classes in the first instance
+
+    :copyright: (c) 2010 by jgumbley.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import with_statement
+
+import collections, datetime, itertools, json, numbers, threading, time
+import urllib
+
+from werkzeug.utils import import_string
+
+class PaymentsConfigurationError(Exception): pass
+
+class PaymentsValidationError(Exception):
+    """A transaction which can't be sent to the gateway. `errors` maps each
+    field at fault to what's wrong with it, i.e. {'acct': 'fails the Luhn
+    check'}, and is what the message is made of when there isn't one.
+    """
+
+    def __init__(self, message=None, errors=None):
+        self.errors = errors or {}
+        if message is None:
+            message = '; '.join('%s %s' % item
+                                for item in sorted(self.errors.items()))
+        Exception.__init__(self, message)
+
+class PaymentsErrorFromGateway(Exception): pass
+class PaymentsQueueFull(Exception): pass
+class PaymentsCircuitOpen(PaymentsErrorFromGateway): pass
+
+class Transaction(object):
+    """The payment request value object, with some validation logic
+    It look like the way this is going the various gateways will be able to add
+    whatever they like to this as and when they want.
+
+    Not sure whether to subclass this and use some kind of factory so the app
+    will get the right one depending on how they've instantiated Payments.
+
+    The fields every gateway understands are slots, anything else set on a
+    transaction, i.e. paypal_express_token, is gateway specific and is kept in
+    the `extensions` dict, though it can still be got and set as an attribute.
+    """
+
+    fields = ('type', 'amount', 'return_url', 'cancel_url', 'redirect_url',
+              'pay_id', 'authorised')
+    __slots__ = fields + ('_raw', 'extensions')
+    _slotted = frozenset(__slots__)
+
+    # the card details, which are never to be written anywhere
+    card_fields = ('acct', 'cvv2', 'expdate')
+
+    # first byte of to_bytes output, bump when the layout changes
+    encoding_version = '\x01'
+
+    def validate(self, rules=None):
+        """
+        validate the details of the payment, i.e. run regex on credit card
+        number, ensure all required fields are filled etc.
+
+        rules is the ValidationRules to check against, Payments passes the
+        gateway's for the transaction type. Without any only what every
+        gateway needs is checked, a type and an amount. Raises
+        PaymentsValidationError saying what's wrong, or returns True.
+        """
+        if rules is None:
+            rules = _generic_rules
+        errors = rules.check(self)
+        if errors:
+            raise PaymentsValidationError(errors=errors)
+        return True
+
+
+    def __init__(self):
+        for name in self.fields:
+            setattr(self, name, None)
+        self._raw = None
+        self.extensions = {}
+        self.authorised = False
+
+    def __setattr__(self, name, value):
+        if name in self._slotted:
+            object.__setattr__(self, name, value)
+        else:
+            self.extensions[name] = value
+
+    def __getattr__(self, name):
+        # only called for names which aren't slots
+        if name == 'extensions':
+            raise AttributeError(name)
+        try:
+            return self.extensions[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__
+                    if hasattr(self, name))
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            object.__setattr__(self, name, value)
+
+    def items(self):
+        """Returns (name, value) pairs for the fields which have been filled
+        in and the gateway specific extensions.
+        """
+        items = [(name, getattr(self, name)) for name in self.fields
+                 if getattr(self, name) is not None]
+        return items + sorted(self.extensions.items())
+
+    def holds_card(self):
+        """ whether any of the card details are filled in """
+        return any(name in self.extensions for name in self.card_fields)
+
+    def to_bytes(self, include_raw=False, include_card=True):
+        """Encodes the transaction compactly, i.e. to keep in the session
+        between setupRedirect and authorise. The gateway's raw response is
+        left out unless include_raw is set, and the card details are if
+        include_card isn't, as they must be for anything that is stored.
+
+        Values are stored as JSON, so come back from from_bytes as unicode,
+        and anything else, i.e. a Decimal amount, as its string.
+        """
+        raw = self._raw if include_raw else None
+        if raw is not None:
+            raw = getattr(raw, 'raw', raw) # NVPResponse keeps the string
+        values = [getattr(self, name) for name in self.fields]
+        extensions = self.extensions
+        if not include_card and self.holds_card():
+            extensions = dict((name, value) for name, value
+                              in extensions.iteritems()
+                              if name not in self.card_fields)
+        return self.encoding_version + json.dumps(
+                [values, extensions, raw], separators=(',', ':'),
+                default=str)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Decodes a transaction encoded by to_bytes"""
+        if data[:1] != cls.encoding_version:
+            raise ValueError("unknown transaction encoding %r" % data[:1])
+        values, extensions, raw = json.loads(data[1:])
+        trans = cls()
+        for name, value in zip(cls.fields, values):
+            object.__setattr__(trans, name, value)
+        trans.extensions = extensions
+        if raw is not None:
+            trans._raw = NVPResponse(str(raw))
+        return trans
+
+# ------------------------------------------------------------------------
+
+class NVPResponse(collections.Mapping):
+    """Read only mapping over a raw name-value pair response from the gateway.
+
+    The body is split into fields in a single pass, on first access, and each
+    value is only unquoted when it is actually looked up. Values may contain
+    '=' as only the first one in each pair separates the name from the value.
+
+    The indexed list fields, i.e. L_ERRORCODE0, L_SHORTMESSAGE0, L_ERRORCODE1
+    and so on, are available grouped by index through `lists`.
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._fields = None
+        self._decoded = {}
+
+    def _parse(self):
+        fields = {}
+        if self.raw:
+            for pair in self.raw.split('&'):
+                name, _, value = pair.partition('=')
+                fields[name] = value
+        self._fields = fields
+        return fields
+
+    def __getitem__(self, name):
+        decoded = self._decoded
+        if name in decoded:
+            return decoded[name]
+        fields = self._fields
+        if fields is None:
+            fields = self._parse()
+        value = decoded[name] = urllib.unquote(fields[name])
+        return value
+
+    def __iter__(self):
+        return iter(self._fields if self._fields is not None
+                    else self._parse())
+
+    def __len__(self):
+        return len(self._fields if self._fields is not None
+                   else self._parse())
+
+    def __repr__(self):
+        return 'NVPResponse(%r)' % self.raw
+
+    def lists(self):
+        """Returns the indexed L_ fields grouped into rows by their index, as
+        a list of dicts ordered by index. So L_ERRORCODE0 and L_SHORTMESSAGE0
+        become::
+
+            [{'ERRORCODE': ..., 'SHORTMESSAGE': ...}]
+        """
+        fields = self._fields
+        if fields is None:
+            fields = self._parse()
+        unquote = urllib.unquote
+        rows = {}
+        for name, value in fields.iteritems():
+            if name.startswith('L_'):
+                field = name.rstrip('0123456789')
+                if len(field) > 2 and len(field) < len(name):
+                    index = int(name[len(field):])
+                    rows.setdefault(index, {})[field[2:]] = unquote(value)
+        return [rows[index] for index in sorted(rows)]
+
+def nvp_fields(raw, *names):
+    """Fast path for when only a handful of fields are wanted out of a
+    response, i.e. TOKEN, ACK or TRANSACTIONID. Finds each one directly in the
+    raw body without splitting the rest of it up and returns the unquoted
+    values in a dict. Missing fields are left out.
+    """
+    found = {}
+    for name in names:
+        key = name + '='
+        if raw.startswith(key):
+            start = len(key)
+        else:
+            start = raw.find('&' + key)
+            if start == -1:
+                continue
+            start += len(key) + 1
+        end = raw.find('&', start)
+        if end == -1:
+            end = len(raw)
+        found[name] = urllib.unquote(raw[start:end])
+    return found
+
+class NVPTemplate(object):
+    """Request encoding for one NVP API method, worked out once so a call
+    only has to encode its own values.
+
+    Encodes exactly as prefix + urllib.urlencode(params) would, in the same
+    order, with the values of the names in `fields` swapped for the ones
+    passed to encode, in that order. Everything else, i.e. METHOD, is
+    encoded up front.
+
+    :param prefix: already encoded start of every request, i.e. the signature
+    :param params: the params dict the method used to encode on every call
+    :param fields: names in params whose values change from call to call
+    """
+
+    def __init__(self, prefix, params, *fields):
+        self.method = params.get('METHOD')
+        self.fields = fields
+        quote = urllib.quote_plus
+        pairs, order = [], []
+        for name, value in params.items(): # the order urlencode takes
+            if name in fields:
+                order.append(fields.index(name))
+                value = '%s'
+            else:
+                value = quote(str(value)).replace('%', '%%')
+            pairs.append(quote(str(name)).replace('%', '%%') + '=' + value)
+        self._format = prefix.replace('%', '%%') + '&'.join(pairs)
+        self._order = None if order == range(len(fields)) else order
+
+    def encode(self, *values):
+        quote = urllib.quote_plus
+        if self._order is not None:
+            values = [values[i] for i in self._order]
+        return self._format % tuple([quote(str(value)) for value in values])
+
+# ------------------------------------------------------------------------
+
+# everything else is kept in modules of its own, which build on the
+# exceptions, Transaction and NVP above, and is gathered back up here
+from flaskext.payments.transport import HTTPTransport, GreenHTTPTransport, \
+     AsyncHTTPTransport, PaymentsFuture, budget, _current_deadline, \
+     _remaining, _retryable, _Scheduler
+from flaskext.payments.metrics import gateway_call, payment_operation, \
+     LatencyHistogram, LatencyMetrics, _has_receivers
+from flaskext.payments.health import CircuitBreaker, GatewayHealth
+from flaskext.payments.limits import RateLimiter, AdaptiveLimiter
+from flaskext.payments.validation import ValidationRules, validation_rules, \
+     _generic_rules
+from flaskext.payments.audit import AuditLog, audit_log
+from flaskext.payments.batch import BatchResult, BatchCheckpoint, \
+     _iter_windows, _run_batch, _wait, _write_csv, _write_jsonl
+from flaskext.payments.cache import MemoryCache, SQLiteCache, CheckoutStore, \
+     TransactionDetailsCache, SingleFlight
+from flaskext.payments.capture import CaptureStatus, CaptureQueue
+from flaskext.payments.routing import MerchantAccounts, RouteStats, \
+     GatewayRouter, _AccountApp
+
+# ------------------------------------------------------------------------
+
+class Payments(object):
+    """
+    Manages payment processing
+
+    :param app: Flask instance
+
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Initializes payment gateway from the application settings.
+
+        You can use this if you want to set up your Payment instance
+        at configuration time.
+
+        Binds to a specific implementation class based on the value
+        in the PAYMENTS_API config value. 
+
+        :param app: Flask application instance
+
+        """
+        # initialise gateway based on configuration
+        self._init_gateway(app)
+        self._init_accounts(app)
+        self._init_routes(app)
+        self._init_flights(app)
+        self._init_checkouts(app)
+        self._init_captures(app)
+        self._init_health(app)
+       
+        self.testing = app.config['TESTING']
+        self.app = app # this Payments instance reference to the Flask app
+
+    def _init_gateway(self, app):
+        """what i'm trying to do here is have some logic to conditionally
+        instantiate a "payment gateway" member depending on the configuration
+        of the PAYMENT_API configuration parameter.
+        
+        want to fail early if gateway not properly configured, so the idea
+        is to delegate to the payment gateway class at this point to give it
+        to the opptunity to validate its configuration and fail if needs be.
+        """
+        name = app.config.get('PAYMENT_API')
+        if not name:
+            raise PaymentsConfigurationError(
+                    "PAYMENT_API must name the payment gateway to use, one of "
+                    + ', '.join(gateways.names()))
+        gateway_class = self._gateway_class(name)
+        check_config(app.config, getattr(gateway_class, 'config_schema', {}),
+                     name)
+        self.gateway = gateway_class(app)
+        self.gateway_class = gateway_class
+        self.validation = validation_rules(gateway_class)
+
+    def _gateway_class(self, name):
+        return gateways.load(name)
+
+    def _init_accounts(self, app):
+        """ sets up the merchant accounts in PAYMENT_ACCOUNTS, a dict of
+        account name to the settings it has of its own, i.e.
+
+            PAYMENT_ACCOUNTS = {'shop-a': {'PAYPAL_API_USER': ...,
+                                           'PAYPAL_API_PWD': ...,
+                                           'PAYPAL_API_SIGNATURE': ...}}
+
+        anything it doesn't set is taken from the app's. Every account's
+        settings are checked now, but its gateway is only made when it's
+        first used. Up to PAYMENT_ACCOUNTS_ACTIVE are kept, and any which
+        go PAYMENT_ACCOUNT_IDLE_TIMEOUT seconds unused are let go.
+        """
+        config = app.config
+        accounts = config.get('PAYMENT_ACCOUNTS')
+        if not accounts:
+            self.accounts = None
+            return
+        schema = getattr(self.gateway_class, 'config_schema', {})
+        name = config['PAYMENT_API']
+        settings = {}
+        for account, overrides in accounts.iteritems():
+            settings[account] = _AccountApp(app, overrides)
+            check_config(settings[account].config, schema,
+                         '%s (account %s)' % (name, account))
+        self.accounts = MerchantAccounts(
+                lambda account: self.gateway_class(settings[account]),
+                settings, config.get('PAYMENT_ACCOUNTS_ACTIVE', 100),
+                config.get('PAYMENT_ACCOUNT_IDLE_TIMEOUT', 600))
+
+    def _init_routes(self, app):
+        """ sets up routing between the gateways in PAYMENT_ROUTES, a dict of
+        route name to the settings it has of its own, as PAYMENT_ACCOUNTS,
+        including its PAYMENT_API if it's a different gateway and its share
+        of the traffic as PAYMENT_ROUTE_WEIGHT, 1 by default. See
+        GatewayRouter for how they're picked between, PAYMENT_ROUTE_WINDOW
+        and PAYMENT_ROUTE_MAX_ERROR_RATE are passed on to it.
+        """
+        config = app.config
+        routes = config.get('PAYMENT_ROUTES')
+        if not routes:
+            self.router = None
+            return
+        gateways = []
+        for route, overrides in sorted(routes.iteritems()):
+            settings = _AccountApp(app, overrides)
+            name = settings.config['PAYMENT_API']
+            gateway_class = self._gateway_class(name)
+            check_config(settings.config,
+                         getattr(gateway_class, 'config_schema', {}),
+                         '%s (route %s)' % (name, route))
+            gateways.append((route, gateway_class(settings),
+                    settings.config.get('PAYMENT_ROUTE_WEIGHT', 1)))
+        self.router = GatewayRouter(gateways, self.gateway,
+                window=config.get('PAYMENT_ROUTE_WINDOW', 50),
+                max_error_rate=config.get('PAYMENT_ROUTE_MAX_ERROR_RATE', 0.5))
+
+    def _on_account(self, account, call):
+        """ calls call(gateway) with the gateway for the merchant account,
+        or the app's own for None, holding on to it until any future it
+        returns is done
+        """
+        if account is None:
+            return call(self.gateway)
+        if self.accounts is None or account not in self.accounts:
+            raise PaymentsValidationError(errors={
+                'account': "isn't one of the PAYMENT_ACCOUNTS"})
+        gateway = self.accounts.acquire(account)
+        try:
+            result = call(gateway)
+        except:
+            self.accounts.release(gateway)
+            raise
+        if isinstance(result, PaymentsFuture):
+            result.add_done_callback(
+                    lambda future: self.accounts.release(gateway))
+        else:
+            self.accounts.release(gateway)
+        return result
+
+    def _routed(self, method):
+        """ the gateway method for the account a transaction is for, or the
+        route the router picks for it if there isn't one
+        """
+        def call(trans):
+            account = getattr(trans, 'account', None)
+            if self.router is not None and account is None:
+                return self.router.call(trans, method)
+            return self._on_account(account,
+                    lambda gateway: getattr(gateway, method)(trans))
+        return call
+
+    def _init_checkouts(self, app):
+        """ sets up the CheckoutStore save_checkout and resume_checkout use.
+        PAYMENT_CHECKOUT_STORE is 'memory', the default, to keep up to
+        PAYMENT_CHECKOUT_STORE_SIZE checkouts in this process, 'sqlite' to
+        keep them in the PAYMENT_CHECKOUT_STORE_PATH database, or a werkzeug
+        style cache object. They're kept for PAYMENT_CHECKOUT_TTL seconds.
+        Only this process sees those kept in memory, so with more than one
+        worker the return from PayPal may not find its checkout, use one of
+        the others there.
+        """
+        backend = app.config.get('PAYMENT_CHECKOUT_STORE', 'memory')
+        if backend == 'memory':
+            backend = MemoryCache(
+                    app.config.get('PAYMENT_CHECKOUT_STORE_SIZE', 10000))
+        elif backend == 'sqlite':
+            try:
+                backend = SQLiteCache(app.config['PAYMENT_CHECKOUT_STORE_PATH'])
+            except KeyError:
+                raise PaymentsConfigurationError("PAYMENT_CHECKOUT_STORE_PATH "
+                        "must be set to keep checkouts in SQLite")
+        self.checkouts = CheckoutStore(backend,
+                app.config.get('PAYMENT_CHECKOUT_TTL', 10800))
+
+    def _init_captures(self, app):
+        """ turns on deferred authorisation if PAYMENT_DEFERRED_CAPTURE is
+        set, with a CaptureQueue of PAYMENT_CAPTURE_WORKERS threads which
+        lets PAYMENT_CAPTURE_QUEUE_DEPTH wait, journalled to the SQLite
+        database at PAYMENT_CAPTURE_QUEUE_PATH if there is one. When it's
+        full authorise waits up to PAYMENT_CAPTURE_QUEUE_BLOCK seconds.
+        """
+        config = app.config
+        if not config.get('PAYMENT_DEFERRED_CAPTURE'):
+            self.captures = None
+            return
+        deadline = config.get('PAYMENT_DEADLINE')
+        self.captures = CaptureQueue(
+                lambda trans, key: self._authorise(trans, deadline, key),
+                workers=config.get('PAYMENT_CAPTURE_WORKERS', 4),
+                depth=config.get('PAYMENT_CAPTURE_QUEUE_DEPTH', 1000),
+                block=config.get('PAYMENT_CAPTURE_QUEUE_BLOCK', 0),
+                path=config.get('PAYMENT_CAPTURE_QUEUE_PATH'),
+                retain=config.get('PAYMENT_CAPTURE_RETAIN', 86400))
+
+    def _init_health(self, app):
+        """ sets up the gateway's GatewayHealth for health to report on. If
+        PAYMENT_PREWARM is set that many connections are opened to it in
+        the background, without holding up startup, and if
+        PAYMENT_PROBE_INTERVAL is it's probed every that many seconds,
+        keeping them alive. Probes give up after PAYMENT_PROBE_TIMEOUT.
+        """
+        config = app.config
+        self.gateway_health = GatewayHealth(self.gateway,
+                config.get('PAYMENT_PREWARM', 0),
+                config.get('PAYMENT_PROBE_INTERVAL'),
+                config.get('PAYMENT_PROBE_TIMEOUT', 5))
+        if self.gateway_health.prewarm or self.gateway_health.interval:
+            self.gateway_health.start()
+
+    def health(self, max_age=None):
+        """The readiness check, whether the gateway can be reached and how
+        fast it's answering, see GatewayHealth.check::
+
+            @app.route('/ready')
+            def ready():
+                health = payments.health(max_age=30)
+                return json.dumps(health), 200 if health['ready'] else 503
+        """
+        return self.gateway_health.check(max_age)
+
+    def _init_flights(self, app):
+        """ sets up the SingleFlight making sure a payment is only authorised
+        once. PAYMENT_IDEMPOTENCY_CACHE is 'memory', the default, to keep
+        outcomes for PAYMENT_IDEMPOTENCY_TTL seconds in this process, a
+        werkzeug style cache object to share them between processes, or None
+        to turn this off.
+        """
+        backend = app.config.get('PAYMENT_IDEMPOTENCY_CACHE', 'memory')
+        if backend is None:
+            self.flights = None
+            return
+        if backend == 'memory':
+            backend = MemoryCache(
+                    app.config.get('PAYMENT_IDEMPOTENCY_CACHE_SIZE', 1000))
+        self.flights = SingleFlight(backend,
+                app.config.get('PAYMENT_IDEMPOTENCY_TTL', 300))
+
+            
+    def setupRedirect(self, trans, deadline=None):
+        """Some gateways such as PayPal WPP Express Checkout and Google payments
+        require you to redirect your customer to them first to collect info, 
+        so going to make an explict getRedirect method for these instances.
+
+        Returns the transaction with the redirect url attached. I guess the idea
+        is the app stuffs this in the session and when it gets the user back
+        will call authorise using this transaction.
+
+        deadline is the total number of seconds all the calls to the gateway
+        this takes may have between them, PAYMENT_DEADLINE by default.
+        """
+        if self._validate(trans): # the gateway's rules for this type
+            return self._instrument('setupRedirect', self._routed('setupRedirect'), trans, deadline) # gateway implementation does own
+
+
+    def authorise(self, trans, deadline=None, idempotency_key=None):
+        """Returns a valid authorisation (accepted or declined) or an error,
+        which can be application (i.e. validation) or a system error (i.e. 500).
+        
+        The transaction is subject to gernic validatation, i.e. does it have
+        necessary fields and do they add up, and only if valid will the
+        instantiated gateway be invoked.
+
+        deadline is the total number of seconds all the calls to the gateway
+        this takes may have between them, PAYMENT_DEADLINE by default.
+
+        A transaction with an `account` set goes to that merchant account in
+        PAYMENT_ACCOUNTS, otherwise to the one the app is configured with,
+        or with PAYMENT_ROUTES to whichever GatewayRouter picks.
+
+        A payment is only authorised once for each idempotency_key, or if
+        there isn't one whatever the gateway identifies it by, i.e. the
+        PayPal express token. Asking again gets the first outcome back.
+
+        With PAYMENT_DEFERRED_CAPTURE set the transaction is only queued,
+        and comes straight back with a capture_id to ask status about.
+        """
+        if self._validate(trans): # the gateway's rules for this type
+            key = idempotency_key or self.gateway.idempotency_key(trans)
+            account = getattr(trans, 'account', None)
+            if key is not None and account is not None:
+                key = '%s:%s' % (account, key) # keys are the account's own
+            if self.captures is not None:
+                trans.capture_id = self.captures.submit(trans, key)
+                return self._settle(self._answer(trans))
+            return self._authorise(trans, deadline, key)
+
+    def _validate(self, trans):
+        return trans.validate(self.validation.get(trans.type,
+                                                  self.validation[None]))
+
+    def validate_many(self, transactions, chunk=10000):
+        """Checks lots of transactions at once, i.e. an imported order file,
+        against the same rules setupRedirect and authorise use, without
+        sending anything. Yields a dict of field to problem for each
+        transaction, in order, empty if it's valid.
+
+        Transactions are taken `chunk` at a time and each rule is run down
+        the whole chunk of its type in one go, rather than every rule over
+        each transaction in turn.
+        """
+        transactions = iter(transactions)
+        while True:
+            batch = list(itertools.islice(transactions, chunk))
+            if not batch:
+                return
+            errors = [None] * len(batch)
+            by_type = {}
+            for i, trans in enumerate(batch):
+                by_type.setdefault(trans.type, []).append(i)
+            for type, positions in by_type.iteritems():
+                rules = self.validation.get(type, self.validation[None])
+                checked = rules.check_many([batch[i] for i in positions])
+                for i, problems in itertools.izip(positions, checked):
+                    errors[i] = problems
+            for problems in errors:
+                yield problems
+
+    def _authorise(self, trans, deadline, key):
+        if key is None or self.flights is None:
+            return self._instrument('authorise', self._routed('authorise'), trans, deadline) # gateway implementation does own
+        flight = self.flights.run(key, lambda: self._instrument(
+                'authorise', self._routed('authorise'), trans, deadline))
+        return self._settle(flight)
+
+    def status(self, capture_id):
+        """The CaptureStatus of an authorisation deferred by authorise, by
+        its capture_id, or None if it isn't known.
+        """
+        if self.captures is None:
+            raise PaymentsConfigurationError(
+                    "PAYMENT_DEFERRED_CAPTURE isn't set")
+        return self.captures.status(capture_id)
+
+    def on_capture(self, callback):
+        """Registers callback(capture_id, status) to be called, on a worker
+        thread, as each deferred authorisation finishes::
+
+            @payments.on_capture
+            def captured(capture_id, status):
+                ...
+        """
+        if self.captures is None:
+            raise PaymentsConfigurationError(
+                    "PAYMENT_DEFERRED_CAPTURE isn't set")
+        return self.captures.add_callback(callback)
+
+    def _answer(self, trans):
+        future = PaymentsFuture()
+        future.set_result(trans)
+        return future
+
+    def _settle(self, future):
+        return future.result()
+
+    def save_checkout(self, trans):
+        """Keeps a transaction setupRedirect has been through until the
+        customer comes back from the gateway, returning the token to resume
+        it by, i.e. to put in the session::
+
+            trans = payments.setupRedirect(trans)
+            session['checkout'] = payments.save_checkout(trans)
+        """
+        token = self.gateway.checkout_token(trans)
+        if not token:
+            raise PaymentsValidationError("transaction has no checkout token, "
+                                          "has it been through setupRedirect?")
+        self.checkouts.save(token, trans)
+        return token
+
+    def resume_checkout(self, token):
+        """Returns the transaction saved by save_checkout for the token, or
+        None if there isn't one or it has expired.
+        """
+        return self.checkouts.load(token)
+
+    def forget_checkout(self, token):
+        """Drops a saved transaction, i.e. once it's been authorised"""
+        self.checkouts.delete(token)
+
+    @property
+    def metrics(self):
+        """The gateway's LatencyMetrics, when PAYMENT_METRICS is set, with a
+        histogram per API method and per Payments operation.
+        """
+        return getattr(self.gateway, 'metrics', None)
+
+    @property
+    def audit(self):
+        """The gateway's AuditLog, when PAYMENT_AUDIT_PATH is set, to look
+        up what was sent and received for a token or transaction id::
+
+            payments.audit.lookup('8VF51385W1287451J')
+        """
+        return getattr(self.gateway, 'audit', None)
+
+    def _instrument(self, operation, call, trans, deadline=None):
+        """ times the call, recording it in the metrics and sending the
+        payment_operation signal, but only if anything is listening, and
+        holds it to its deadline
+        """
+        if deadline is None:
+            deadline = self.app.config.get('PAYMENT_DEADLINE')
+        metrics = self.metrics
+        if metrics is None and not _has_receivers(payment_operation):
+            with budget(deadline):
+                return call(trans)
+        started = time.time()
+        try:
+            with budget(deadline):
+                result = call(trans)
+        except Exception, e:
+            self._record(operation, started, e)
+            raise
+        if isinstance(result, PaymentsFuture):
+            result.add_done_callback(lambda future:
+                    self._record(operation, started, future.exception()))
+        else:
+            self._record(operation, started, None)
+        return result
+
+    def _record(self, operation, started, error):
+        duration = time.time() - started
+        if self.metrics is not None:
+            self.metrics.record(operation, duration, error is not None)
+        if _has_receivers(payment_operation):
+            payment_operation.send(self, operation=operation,
+                    duration=duration,
+                    error=error.__class__ if error is not None else None)
+
+
+    def get_transaction_details_many(self, ids, concurrency=None, rate=None,
+                                     account=None):
+        """Looks up the details of lots of transactions at once, i.e. for
+        reconciliation, over a pool of `concurrency` worker threads.
+
+        Returns a generator of BatchResults, keyed on transaction id, in the
+        order the lookups finish. A lookup which fails comes back as a result
+        with the error on rather than stopping the rest of the batch.
+
+        Calls to the gateway are held to `rate` a second to stay clear of its
+        throttling. Both default to the PAYMENT_BATCH_CONCURRENCY (8) and
+        PAYMENT_BATCH_RATE (unlimited) settings.
+
+        The transactions are looked up in the merchant `account` named, or
+        the app's own.
+        """
+        config = self.app.config
+        if concurrency is None:
+            concurrency = config.get('PAYMENT_BATCH_CONCURRENCY', 8)
+        if rate is None:
+            rate = config.get('PAYMENT_BATCH_RATE')
+        limiter = RateLimiter(rate) if rate else None
+        return _run_batch(ids, lambda tx_id: self._on_account(account,
+                lambda gateway: gateway.GetTransactionDetails(tx_id)),
+                concurrency, limiter)
+
+    def capture_many(self, authorisations, concurrency=None, rate=None,
+                     checkpoint=None, account=None):
+        """Captures lots of authorisations at once, i.e. at dispatch time.
+        `authorisations` is an iterable of (authorisation id, amount) pairs.
+
+        Runs just like get_transaction_details_many, yielding BatchResults
+        keyed on authorisation id with the gateway's response, as they
+        finish.
+
+        Give a `checkpoint`, a file path or BatchCheckpoint, and progress is
+        recorded as it's made, so running the same batch again after it was
+        interrupted picks up where it left off. Those already captured come
+        straight back from the checkpoint. Those which were in flight are
+        only captured if the gateway says they're still open, and come back
+        with None for a result if they aren't.
+        """
+        return self._settle_many(authorisations, lambda item: item[0],
+                lambda gateway, item: gateway.capture(*item), concurrency,
+                rate, checkpoint, account)
+
+    def void_many(self, authorisation_ids, concurrency=None, rate=None,
+                  checkpoint=None, account=None):
+        """Voids lots of authorisations at once, as capture_many captures
+        them, given an iterable of authorisation ids.
+        """
+        return self._settle_many(authorisation_ids, lambda item: item,
+                lambda gateway, item: gateway.void(item), concurrency, rate,
+                checkpoint, account)
+
+    def iter_transactions(self, start, end, window=None, concurrency=None,
+                          account=None, **filters):
+        """Yields every transaction from the start datetime up to the end
+        one, UTC, oldest first, as a dict of the gateway's fields for it.
+        filters narrow the search, i.e. STATUS='Success' for PayPal.
+
+        The range is searched a `window` timedelta at a time, a day unless
+        PAYMENT_SEARCH_WINDOW says how many seconds, with up to
+        `concurrency` (PAYMENT_SEARCH_CONCURRENCY, 4) windows fetched ahead.
+        Windows with more in than the gateway will answer with are split up
+        until they don't, and PaymentsErrorFromGateway raised if even a
+        second has too many. Only those windows are held in memory, however
+        many transactions there are.
+
+        It's the merchant `account` named which is searched, or the app's
+        own.
+        """
+        config = self.app.config
+        if window is None:
+            window = datetime.timedelta(
+                    seconds=config.get('PAYMENT_SEARCH_WINDOW', 86400))
+        if concurrency is None:
+            concurrency = config.get('PAYMENT_SEARCH_CONCURRENCY', 4)
+        return _iter_windows(lambda low, high: self._on_account(account,
+                lambda gateway: gateway.search_transactions(low, high,
+                                                            filters)),
+                start, end, window, concurrency)
+
+    def export_transactions(self, out, start, end, format='csv', **kwargs):
+        """Writes iter_transactions(start, end, **kwargs) to the file `out`
+        as it goes, as 'csv' with a header row or 'jsonl', one JSON object
+        a line. Returns how many were written.
+        """
+        records = self.iter_transactions(start, end, **kwargs)
+        if format == 'jsonl':
+            return _write_jsonl(records, out)
+        if format == 'csv':
+            return _write_csv(records, out)
+        raise ValueError("can't export transactions as %r" % format)
+
+    def _settle_many(self, items, key, call, concurrency, rate, checkpoint,
+                     account):
+        config = self.app.config
+        if concurrency is None:
+            concurrency = config.get('PAYMENT_BATCH_CONCURRENCY', 8)
+        if rate is None:
+            rate = config.get('PAYMENT_BATCH_RATE')
+        limiter = RateLimiter(rate) if rate else None
+        if isinstance(checkpoint, basestring):
+            checkpoint = BatchCheckpoint(checkpoint)
+
+        def settle(gateway, item):
+            if checkpoint is None:
+                return _wait(call(gateway, item))
+            name = key(item)
+            state, raw = checkpoint.get(name)
+            if state == 'done':
+                return NVPResponse(raw) if raw is not None else None
+            if state == 'started' and \
+                    not _wait(gateway.authorisation_open(name)):
+                # it went through before we were interrupted
+                checkpoint.mark(name, 'done')
+                return None
+            checkpoint.mark(name, 'started')
+            response = _wait(call(gateway, item)) # in doubt if this raises
+            if response.get('ACK') in ('Success', 'SuccessWithWarning'):
+                checkpoint.mark(name, 'done', response.raw)
+            else:
+                checkpoint.mark(name, 'failed', response.raw)
+            return response
+
+        for result in _run_batch(items, lambda item: self._on_account(account,
+                lambda gateway: settle(gateway, item)), concurrency, limiter):
+            yield BatchResult(key(result.key), result.result, result.error)
+
+
+class AsyncPayments(Payments):
+    """
+    Manages payment processing without blocking on the gateway.
+
+    setupRedirect and authorise validate the transaction just as Payments
+    does, raising straight away if it isn't valid, but then return a
+    PaymentsFuture for the gateway's answer rather than waiting on it. So a
+    single worker can have hundreds of calls to the gateway in flight::
+
+        futures = [payments.authorise(trans) for trans in batch]
+        for future in futures:
+            trans = future.result()
+
+    :param app: Flask instance
+
+    """
+
+    def _gateway_class(self, name):
+        gateway_class = getattr(gateways.load(name), 'async_gateway', None)
+        if gateway_class is None:
+            raise PaymentsConfigurationError(
+                    "the %s gateway can't be used with AsyncPayments" % name)
+        return gateway_class
+
+    def _settle(self, future):
+        return future
+
+# ------------------------------------------------------------------------
+
+class GatewayRegistry(object):
+    """Where Payments finds the gateway PAYMENT_API names. Gateways are
+    registered by import path and only imported when they're asked for, so
+    an app only pays for the one it uses.
+
+    Gateways which aren't registered directly are looked for in the `group`
+    entry point group, so a separately installed backend can add itself from
+    its setup.py::
+
+        entry_points={'flaskext.payments.gateways': [
+            'Stripe = flask_payments_stripe:StripeGateway']}
+
+    A gateway class may have a `config_schema`, checked by check_config
+    before it's made, and an `async_gateway` for AsyncPayments to use.
+    """
+
+    def __init__(self, group):
+        self.group = group
+        self._gateways = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, gateway):
+        """Registers a gateway class, or its 'module:Class' import path"""
+        with self._lock:
+            self._gateways[name] = gateway
+
+    def names(self):
+        names = set(self._gateways)
+        names.update(entry_point.name for entry_point in self._entry_points())
+        return sorted(names)
+
+    def load(self, name):
+        """Returns the gateway class called name, importing it if need be"""
+        with self._lock:
+            gateway = self._gateways.get(name)
+            if gateway is None:
+                for entry_point in self._entry_points(name):
+                    gateway = entry_point.load()
+                    break
+                else:
+                    raise PaymentsConfigurationError(
+                            "PAYMENT_API %r isn't a known gateway, the ones "
+                            "available are %s" % (name,
+                            ', '.join(sorted(self._gateways))))
+            elif isinstance(gateway, basestring):
+                gateway = import_string(gateway)
+            self._gateways[name] = gateway
+            return gateway
+
+    def _entry_points(self, name=None):
+        # pkg_resources is slow to import so only when it's really needed
+        try:
+            import pkg_resources
+        except ImportError:
+            return []
+        return pkg_resources.iter_entry_points(self.group, name)
+
+#: The gateways Payments can use, see GatewayRegistry.
+gateways = GatewayRegistry('flaskext.payments.gateways')
+gateways.register('PayPal', 'flaskext.payments.paypal:PayPalGateway')
+gateways.register('Simulated',
+                  'flaskext.payments.simulated:SimulatedGateway')
+
+def check_config(config, schema, gateway):
+    """Checks the app config against a gateway's config_schema, which maps
+    setting names to (type or tuple of types, required) pairs, raising
+    PaymentsConfigurationError for the first setting which is missing or of
+    the wrong type. Settings which aren't required may be None.
+    """
+    for name in sorted(schema):
+        types, required = schema[name]
+        value = config.get(name)
+        if value is None or value == '':
+            if required:
+                raise PaymentsConfigurationError(
+                        "%s must be set to use the %s gateway"
+                        % (name, gateway))
+            continue
+        if not isinstance(value, types):
+            if not isinstance(types, tuple):
+                types = (types,)
+            raise PaymentsConfigurationError("%s should be %s, not %r"
+                    % (name, ' or '.join(_type_name(t) for t in types),
+                       value))
+
+def _type_name(t):
+    return {basestring: 'a string', numbers.Real: 'a number'}.get(t,
+            getattr(t, '__name__', str(t)))
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+    flaskext.payments.audit
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    An append-only log of every call made to a gateway, with the sensitive
+    fields left out, indexed so a transaction's calls can be looked up.
+
+    :copyright: (c) 2010 by jgumbley.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import with_statement
+
+import itertools, json, os, Queue, threading, time, traceback, urlparse
+
+class AuditLog(object):
+    """Append-only record of every request made to the gateway and what came
+    back, as JSON lines in segment files under the directory `path`, each
+    up to `segment_size` bytes before the next is started.
+
+    record only queues the exchange, so it costs the caller next to nothing.
+    A writer thread takes everything queued at once, up to `batch`, takes
+    out the `redact` fields and all but the last four characters of the
+    `mask` ones, writes it and syncs it to disk in one go. If
+    `depth` are waiting record blocks until they're written rather than
+    any being lost.
+
+    The `index` fields, i.e. TOKEN and TRANSACTIONID, of requests and
+    responses are indexed in an SQLite database alongside, so `lookup`
+    goes straight to the entries for one without reading the segments.
+
+    Only one process should write to a directory, see audit_log for
+    sharing one in a process.
+    """
+
+    def __init__(self, path, redact=(), mask=(), index=(),
+                 segment_size=64 << 20, batch=1000, depth=100000, fsync=True):
+        import sqlite3 # only for those who use it
+        self.path = path
+        self.redact = frozenset(redact)
+        self.mask = frozenset(mask)
+        self.index = tuple(index)
+        self.segment_size = segment_size
+        self.batch = batch
+        self.fsync = fsync
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._db = sqlite3.connect(os.path.join(path, 'index.db'),
+                                   timeout=10, check_same_thread=False)
+        self._db_lock = threading.Lock()
+        with self._db_lock:
+            self._db.execute('CREATE TABLE IF NOT EXISTS audit_index '
+                             '(key TEXT, segment INTEGER, offset INTEGER)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS audit_index_key '
+                             'ON audit_index (key)')
+            self._db.commit()
+        segments = self._segments()
+        self._open(segments[-1] if segments else 1)
+        self._todo = Queue.Queue(depth)
+        self._writer = threading.Thread(target=self._write,
+                                        name='payments-audit')
+        self._writer.daemon = True
+        self._writer.start()
+
+    def record(self, method, sent, received, error, duration):
+        """Queues an exchange with the gateway, received being the raw
+        response or None if there's an error instead
+        """
+        self._todo.put((time.time(), method, sent, received,
+                        None if error is None else
+                        '%s: %s' % (error.__class__.__name__, error),
+                        duration))
+
+    def flush(self):
+        """Waits for everything recorded so far to be written"""
+        self._todo.join()
+
+    def lookup(self, key):
+        """The entries, oldest first, with a token or transaction id of key
+        in either the request or the response
+        """
+        with self._db_lock:
+            rows = self._db.execute('SELECT segment, offset FROM audit_index '
+                                    'WHERE key = ? ORDER BY segment, offset',
+                                    (key,)).fetchall()
+        entries = []
+        for number, offsets in itertools.groupby(rows, lambda row: row[0]):
+            with open(self._segment_path(number), 'rb') as segment:
+                for number, offset in offsets:
+                    segment.seek(offset)
+                    entries.append(json.loads(segment.readline()))
+        return entries
+
+    def _segments(self):
+        return sorted(int(name[:-6]) for name in os.listdir(self.path)
+                      if name.endswith('.jsonl') and name[:-6].isdigit())
+
+    def _segment_path(self, number):
+        return os.path.join(self.path, '%08d.jsonl' % number)
+
+    def _open(self, number):
+        self._number = number
+        self._file = open(self._segment_path(number), 'ab')
+        self._file.seek(0, os.SEEK_END)
+        self._offset = self._file.tell()
+
+    def _write(self):
+        while True:
+            group = [self._todo.get()]
+            while len(group) < self.batch:
+                try:
+                    group.append(self._todo.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                self._commit(group)
+            except Exception:
+                traceback.print_exc() # as a thread would, keep working
+            for item in group:
+                self._todo.task_done()
+
+    def _commit(self, group):
+        """ writes a group of exchanges to the segment and the index with one
+        sync each
+        """
+        lines, keys = [], []
+        for when, method, sent, received, error, duration in group:
+            request = self._fields(sent)
+            response = self._fields(received) if received is not None \
+                    else None
+            line = json.dumps({'time': when, 'method': method,
+                    'duration': duration, 'request': request,
+                    'response': response, 'error': error},
+                    separators=(',', ':'), sort_keys=True) + '\n'
+            if self._offset and self._offset + len(line) > self.segment_size:
+                self._sync()
+                self._file.close()
+                self._open(self._number + 1)
+            found = set()
+            for fields in (request, response or {}):
+                for name in self.index:
+                    if fields.get(name):
+                        found.add(fields[name])
+            keys.extend((key, self._number, self._offset) for key in found)
+            self._file.write(line)
+            self._offset += len(line)
+        self._sync()
+        with self._db_lock:
+            self._db.executemany('INSERT INTO audit_index VALUES (?, ?, ?)',
+                                 keys)
+            self._db.commit()
+
+    def _sync(self):
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def _fields(self, raw):
+        fields = dict(urlparse.parse_qsl(raw, keep_blank_values=True))
+        for name in self.redact.intersection(fields):
+            fields[name] = '[redacted]'
+        for name in self.mask.intersection(fields):
+            fields[name] = '*' * max(0, len(fields[name]) - 4) \
+                    + fields[name][-4:]
+        return fields
+
+_audit_logs = {}
+_audit_logs_lock = threading.Lock()
+
+def audit_log(path, **options):
+    """Returns the AuditLog for the directory path in this process, making
+    it with the options if there isn't one yet, so every gateway configured
+    with the same path writes to the same log.
+    """
+    path = os.path.abspath(path)
+    with _audit_logs_lock:
+        log = _audit_logs.get(path)
+        if log is None:
+            log = _audit_logs[path] = AuditLog(path, **options)
+        return log
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+    flaskext.payments.batch
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Running many gateway calls at once for the *_many methods of Payments,
+    with checkpoints so a settlement run can pick up where it stopped, and
+    searching long date ranges a window at a time.
+
+    :copyright: (c) 2010 by jgumbley.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import with_statement
+
+import collections, csv, datetime, itertools, json, os, Queue, sys
+import threading
+
+from flaskext.payments import PaymentsErrorFromGateway
+from flaskext.payments.transport import PaymentsFuture
+
+class BatchResult(collections.namedtuple('BatchResult', 'key result error')):
+    """What happened to one item of a batch, key being the item it was for.
+    Either result holds what the gateway came back with, or error holds the
+    exception the call failed with.
+    """
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.error is None
+
+_FINISHED = object()
+
+class BatchCheckpoint(object):
+    """Record of how far a capture_many or void_many batch has got, one
+    JSON line per change appended to the file at `path`, so it survives
+    the process being killed part way through. Each key is 'started',
+    'done' or 'failed', along with the gateway's raw response once there
+    is one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._states = {}
+        self._lock = threading.Lock()
+        try:
+            with open(path) as lines:
+                for line in lines:
+                    try:
+                        key, state, raw = json.loads(line)
+                    except ValueError:
+                        continue # torn by the crash we're recovering from
+                    self._states[key] = (state, raw)
+        except IOError:
+            pass
+        self._file = open(path, 'a')
+
+    def get(self, key):
+        """(state, raw response) for key, (None, None) if it isn't known"""
+        return self._states.get(key, (None, None))
+
+    def mark(self, key, state, raw=None):
+        line = json.dumps([key, state, raw]) + '\n'
+        with self._lock:
+            self._states[key] = (state, raw)
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+def _iter_windows(fetch, start, end, step, concurrency):
+    """Yields what fetch(window start, window end) finds, a list of records
+    and whether there were too many to get, for each `step` long window from
+    start to end in turn. Up to `concurrency` windows are fetched ahead of
+    the one being yielded from, and a window there were too many in is
+    split in half and fetched again, down to a second. One there are still
+    too many in raises PaymentsErrorFromGateway rather than leaving any out.
+    """
+    todo = Queue.Queue()
+
+    def work():
+        while True:
+            item = todo.get()
+            if item is _FINISHED:
+                return
+            window, future = item
+            try:
+                future.set_result(fetch(*window))
+            except Exception:
+                future.set_exception()
+
+    def windows():
+        at = start
+        while at < end:
+            yield at, min(at + step, end)
+            at += step
+
+    def submit(window):
+        future = PaymentsFuture()
+        todo.put((window, future))
+        return window, future
+
+    threads = [threading.Thread(target=work) for i in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    upcoming = windows()
+    pending = collections.deque()
+    try:
+        while True:
+            for window in itertools.islice(upcoming,
+                                           max(0, concurrency - len(pending))):
+                pending.append(submit(window))
+            if not pending:
+                return
+            window, future = pending.popleft()
+            records, truncated = future.result()
+            low, high = window
+            if truncated:
+                if high - low <= _SECOND:
+                    raise PaymentsErrorFromGateway("too many transactions "
+                            "from %s to %s to search for" % (low, high))
+                middle = low + (high - low) / 2
+                pending.appendleft(submit((middle, high)))
+                pending.appendleft(submit((low, middle)))
+                continue
+            for record in records:
+                yield record
+    finally:
+        for thread in threads:
+            todo.put(_FINISHED)
+
+_SECOND = datetime.timedelta(seconds=1)
+
+# the columns export_transactions writes as csv, PayPal's TransactionSearch
+# fields
+_CSV_FIELDS = ['TIMESTAMP', 'TIMEZONE', 'TYPE', 'EMAIL', 'NAME',
+               'TRANSACTIONID', 'STATUS', 'AMT', 'CURRENCYCODE', 'FEEAMT',
+               'NETAMT']
+
+def _write_csv(records, out):
+    writer = csv.DictWriter(out, _CSV_FIELDS, extrasaction='ignore')
+    writer.writeheader()
+    count = 0
+    for record in records:
+        writer.writerow(record)
+        count += 1
+    return count
+
+def _write_jsonl(records, out):
+    count = 0
+    for record in records:
+        out.write(json.dumps(record, sort_keys=True) + '\n')
+        count += 1
+    return count
+
+def _wait(result):
+    """ the answer to a gateway call, waiting on it if it's a future """
+    if isinstance(result, PaymentsFuture):
+        return result.result()
+    return result
+
+def _run_batch(items, call, concurrency, limiter=None):
+    """Calls call(item) for each of items over `concurrency` worker threads
+    and yields a BatchResult for each as they complete, in whatever order
+    that is. Items are read from the iterable only as the workers get to
+    them, so it can be arbitrarily long. Closing the generator early stops
+    the workers taking on anything more.
+    """
+    todo = Queue.Queue(concurrency * 2)
+    done = Queue.Queue()
+    stopping = threading.Event()
+    failed = []
+
+    def feed():
+        try:
+            for item in items:
+                if stopping.is_set():
+                    break
+                todo.put(item)
+        except Exception:
+            failed.append(sys.exc_info())
+        finally:
+            for i in range(concurrency):
+                todo.put(_FINISHED)
+
+    def work():
+        while True:
+            item = todo.get()
+            if item is _FINISHED:
+                done.put(_FINISHED)
+                return
+            if stopping.is_set():
+                continue
+            try:
+                if limiter is not None:
+                    limiter.acquire()
+                result = BatchResult(item, call(item), None)
+            except Exception, e:
+                result = BatchResult(item, None, e)
+            done.put(result)
+
+    threads = [threading.Thread(target=feed)]
+    threads.extend(threading.Thread(target=work) for i in range(concurrency))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    finished = 0
+    try:
+        while finished < concurrency:
+            result = done.get()
+            if result is _FINISHED:
+                finished += 1
+            else:
+                yield result
+        if failed:
+            raise failed[0][0], failed[0][1], failed[0][2] # from items
+    finally:
+        stopping.set()
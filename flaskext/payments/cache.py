@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+    flaskext.payments.cache
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Where things are kept between requests: in memory or in SQLite, or any
+    werkzeug style cache. Checkouts between the redirect to the gateway and
+    the return from it, transaction details, and the outcome of payments so
+    each is only made once.
+
+    :copyright: (c) 2010 by jgumbley.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import with_statement
+
+import collections, sys, threading, time
+
+from flaskext.payments import Transaction, nvp_fields
+from flaskext.payments.transport import PaymentsFuture
+
+class MemoryCache(object):
+    """In-process cache of up to `size` entries, evicting the least recently
+    used first. It has the get/set/delete interface of the werkzeug caches,
+    so one of those can be used in its place to share entries between
+    processes, i.e. werkzeug.contrib.cache.MemcachedCache.
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self._entries = collections.OrderedDict() # key: (expires, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._entries.pop(key)
+            except KeyError:
+                return None
+            if expires is not None and expires < time.time():
+                return None
+            self._entries[key] = (expires, value) # now most recently used
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires = time.time() + timeout if timeout else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+class SQLiteCache(object):
+    """Cache in an SQLite database file, with the same get/set/delete
+    interface as MemoryCache, so entries outlive the process and are shared
+    by every process on the machine using the same `path`. Expired entries
+    are cleared out every `purge_every` sets.
+    """
+
+    def __init__(self, path, purge_every=100):
+        import sqlite3 # only for those who use it
+        self.path = path
+        self.purge_every = purge_every
+        self._sets = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=10,
+                                   check_same_thread=False)
+        self._db.text_factory = str
+        with self._lock:
+            self._db.execute('CREATE TABLE IF NOT EXISTS payments_cache '
+                             '(key TEXT PRIMARY KEY, value BLOB, expires REAL)')
+            self._db.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute('SELECT value, expires FROM payments_cache '
+                                   'WHERE key = ?', (key,)).fetchone()
+        if row is None or row[1] is not None and row[1] < time.time():
+            return None
+        return str(row[0])
+
+    def set(self, key, value, timeout=None):
+        expires = time.time() + timeout if timeout else None
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO payments_cache '
+                             'VALUES (?, ?, ?)', (key, buffer(value), expires))
+            self._sets += 1
+            if self._sets % self.purge_every == 0:
+                self._db.execute('DELETE FROM payments_cache '
+                                 'WHERE expires < ?', (time.time(),))
+            self._db.commit()
+
+    def delete(self, key):
+        with self._lock:
+            self._db.execute('DELETE FROM payments_cache WHERE key = ?',
+                             (key,))
+            self._db.commit()
+
+class CheckoutStore(object):
+    """Keeps transactions on the server between the redirect to the gateway
+    and the customer coming back, so the session only has to carry the
+    checkout token rather than the whole transaction.
+
+    :param backend: anything with get(key), set(key, value, timeout) and
+                    delete(key), such as MemoryCache or SQLiteCache
+    :param ttl: seconds to keep a checkout for, PayPal's express tokens
+                last three hours
+    """
+
+    def __init__(self, backend, ttl=10800):
+        self.backend = backend
+        self.ttl = ttl
+
+    def save(self, token, trans):
+        self.backend.set(self._key(token), trans.to_bytes(), self.ttl)
+
+    def load(self, token):
+        data = self.backend.get(self._key(token))
+        if data is None:
+            return None
+        return Transaction.from_bytes(data)
+
+    def delete(self, token):
+        self.backend.delete(self._key(token))
+
+    def _key(self, token):
+        return 'payments-checkout-' + token
+
+class TransactionDetailsCache(object):
+    """Keeps GetTransactionDetails responses around for as long as the
+    transaction's PAYMENTSTATUS suggests they'll stay true, i.e. a completed
+    payment for an hour but a pending one for only half a minute. Only
+    successful responses are kept, as raw NVP strings.
+
+    :param backend: anything with get(key), set(key, value, timeout) and
+                    delete(key), such as MemoryCache
+    :param ttls: seconds to keep a response for, by PAYMENTSTATUS
+    :param default_ttl: seconds to keep responses with any other status
+    """
+
+    ttls = {
+        'Completed': 3600,
+        'Refunded': 3600,
+        'Reversed': 3600,
+        'Denied': 3600,
+        'Pending': 30,
+    }
+
+    def __init__(self, backend, ttls=None, default_ttl=60):
+        self.backend = backend
+        self.ttls = dict(self.ttls, **(ttls or {}))
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, tx_id):
+        raw = self.backend.get(self._key(tx_id))
+        with self._lock:
+            if raw is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return raw
+
+    def store(self, tx_id, raw):
+        fields = nvp_fields(raw, 'ACK', 'PAYMENTSTATUS')
+        if fields.get('ACK') in ('Success', 'SuccessWithWarning'):
+            ttl = self.ttls.get(fields.get('PAYMENTSTATUS'), self.default_ttl)
+            if ttl:
+                self.backend.set(self._key(tx_id), raw, ttl)
+        return raw
+
+    def invalidate(self, tx_id):
+        self.backend.delete(self._key(tx_id))
+
+    def _key(self, tx_id):
+        return 'payments-details-' + tx_id
+
+class SingleFlight(object):
+    """Makes sure the same payment is only authorised once, however many
+    times it's asked for, i.e. by a double click or a browser retrying the
+    return url. Callers asking while it's in flight share the one call to
+    the gateway, and for `ttl` seconds after the outcome is kept in `backend`
+    and handed straight back. Only authorised payments are kept, failures
+    and declines aren't, so can be tried again.
+
+    Outcomes are kept as Transaction.to_bytes, without the card details as
+    the backend may well be shared, and everyone but the caller which
+    actually made the call gets their own copy of the transaction.
+
+    :param backend: anything with get(key), set(key, value, timeout) and
+                    delete(key), such as MemoryCache
+    :param ttl: seconds to keep outcomes for
+    """
+
+    def __init__(self, backend, ttl=300):
+        self.backend = backend
+        self.ttl = ttl
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, call):
+        """Returns a PaymentsFuture for the transaction call() returns, only
+        calling it if nothing has for key already. call may return a future.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight.then(_copy_transaction)
+            flight = self._flights[key] = PaymentsFuture()
+        # the backend may be across the network so it's looked in with the
+        # flight up rather than holding the lock, anyone asking meanwhile
+        # joins it, and anything landed before it went up is already stored
+        try:
+            data = self.backend.get(self._key(key))
+        except Exception:
+            self._land(key, flight, None, sys.exc_info())
+            raise
+        if data is not None:
+            self._land(key, flight, Transaction.from_bytes(data), None,
+                       store=False)
+            return flight
+        try:
+            result = call()
+        except Exception:
+            self._land(key, flight, None, sys.exc_info())
+            return flight
+        if isinstance(result, PaymentsFuture):
+            result.add_done_callback(lambda future: self._land(key, flight,
+                    future._result, future._exc_info))
+        else:
+            self._land(key, flight, result, None)
+        return flight
+
+    def forget(self, key):
+        self.backend.delete(self._key(key))
+
+    def _land(self, key, flight, trans, exc_info, store=True):
+        # stored before the flight goes so there's no gap between the two
+        if store and exc_info is None and trans.authorised:
+            self.backend.set(self._key(key), trans.to_bytes(include_raw=True,
+                             include_card=False), self.ttl)
+        with self._lock:
+            del self._flights[key]
+        if exc_info is None:
+            flight.set_result(trans)
+        else:
+            flight.set_exception(exc_info)
+
+    def _key(self, key):
+        return 'payments-authorised-' + key
+
+def _copy_transaction(trans):
+    return Transaction.from_bytes(trans.to_bytes(include_raw=True))
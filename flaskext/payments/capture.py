@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+    flaskext.payments.capture
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Authorisations run in the background, so the request asking for one
+    doesn't wait on the gateway, journalled to SQLite if need be so none
+    are lost when the process stops.
+
+    :copyright: (c) 2010 by jgumbley.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import with_statement
+
+import collections, Queue, threading, time, traceback, uuid
+
+from flaskext.payments import PaymentsQueueFull, Transaction
+from flaskext.payments.transport import PaymentsFuture
+from flaskext.payments.cache import MemoryCache
+
+class CaptureStatus(collections.namedtuple('CaptureStatus',
+                                           'state transaction error')):
+    """Where a deferred authorisation has got to. state is one of 'pending',
+    'running', 'authorised', 'declined', 'failed' or 'unknown', transaction
+    is the transaction as it was last seen, and error describes why a
+    failed or unknown one is so. An unknown one was running when the
+    process stopped, so may or may not have gone through, and needs
+    looking up with the gateway before it's tried again.
+    """
+    __slots__ = ()
+
+    @property
+    def done(self):
+        return self.state not in ('pending', 'running')
+
+class CaptureQueue(object):
+    """Runs authorisations in the background, over `workers` threads, so
+    the request asking for one doesn't wait on the gateway.
+
+    Once `depth` are waiting, submit waits up to `block` seconds for room
+    before raising PaymentsQueueFull, so a backed up gateway pushes back on
+    callers rather than the queue growing without end.
+
+    With a `path` the queue is journalled to an SQLite database there, and
+    anything pending when the process stopped is run when it next starts.
+    Anything that was running is marked 'unknown' rather than run again, as
+    it may already have been paid for. Finished ones are kept `retain`
+    seconds for status.
+    Card details are never journalled, so a card payment is only written
+    there once it has finished, it couldn't be run again without them.
+
+    :param capture: called with each transaction and an idempotency key or
+                    None, returning the authorised transaction
+    """
+
+    def __init__(self, capture, workers=4, depth=1000, block=0, path=None,
+                 retain=86400):
+        self.capture = capture
+        self.depth = depth
+        self.block = block
+        self.retain = retain
+        self._todo = Queue.Queue()
+        self._waiting = 0
+        self._room = threading.Condition()
+        self._active = {} # id: CaptureStatus, for those not done
+        self._finished = MemoryCache(10000)
+        self._callbacks = []
+        self._journal = _CaptureJournal(path) if path else None
+        if self._journal is not None:
+            for capture_id, key, state, data in \
+                    self._journal.unfinished(retain):
+                if state == 'running':
+                    self._journal.save(capture_id, key, 'unknown', data,
+                            "was running when the process stopped, look it "
+                            "up before trying it again")
+                else:
+                    self._enqueue(capture_id, key,
+                                  Transaction.from_bytes(data))
+        self._threads = [threading.Thread(target=self._work)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, trans, key=None):
+        """Queues the transaction to be authorised, returning the id to ask
+        status about it by, the key if there is one. A key already queued
+        isn't queued again.
+        """
+        capture_id = key or uuid.uuid4().hex
+        with self._room:
+            if capture_id in self._active:
+                return capture_id
+            expires = time.time() + self.block
+            while self._waiting >= self.depth:
+                remaining = expires - time.time()
+                if remaining <= 0:
+                    raise PaymentsQueueFull("%d authorisations already "
+                                            "waiting" % self._waiting)
+                self._room.wait(remaining)
+            self._save(capture_id, key, 'pending', trans)
+            self._enqueue(capture_id, key, trans)
+        return capture_id
+
+    def status(self, capture_id):
+        """The CaptureStatus for the id submit returned, or None if it isn't
+        known, i.e. has been forgotten after `retain` seconds
+        """
+        status = self._active.get(capture_id) \
+                or self._finished.get(capture_id)
+        if status is None and self._journal is not None:
+            row = self._journal.load(capture_id)
+            if row is not None:
+                state, data, error = row
+                status = CaptureStatus(state, Transaction.from_bytes(data),
+                                       error)
+        return status
+
+    def add_callback(self, callback):
+        """Calls callback(capture_id, status), on a worker thread, whenever
+        an authorisation finishes. Returns it so it can be a decorator.
+        """
+        self._callbacks.append(callback)
+        return callback
+
+    def join(self, timeout=None):
+        """Waits for everything queued to finish, returning whether it has"""
+        expires = time.time() + timeout if timeout is not None else None
+        with self._room:
+            while self._active:
+                remaining = None if expires is None else expires - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._room.wait(remaining)
+        return True
+
+    def _enqueue(self, capture_id, key, trans):
+        with self._room:
+            self._active[capture_id] = CaptureStatus('pending', trans, None)
+            self._waiting += 1
+        self._todo.put((capture_id, key, trans))
+
+    def _work(self):
+        while True:
+            capture_id, key, trans = self._todo.get()
+            with self._room:
+                self._waiting -= 1
+                self._active[capture_id] = CaptureStatus('running', trans,
+                                                         None)
+                self._room.notify_all()
+            self._save(capture_id, key, 'running', trans)
+            try:
+                result = self.capture(trans, key)
+                if isinstance(result, PaymentsFuture):
+                    result = result.result()
+            except Exception, e:
+                status = CaptureStatus('failed', trans,
+                                       '%s: %s' % (e.__class__.__name__, e))
+            else:
+                status = CaptureStatus(
+                        'authorised' if result.authorised else 'declined',
+                        result, None)
+            self._finish(capture_id, key, status)
+
+    def _save(self, capture_id, key, state, trans, error=None):
+        done = state not in ('pending', 'running')
+        if self._journal is None or (not done and trans.holds_card()):
+            return
+        self._journal.save(capture_id, key, state,
+                trans.to_bytes(include_raw=done, include_card=False), error)
+
+    def _finish(self, capture_id, key, status):
+        self._save(capture_id, key, status.state, status.transaction,
+                   status.error)
+        self._finished.set(capture_id, status, self.retain)
+        with self._room:
+            del self._active[capture_id]
+            self._room.notify_all()
+        for callback in self._callbacks:
+            try:
+                callback(capture_id, status)
+            except Exception:
+                traceback.print_exc() # as a thread would, keep working
+
+class _CaptureJournal(object):
+    """ SQLite record of the captures a CaptureQueue has been given """
+
+    def __init__(self, path):
+        import sqlite3
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self._db.text_factory = str
+        with self._lock:
+            self._db.execute('CREATE TABLE IF NOT EXISTS payments_captures '
+                             '(id TEXT PRIMARY KEY, key TEXT, state TEXT, '
+                             'trans BLOB, error TEXT, updated REAL)')
+            self._db.commit()
+
+    def save(self, capture_id, key, state, data, error):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO payments_captures '
+                             'VALUES (?, ?, ?, ?, ?, ?)', (capture_id, key,
+                             state, buffer(data), error, time.time()))
+            self._db.commit()
+
+    def load(self, capture_id):
+        with self._lock:
+            row = self._db.execute('SELECT state, trans, error FROM '
+                                   'payments_captures WHERE id = ?',
+                                   (capture_id,)).fetchone()
+        if row is not None:
+            return row[0], str(row[1]), row[2]
+
+    def unfinished(self, retain):
+        """ what was pending or running, clearing out finished ones older
+        than retain seconds while it's at it
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM payments_captures WHERE state NOT "
+                             "IN ('pending', 'running') AND updated < ?",
+                             (time.time() - retain,))
+            self._db.commit()
+            rows = self._db.execute("SELECT id, key, state, trans FROM "
+                                    "payments_captures WHERE state IN "
+                                    "('pending', 'running') ORDER BY updated"
+                                    ).fetchall()
+        return [(capture_id, key, state, str(data))
+                for capture_id, key, state, data in rows]
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+    flaskext.payments.health
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Keeping away from a gateway which is failing, with a circuit breaker,
+    and finding out whether it can be reached, with a readiness probe which
+    keeps connections to it warm.
+
+    :copyright: (c) 2010 by jgumbley.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import with_statement
+
+import collections, threading, time
+
+from flaskext.payments import PaymentsCircuitOpen
+
+class CircuitBreaker(object):
+    """Fails calls to an endpoint fast, with PaymentsErrorFromGateway, once
+    too many of the recent ones have failed or been too slow, rather than
+    leaving every caller waiting on it. After `cooldown` seconds one probe
+    call is let through, and the circuit closes again if it succeeds.
+
+    :param error_rate: share of the calls in the window failing to open at
+    :param slow_call: seconds after which a call counts as slow, None to
+                      ignore latency
+    :param slow_rate: share of the calls in the window being slow to open at
+    :param window: how many of the most recent calls are judged
+    :param min_calls: calls there must be in the window before judging
+    :param cooldown: seconds to stay open before letting a probe through
+    """
+
+    def __init__(self, error_rate=0.5, slow_call=None, slow_rate=0.5,
+                 window=20, min_calls=10, cooldown=30):
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.opened = None
+        self._calls = collections.deque(maxlen=window) # (failed, slow)
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before(self):
+        """Raises PaymentsErrorFromGateway if a call shouldn't be made"""
+        with self._lock:
+            if self.state == 'closed':
+                return
+            if self.state == 'open' \
+                    and time.time() - self.opened >= self.cooldown:
+                self.state = 'half-open'
+            if self.state == 'half-open' and not self._probing:
+                self._probing = True
+                return
+        raise PaymentsCircuitOpen("circuit open, the gateway has been "
+                                  "failing or too slow")
+
+    def record(self, duration, failed):
+        """Notes the outcome of a call let through by before"""
+        slow = self.slow_call is not None and duration > self.slow_call
+        with self._lock:
+            if self.state == 'half-open':
+                self._probing = False
+                if failed or slow:
+                    self._open()
+                else:
+                    self.state = 'closed'
+                return
+            if self.state == 'open':
+                return # made before it opened
+            self._calls.append((failed, slow))
+            calls = len(self._calls)
+            if calls < self.min_calls:
+                return
+            failures = sum(1 for failed, slow in self._calls if failed)
+            slows = sum(1 for failed, slow in self._calls if slow)
+            if failures >= self.error_rate * calls or \
+                    (self.slow_call is not None
+                     and slows >= self.slow_rate * calls):
+                self._open()
+
+    def _open(self):
+        self.state = 'open'
+        self.opened = time.time()
+        self._calls.clear()
+
+class GatewayHealth(object):
+    """Whether the gateway can be reached and how quickly it's answering,
+    found out with its cheap `probe` call, which moves no money.
+
+    start runs it in the background: the gateway's `warm` opens `prewarm`
+    connections to it first, then every `interval` seconds, if there is
+    one, it's probed and topped back up, which keeps those connections
+    alive. check is the readiness check.
+    """
+
+    def __init__(self, gateway, prewarm=0, interval=None, timeout=5):
+        self.gateway = gateway
+        self.prewarm = prewarm
+        self.interval = interval
+        self.timeout = timeout
+        self.warmed = 0 # connections opened ahead of time
+        self._last = None
+        self._average = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name='payments-health')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def check(self, max_age=None):
+        """Returns a dict saying whether the gateway is `ready`, the
+        `latency` of the last probe and the `average` of the recent ones,
+        in seconds, when it was `checked` and the `error` if it failed.
+        Probes now if it never has or did over max_age seconds ago.
+        """
+        last = self._last
+        if last is None or (max_age is not None
+                            and last['checked'] < time.time() - max_age):
+            last = self.probe()
+        return dict(last, average=self._average, warmed=self.warmed)
+
+    def probe(self):
+        started = time.time()
+        try:
+            self.gateway.probe(self.timeout)
+        except Exception, e:
+            result = {'ready': False, 'latency': None,
+                      'error': '%s: %s' % (e.__class__.__name__, e)}
+        else:
+            result = {'ready': True, 'latency': time.time() - started,
+                      'error': None}
+        result['checked'] = time.time()
+        with self._lock:
+            if result['latency'] is not None:
+                if self._average is None:
+                    self._average = result['latency']
+                else:
+                    self._average += 0.2 * (result['latency'] - self._average)
+            self._last = result
+        return result
+
+    def _run(self):
+        while True:
+            if self.prewarm:
+                try:
+                    self.warmed += self.gateway.warm(self.prewarm)
+                except Exception:
+                    pass # the probe says what's wrong
+            if self.interval is None:
+                return
+            self.probe()
+            if self._stopped.wait(self.interval):
+                return
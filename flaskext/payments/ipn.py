@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+    flaskext.payments.ipn
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    PayPal Instant Payment Notification, so refunds, reversals and pending
+    payments completing are told to the app rather than it having to poll
+    GetTransactionDetails for them::
+
+        ipn = IPNListener(app)
+
+        @ipn.on('refunded', 'reversed')
+        def money_back(event):
+            orders.refund(event.txn_id)
+
+    Notifications are acknowledged as soon as they're queued, and verified
+    with PayPal and handed to the handlers in the background.
+
+    :copyright: (c) 2010 by jgumbley.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import with_statement
+
+import collections, Queue, threading, time, traceback, urlparse
+
+from flask import Blueprint, request
+from flaskext.payments import AsyncHTTPTransport, MemoryCache, SQLiteCache
+
+VERIFY_URL = 'https://ipnpb.paypal.com/cgi-bin/webscr'
+SANDBOX_VERIFY_URL = 'https://ipnpb.sandbox.paypal.com/cgi-bin/webscr'
+
+# the event type for each payment_status, anything else is its txn_type
+_EVENT_TYPES = {
+    'Completed': 'completed',
+    'Pending': 'pending',
+    'Refunded': 'refunded',
+    'Reversed': 'reversed',
+    'Canceled_Reversal': 'reversal_canceled',
+    'Denied': 'denied',
+    'Failed': 'failed',
+    'Voided': 'voided',
+    'Expired': 'expired',
+}
+
+class IPNEvent(collections.namedtuple('IPNEvent',
+                                      'type txn_id track_id fields')):
+    """A verified notification. type is what happened, i.e. 'completed',
+    'refunded' or 'reversed' from the payment_status, or the txn_type, i.e.
+    'recurring_payment', for those without one. fields is everything PayPal
+    sent.
+    """
+    __slots__ = ()
+
+    @property
+    def key(self):
+        """ what a notification sent again has in common with the first """
+        return self.track_id or '%s:%s' % (self.txn_id,
+                                           self.fields.get('payment_status'))
+
+    @classmethod
+    def parse(cls, body):
+        fields = dict(urlparse.parse_qsl(body, keep_blank_values=True))
+        kind = _EVENT_TYPES.get(fields.get('payment_status')) \
+                or fields.get('txn_type') or 'unknown'
+        return cls(kind, fields.get('txn_id'), fields.get('ipn_track_id'),
+                   fields)
+
+class IPNListener(object):
+    """Receives PayPal's notifications at PAYMENT_IPN_URL_PREFIX + '/ipn'
+    and calls the handlers registered with `on` for each, once, once PayPal
+    has said it really sent it.
+
+    Posts are only queued on the request thread. Up to
+    PAYMENT_IPN_QUEUE_DEPTH may wait, beyond that they're turned away with
+    a 503 for PayPal to send again later. With PAYMENT_IPN_QUEUE_PATH the
+    queue is kept in an SQLite database there, so none are lost if the
+    process stops before they've been dealt with, and those already seen
+    are remembered there too.
+
+    PAYMENT_IPN_WORKERS threads take up to PAYMENT_IPN_BATCH notifications
+    at a time and verify them all at once, over a pool of
+    PAYMENT_IPN_POOL_SIZE keep-alive connections to PAYMENT_IPN_VERIFY_URL.
+    Only those PayPal answers INVALID are dropped. Those which couldn't be
+    verified, whatever the reason, and those a handler failed on are tried
+    again after PAYMENT_IPN_RETRY_BACKOFF seconds. A notification PayPal
+    sends again within PAYMENT_IPN_DEDUPE_TTL seconds of being handled is
+    only handled the first time.
+
+    :param app: Flask instance
+
+    """
+
+    transport_class = AsyncHTTPTransport
+
+    def __init__(self, app=None):
+        self.blueprint = Blueprint('payments_ipn', __name__)
+        self.blueprint.add_url_rule('/ipn', 'ipn', self._receive,
+                                    methods=['POST'])
+        self._handlers = [] # (types or None for all, handler)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.app = app
+        verify_url = config.get('PAYMENT_IPN_VERIFY_URL')
+        if verify_url is None:
+            sandbox = 'sandbox' in config.get('PAYPAL_API_ENDPOINT', '')
+            verify_url = SANDBOX_VERIFY_URL if sandbox else VERIFY_URL
+        self.transport = self.transport_class(verify_url,
+                size=config.get('PAYMENT_IPN_POOL_SIZE', 8),
+                connect_timeout=config.get('PAYMENT_CONNECT_TIMEOUT'),
+                read_timeout=config.get('PAYMENT_READ_TIMEOUT'))
+        self.timeout = config.get('PAYMENT_IPN_VERIFY_TIMEOUT', 30)
+        self.batch = config.get('PAYMENT_IPN_BATCH', 50)
+        self.depth = config.get('PAYMENT_IPN_QUEUE_DEPTH', 10000)
+        self.retry_backoff = config.get('PAYMENT_IPN_RETRY_BACKOFF', 1.0)
+        self.dedupe_ttl = config.get('PAYMENT_IPN_DEDUPE_TTL', 7 * 86400)
+        self.invalid = 0 # how many PayPal said it didn't send
+
+        path = config.get('PAYMENT_IPN_QUEUE_PATH')
+        if path:
+            self._journal = _IPNJournal(path)
+            self._seen = SQLiteCache(path)
+        else:
+            self._journal = None
+            self._seen = MemoryCache(
+                    config.get('PAYMENT_IPN_DEDUPE_SIZE', 100000))
+        self._seen_lock = threading.Lock()
+        self._handling = set() # keys being handled right now
+        self._todo = Queue.Queue()
+        self._waiting = 0 # queued or being verified
+        self._room = threading.Condition()
+        if self._journal is not None:
+            for item in self._journal.pending():
+                self._enqueue(item)
+        for i in range(config.get('PAYMENT_IPN_WORKERS', 2)):
+            thread = threading.Thread(target=self._work,
+                                      name='payments-ipn')
+            thread.daemon = True
+            thread.start()
+        app.register_blueprint(self.blueprint,
+                url_prefix=config.get('PAYMENT_IPN_URL_PREFIX', '/payments'))
+
+    def on(self, *types):
+        """Registers a handler, called with the IPNEvent, on a worker thread
+        in an app context, for each notification of the types given, or of
+        any type if none are::
+
+            @ipn.on('completed')
+            def paid(event):
+                ...
+        """
+        def register(handler):
+            self._handlers.append((frozenset(types) or None, handler))
+            return handler
+        return register
+
+    def join(self, timeout=None):
+        """Waits for everything queued to be dealt with, returning whether
+        it has been
+        """
+        expires = time.time() + timeout if timeout is not None else None
+        with self._room:
+            while self._waiting:
+                remaining = None if expires is None else expires - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._room.wait(remaining)
+        return True
+
+    def _receive(self):
+        body = request.get_data()
+        with self._room:
+            if self._waiting >= self.depth:
+                return '', 503 # PayPal sends it again later
+            self._waiting += 1
+        if self._journal is not None:
+            self._todo.put((self._journal.add(body), body))
+        else:
+            self._todo.put((None, body))
+        return ''
+
+    def _enqueue(self, item):
+        with self._room:
+            self._waiting += 1
+        self._todo.put(item)
+
+    def _work(self):
+        while True:
+            batch = [self._todo.get()]
+            while len(batch) < self.batch:
+                try:
+                    batch.append(self._todo.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                self._verify(batch)
+            except Exception:
+                traceback.print_exc() # as a thread would, keep working
+
+    def _verify(self, batch):
+        futures = [self.transport.request_async(
+                   'cmd=_notify-validate&' + body, self.timeout)
+                   for item_id, body in batch]
+        done, failed = [], []
+        for item, future in zip(batch, futures):
+            try:
+                answer = future.result().strip()
+            except Exception:
+                failed.append(item)
+                continue
+            if answer == 'VERIFIED':
+                if not self._dispatch(IPNEvent.parse(item[1])):
+                    failed.append(item)
+                    continue
+            elif answer == 'INVALID':
+                self.invalid += 1
+            else:
+                # i.e. an error page, PayPal hasn't said either way
+                failed.append(item)
+                continue
+            done.append(item)
+        if self._journal is not None:
+            self._journal.done([item_id for item_id, body in done])
+        with self._room:
+            self._waiting -= len(done)
+            self._room.notify_all()
+        if failed:
+            time.sleep(self.retry_backoff)
+            for item in failed:
+                self._todo.put(item)
+
+    def _dispatch(self, event):
+        """ hands the event to the handlers unless it has been already,
+        returning False if it has to be tried again later, as a handler
+        failed or another worker has it in hand
+        """
+        key = 'ipn:' + event.key
+        with self._seen_lock:
+            if self._seen.get(key) is not None:
+                return True
+            if key in self._handling:
+                return False
+            self._handling.add(key)
+        handled = True
+        try:
+            with self.app.app_context():
+                for types, handler in self._handlers:
+                    if types is None or event.type in types:
+                        try:
+                            handler(event)
+                        except Exception:
+                            traceback.print_exc()
+                            handled = False
+        finally:
+            with self._seen_lock:
+                if handled:
+                    self._seen.set(key, '1', self.dedupe_ttl)
+                self._handling.discard(key)
+        return handled
+
+class _IPNJournal(object):
+    """ SQLite record of the notifications an IPNListener has queued """
+
+    def __init__(self, path):
+        import sqlite3
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self._db.text_factory = str
+        with self._lock:
+            self._db.execute('CREATE TABLE IF NOT EXISTS payments_ipn '
+                             '(id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                             'body BLOB, received REAL)')
+            self._db.commit()
+
+    def add(self, body):
+        with self._lock:
+            cursor = self._db.execute('INSERT INTO payments_ipn (body, '
+                    'received) VALUES (?, ?)', (buffer(body), time.time()))
+            self._db.commit()
+        return cursor.lastrowid
+
+    def done(self, ids):
+        """ forgets a batch of notifications in one go """
+        if not ids:
+            return
+        with self._lock:
+            self._db.executemany('DELETE FROM payments_ipn WHERE id = ?',
+                                 [(item_id,) for item_id in ids])
+            self._db.commit()
+
+    def pending(self):
+        with self._lock:
+            rows = self._db.execute('SELECT id, body FROM payments_ipn '
+                                    'ORDER BY id').fetchall()
+        return [(item_id, str(body)) for item_id, body in rows]
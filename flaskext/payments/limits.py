@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+    flaskext.payments.limits
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Holding back the calls made to a gateway: a plain token bucket for the
+    batch runs, and a limiter which adapts to how the gateway is coping,
+    shared between the threads of a process or, through a file, between
+    the processes on a machine.
+
+    :copyright: (c) 2010 by jgumbley.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import with_statement
+
+import errno, json, os, threading, time
+
+from flaskext.payments.transport import _remaining
+from flaskext.payments.metrics import LatencyHistogram
+
+class RateLimiter(object):
+    """Token bucket holding the calls made through it to `rate` a second,
+    allowing bursts of up to `burst` calls at once. Safe to share between
+    threads, each caller waits out its own place in the queue.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until the caller is allowed to make a call"""
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst,
+                    self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+class AdaptiveLimiter(object):
+    """Holds the calls leaving a gateway to `rate` a second, in bursts of up
+    to `burst`, and to a limit on how many are in flight at once. The limit
+    adapts: it creeps up by one per limit's worth of calls answered in good
+    time, and halves (by `decrease`) at most once a round trip when a call
+    is throttled, times out or takes longer than `latency_target`.
+
+    Shared between threads as is. Give it a `path` and the bucket, the limit
+    and the calls in flight are kept in that file, under an flock, so are
+    shared by every process on the machine using it. Calls in flight from
+    processes which have died are forgotten.
+
+    The time callers spend waiting for their turn goes in `waits`, a
+    LatencyHistogram.
+    """
+
+    # how often those waiting on another process look again
+    poll = 0.005
+
+    def __init__(self, rate=None, burst=1, initial=10, minimum=1,
+                 maximum=100, latency_target=None, decrease=0.5, path=None):
+        self.rate = float(rate) if rate else None
+        self.burst = burst
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.decrease = decrease
+        self.waits = LatencyHistogram()
+        initial = {'tokens': float(burst), 'updated': time.time(),
+                   'limit': float(initial), 'decreased': 0.0, 'flight': {}}
+        if path is None:
+            self._state = _LocalLimitState(initial)
+        else:
+            self._state = _FileLimitState(path, initial)
+
+    def acquire(self, expires=None):
+        """Blocks until a call may be made, returning the seconds waited, or
+        raises PaymentsErrorFromGateway if that won't be before expires.
+        """
+        started = time.time()
+        self._state.wait_for(self._take, expires)
+        waited = time.time() - started
+        self.waits.record(waited)
+        return waited
+
+    def try_acquire(self, since=None):
+        """Takes a place for a call if there is one, returning None, and
+        otherwise the seconds until there might be, without waiting. Give
+        `since` when the caller first asked to have the wait put in `waits`.
+        """
+        wait = self._state.update(self._take)
+        if wait is None and since is not None:
+            self.waits.record(time.time() - since)
+        return wait
+
+    def release(self, duration, congested=False):
+        """Notes a call let through by acquire has finished, taking
+        `duration` seconds, and whether the gateway pushed back on it
+        """
+        self._state.update(lambda state: self._adjust(state, duration,
+                                                      congested))
+
+    def cancel(self):
+        """Gives back a place taken by acquire which wasn't used"""
+        self._state.update(self._leave)
+
+    @property
+    def limit(self):
+        return self._state.update(lambda state: int(state['limit']))
+
+    def _take(self, state):
+        # None once there's a place, otherwise how long until there might be
+        now = time.time()
+        if sum(state['flight'].itervalues()) >= int(state['limit']):
+            return self.poll
+        if self.rate is not None:
+            state['tokens'] = min(self.burst, state['tokens']
+                                  + (now - state['updated']) * self.rate)
+            state['updated'] = now
+            if state['tokens'] < 1:
+                return (1 - state['tokens']) / self.rate
+            state['tokens'] -= 1
+        pid = str(os.getpid())
+        state['flight'][pid] = state['flight'].get(pid, 0) + 1
+        return None
+
+    def _leave(self, state):
+        pid = str(os.getpid())
+        flight = state['flight']
+        flight[pid] = flight.get(pid, 1) - 1
+        if flight[pid] <= 0:
+            del flight[pid]
+
+    def _adjust(self, state, duration, congested):
+        self._leave(state)
+        now = time.time()
+        if congested or (self.latency_target is not None
+                         and duration > self.latency_target):
+            # once a round trip, as everything in flight will see the same
+            if now - state['decreased'] > duration:
+                state['limit'] = max(self.minimum,
+                                     state['limit'] * self.decrease)
+                state['decreased'] = now
+        else:
+            state['limit'] = min(self.maximum,
+                                 state['limit'] + 1.0 / state['limit'])
+
+class _LocalLimitState(object):
+    """ AdaptiveLimiter state for the threads of one process """
+
+    def __init__(self, state):
+        self.state = state
+        self._changed = threading.Condition()
+
+    def update(self, change):
+        with self._changed:
+            result = change(self.state)
+            self._changed.notify_all()
+        return result
+
+    def wait_for(self, take, expires):
+        with self._changed:
+            while True:
+                wait = take(self.state)
+                if wait is None:
+                    return
+                if expires is not None:
+                    wait = min(wait, _remaining(expires))
+                self._changed.wait(wait)
+
+class _FileLimitState(object):
+    """ AdaptiveLimiter state in a file shared between processes """
+
+    def __init__(self, path, state):
+        import fcntl
+        self._fcntl = fcntl
+        self._lock = threading.Lock() # flock doesn't exclude our own threads
+        self._file = open(path, 'a+')
+        self._initial = state
+
+    def update(self, change):
+        with self._lock:
+            self._fcntl.flock(self._file, self._fcntl.LOCK_EX)
+            try:
+                self._file.seek(0)
+                data = self._file.read()
+                state = json.loads(data or json.dumps(self._initial))
+                self._forget_dead(state['flight'])
+                result = change(state)
+                self._file.seek(0)
+                self._file.truncate()
+                self._file.write(json.dumps(state))
+                self._file.flush()
+            finally:
+                self._fcntl.flock(self._file, self._fcntl.LOCK_UN)
+        return result
+
+    def wait_for(self, take, expires):
+        while True:
+            wait = self.update(take)
+            if wait is None:
+                return
+            if expires is not None:
+                wait = min(wait, _remaining(expires))
+            time.sleep(min(wait, AdaptiveLimiter.poll))
+
+    def _forget_dead(self, flight):
+        for pid in flight.keys():
+            try:
+                os.kill(int(pid), 0)
+            except OSError, e:
+                if e.errno == errno.ESRCH:
+                    del flight[pid]
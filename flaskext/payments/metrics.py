@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+    flaskext.payments.metrics
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Signals sent after every gateway call and Payments operation, and the
+    latency histograms the gateway keeps per API method when PAYMENT_METRICS
+    is on.
+
+    :copyright: (c) 2010 by jgumbley.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import with_statement
+
+import bisect, threading
+
+from flask.signals import Namespace, signals_available
+
+_signals = Namespace()
+
+#: Sent by the gateway after every call to its API, with the API method name,
+#: duration in seconds, bytes sent and received, the ACK the gateway answered
+#: with and the class of the exception if the call failed outright.
+gateway_call = _signals.signal('payments-gateway-call')
+
+#: Sent by Payments after every setupRedirect and authorise, with the
+#: operation name, duration in seconds and the class of any exception.
+payment_operation = _signals.signal('payments-operation')
+
+def _has_receivers(signal):
+    return signals_available and bool(signal.receivers)
+
+class LatencyHistogram(object):
+    """Counts durations into fixed buckets, so percentiles can be read off
+    cheaply at any point without holding on to every sample.
+    """
+
+    # upper bounds in seconds, the last bucket catches everything slower
+    bounds = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+              10.0, 30.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+
+    def record(self, duration, error=False):
+        self.counts[bisect.bisect_left(self.bounds, duration)] += 1
+        self.count += 1
+        self.total += duration
+        if error:
+            self.errors += 1
+
+    def percentile(self, fraction):
+        """Returns the upper bound of the bucket the percentile falls in, or
+        None if it's in the last, unbounded, one.
+        """
+        if not self.count:
+            return 0.0
+        wanted = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return None
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'total': self.total,
+            'buckets': zip(self.bounds + (None,), self.counts),
+            'p50': self.percentile(0.50),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99),
+        }
+
+class LatencyMetrics(object):
+    """A LatencyHistogram per gateway API method and Payments operation,
+    safe to record into from many threads. `snapshot` returns plain dicts,
+    i.e. to be jsonified from a metrics view.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, duration, error=False):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = LatencyHistogram()
+            histogram.record(duration, error)
+
+    def snapshot(self):
+        with self._lock:
+            return dict((name, histogram.snapshot())
+                        for name, histogram in self.histograms.iteritems())
@@ -0,0 +1,691 @@
+# -*- coding: utf-8 -*-
+"""
+    flaskext.payments.paypal
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    PayPal Website Payments Pro gateway, over the NVP API. Only imported
+    when PAYMENT_API is 'PayPal'.
+
+    :copyright: (c) 2010 by jgumbley.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import with_statement
+
+import datetime, numbers, random, socket, time, urllib
+
+from flaskext.payments import PaymentsConfigurationError, \
+     PaymentsValidationError, PaymentsErrorFromGateway, HTTPTransport, \
+     AsyncHTTPTransport, PaymentsFuture, NVPResponse, NVPTemplate, nvp_fields, \
+     MemoryCache, TransactionDetailsCache, LatencyMetrics, CircuitBreaker, \
+     AdaptiveLimiter, GreenHTTPTransport, audit_log, \
+     gateway_call, _has_receivers, _current_deadline, _remaining, _retryable, \
+     _wait, _Scheduler
+
+_TIMESTAMP = '%Y-%m-%dT%H:%M:%SZ'
+
+# the fields of the warnings which come in the lists alongside the results
+_ERROR_FIELDS = frozenset(['ERRORCODE', 'SHORTMESSAGE', 'LONGMESSAGE',
+                           'SEVERITYCODE'])
+
+def _express_token(response):
+    return nvp_fields(response, 'TOKEN').get('TOKEN', "")
+
+class PayPalGateway:
+    """ Specific Impementation for PayPal WPP"""
+
+    # the transport is pluggable, anything with a request(body[, timeout])
+    # method returning the response body will do
+    transport_class = HTTPTransport
+
+    # the calls which can be repeated when they fail without any risk of
+    # moving money twice
+    safe_methods = frozenset(['SetExpressCheckout', 'GetTransactionDetails',
+                              'TransactionSearch'])
+
+    # the errors PayPal sheds load with, so the limiter should back off on
+    throttle_codes = frozenset(['10001'])
+
+    # what the audit log leaves out of the requests and responses it keeps,
+    # what it only keeps the last four digits of and what it indexes by
+    audit_redact = frozenset(['USER', 'PWD', 'SIGNATURE', 'CVV2', 'EXPDATE'])
+    audit_mask = frozenset(['ACCT'])
+    audit_index = ('TOKEN', 'TRANSACTIONID', 'AUTHORIZATIONID')
+
+    # what check_config makes sure of before the gateway is made
+    config_schema = {
+        'PAYPAL_API_ENDPOINT': (basestring, True),
+        'PAYPAL_API_URL': (basestring, True),
+        'PAYPAL_API_USER': (basestring, True),
+        'PAYPAL_API_PWD': (basestring, True),
+        'PAYPAL_API_SIGNATURE': (basestring, True),
+        'PAYMENT_POOL_SIZE': (int, False),
+        'PAYMENT_ASYNC_POOL_SIZE': (int, False),
+        'PAYMENT_POOL_IDLE_TIMEOUT': (numbers.Real, False),
+        'PAYMENT_CONNECT_TIMEOUT': (numbers.Real, False),
+        'PAYMENT_READ_TIMEOUT': (numbers.Real, False),
+        'PAYMENT_RETRIES': (int, False),
+        'PAYMENT_RETRY_BACKOFF': (numbers.Real, False),
+        'PAYMENT_BREAKER': ((bool, dict), False),
+        'PAYMENT_LIMITER': ((bool, dict), False),
+        'PAYMENT_DETAILS_CACHE_SIZE': (int, False),
+        'PAYMENT_DETAILS_CACHE_TTL': (numbers.Real, False),
+        'PAYMENT_DETAILS_CACHE_TTLS': (dict, False),
+        'PAYMENT_AUDIT_PATH': (basestring, False),
+        'PAYMENT_AUDIT_SEGMENT_SIZE': (int, False),
+        'PAYMENT_AUDIT_FSYNC': (bool, False),
+        'PAYMENT_IO_MODE': (basestring, False),
+        'PAYMENT_PREWARM': (int, False),
+        'PAYMENT_PROBE_INTERVAL': (numbers.Real, False),
+        'PAYMENT_PROBE_TIMEOUT': (numbers.Real, False),
+    }
+
+    # what each type of transaction has to have before it's sent, compiled
+    # once into ValidationRules by validation_rules()
+    validation_rules = {
+        'Express': [
+            ('amount', 'amount'),
+            ('return_url', 'required'),
+            ('cancel_url', 'required'),
+        ],
+        'Direct': [
+            ('amount', 'amount'),
+            ('acct', 'card_number'),
+            ('expdate', 'expiry'),
+            ('cvv2', 'cvv'),
+            ('ipaddress', 'required'),
+            ('firstname', 'required'),
+            ('lastname', 'required'),
+            ('cctype', 'required'),
+            ('street', 'required'),
+            ('city', 'required'),
+            ('state', 'required'),
+            ('zipcode', 'required'),
+        ],
+    }
+
+    def __init__(self, app):
+        # Need to catch value error and throw as config error
+        try:
+            self._init_API(app)
+        except KeyError:
+            raise PaymentsConfigurationError
+        self._init_transport(app)
+        self._init_cache(app)
+        self.metrics = LatencyMetrics() if app.config.get('PAYMENT_METRICS') \
+                else None
+        self._init_resilience(app)
+        self._init_audit(app)
+
+    def _init_audit(self, app):
+        """ sets up the audit log of every call to PayPal if PAYMENT_AUDIT_PATH
+        names a directory for it, started afresh every
+        PAYMENT_AUDIT_SEGMENT_SIZE bytes and synced to disk unless
+        PAYMENT_AUDIT_FSYNC is False. Credentials and card details are
+        left out.
+        """
+        path = app.config.get('PAYMENT_AUDIT_PATH')
+        if not path:
+            self.audit = None
+            return
+        self.audit = audit_log(path, redact=self.audit_redact,
+                mask=self.audit_mask, index=self.audit_index,
+                segment_size=app.config.get('PAYMENT_AUDIT_SEGMENT_SIZE',
+                                            64 << 20),
+                fsync=app.config.get('PAYMENT_AUDIT_FSYNC', True))
+
+    def _init_resilience(self, app):
+        """ sets how many times, PAYMENT_RETRIES, the safe methods are
+        retried after failing to get an answer, backing off from around
+        PAYMENT_RETRY_BACKOFF seconds. PAYMENT_BREAKER turns on a circuit
+        breaker for the endpoint, set it to a dict to pass CircuitBreaker
+        its thresholds. PAYMENT_LIMITER likewise turns on an AdaptiveLimiter,
+        i.e. {'rate': 20, 'path': '/tmp/paypal.limit'} to share 20 calls a
+        second between every process on the machine.
+        """
+        self.retries = app.config.get('PAYMENT_RETRIES', 2)
+        # the green transports' sleep yields rather than blocking the worker
+        self.sleep = getattr(self.transport, 'sleep', time.sleep)
+        self.retry_backoff = app.config.get('PAYMENT_RETRY_BACKOFF', 0.1)
+        breaker = app.config.get('PAYMENT_BREAKER')
+        if breaker:
+            if breaker is True:
+                breaker = {}
+            self.breaker = CircuitBreaker(**breaker)
+        else:
+            self.breaker = None
+        limiter = app.config.get('PAYMENT_LIMITER')
+        if limiter:
+            if limiter is True:
+                limiter = {}
+            self.limiter = AdaptiveLimiter(**limiter)
+        else:
+            self.limiter = None
+
+    def _init_transport(self, app):
+        """ sets up the pool of connections to the NVP endpoint, sized and
+        timed out according to the PAYMENT_POOL_* and PAYMENT_*_TIMEOUT
+        settings. PAYMENT_IO_MODE is 'threads' by default, or 'gevent' or
+        'eventlet' for a GreenHTTPTransport in workers of that kind.
+        """
+        options = dict(size=app.config.get('PAYMENT_POOL_SIZE', 4),
+                idle_timeout=app.config.get('PAYMENT_POOL_IDLE_TIMEOUT', 60),
+                connect_timeout=app.config.get('PAYMENT_CONNECT_TIMEOUT'),
+                read_timeout=app.config.get('PAYMENT_READ_TIMEOUT'))
+        mode = app.config.get('PAYMENT_IO_MODE', 'threads')
+        if mode == 'threads':
+            self.transport = self.transport_class(self.API_ENDPOINT,
+                                                  **options)
+        else:
+            self.transport = GreenHTTPTransport(self.API_ENDPOINT, mode=mode,
+                                                **options)
+
+    def _init_cache(self, app):
+        """ sets up the cache of GetTransactionDetails responses if one is
+        configured. PAYMENT_DETAILS_CACHE is either 'memory', for an LRU cache
+        of PAYMENT_DETAILS_CACHE_SIZE responses in this process, or a werkzeug
+        style cache object to share them. The PAYMENT_DETAILS_CACHE_TTLS dict
+        overrides how long they are kept by PAYMENTSTATUS.
+        """
+        backend = app.config.get('PAYMENT_DETAILS_CACHE')
+        if backend is None:
+            self.details_cache = None
+            return
+        if backend == 'memory':
+            backend = MemoryCache(
+                    app.config.get('PAYMENT_DETAILS_CACHE_SIZE', 1000))
+        self.details_cache = TransactionDetailsCache(backend,
+                app.config.get('PAYMENT_DETAILS_CACHE_TTLS'),
+                app.config.get('PAYMENT_DETAILS_CACHE_TTL', 60))
+
+    def _init_API(self ,app):
+        """ initialises any stuff needed for the payment gateway API and should
+        fail if anything is invalid or missing
+        """
+        self.signature_values = {
+        'USER' : app.config['PAYPAL_API_USER'], 
+        'PWD' : app.config['PAYPAL_API_PWD'],
+        'SIGNATURE' : app.config['PAYPAL_API_SIGNATURE'],
+        'VERSION' : '54.0',
+        }
+        self.API_ENDPOINT = app.config['PAYPAL_API_ENDPOINT']
+        self.PAYPAL_URL =  app.config['PAYPAL_API_URL']
+        self.signature = urllib.urlencode(self.signature_values) + "&"
+        self._init_templates()
+
+    def _init_templates(self):
+        """ the requests for each API method, signed and with everything but
+        the values which change from call to call encoded up front
+        """
+        self.templates = dict((template.method, template) for template in [
+            NVPTemplate(self.signature, {
+                'METHOD' : "SetExpressCheckout",
+                'NOSHIPPING' : 1,
+                'PAYMENTACTION' : 'Authorization',
+                'RETURNURL' : None,
+                'CANCELURL' : None, 
+                'AMT' : None,
+            }, 'AMT', 'RETURNURL', 'CANCELURL'),
+            NVPTemplate(self.signature, {
+                'METHOD' : "DoExpressCheckoutPayment",
+                'PAYMENTACTION' : 'Sale',
+                'RETURNURL' : 'http://www.yoursite.com/returnurl', #edit this 
+                'CANCELURL' : 'http://www.yoursite.com/cancelurl', #edit this 
+                'TOKEN' : None,
+                'AMT' : None,
+                'PAYERID' : None,
+            }, 'TOKEN', 'PAYERID', 'AMT'),
+            NVPTemplate(self.signature, {
+                'METHOD' : "GetTransactionDetails", 
+                'TRANSACTIONID' : None,
+            }, 'TRANSACTIONID'),
+            NVPTemplate(self.signature, {
+                'METHOD' : "DoCapture",
+                'AUTHORIZATIONID' : None,
+                'AMT' : None,
+                'COMPLETETYPE' : 'Complete',
+            }, 'AUTHORIZATIONID', 'AMT'),
+            NVPTemplate(self.signature, {
+                'METHOD' : "DoVoid",
+                'AUTHORIZATIONID' : None,
+            }, 'AUTHORIZATIONID'),
+            NVPTemplate(self.signature, {
+                'METHOD' : "TransactionSearch",
+                'STARTDATE' : None,
+                'ENDDATE' : None,
+            }, 'STARTDATE', 'ENDDATE'),
+            NVPTemplate(self.signature, {
+                'METHOD' : "DoDirectPayment",
+                'PAYMENTACTION' : 'Sale',
+                'AMT' : None,
+                'IPADDRESS' : None,
+                'ACCT': None,
+                'EXPDATE' : None,
+                'CVV2' : None,
+                'FIRSTNAME' : None,
+                'LASTNAME': None,
+                'CREDITCARDTYPE': None,
+                'STREET': None,
+                'CITY': None,
+                'STATE': None,
+                'ZIP': None,
+                'COUNTRY' : 'United States',
+                'COUNTRYCODE': 'US',
+                'RETURNURL' : 'http://www.yoursite.com/returnurl', #why needed? 
+                'CANCELURL' : 'http://www.yoursite.com/cancelurl', # ditto
+                'L_DESC0' : "Desc: ",
+                'L_NAME0' : "Name: ",
+            }, 'AMT', 'IPADDRESS', 'ACCT', 'EXPDATE', 'CVV2', 'FIRSTNAME',
+               'LASTNAME', 'CREDITCARDTYPE', 'STREET', 'CITY', 'STATE', 'ZIP'),
+        ])
+
+    def setupRedirect(self, trans):
+        """ this is for WPP only"""
+        if trans.type == 'Express':
+            return self._setupExpressTransfer(trans)
+        else:
+            raise PaymentsValidationError(errors={
+                'type': 'should be Express to be set up with a redirect'})
+
+    # why is this two methods surely this could be easier?
+
+    def _setupExpressTransfer(self, trans):
+        """ add details to transaction to allow it to be forwarded to the 
+        third party gateway 
+        """
+        r = self.SetExpressCheckout(
+                trans.amount,
+                trans.return_url,
+                trans.cancel_url
+                )
+        return self._expressRedirect(trans, r)
+
+    def _expressRedirect(self, trans, token):
+        trans.paypal_express_token = token
+        
+        trans.redirect_url = self.PAYPAL_URL + trans.paypal_express_token             
+        return trans
+
+    # Public methods of gateway 'interface'
+    def close(self):
+        """ closes the connections to PayPal, i.e. once a merchant account's
+        gateway is let go
+        """
+        self.transport.close()
+
+    def warm(self, count):
+        """ opens connections to PayPal ahead of them being needed, where
+        the transport can, returning how many
+        """
+        warm = getattr(self.transport, 'warm', None)
+        if warm is None:
+            return 0
+        return warm(count)
+
+    def probe(self, timeout=None):
+        """ makes the cheapest call there is, GetPalDetails, which moves no
+        money, straight over the transport, raising if there's no NVP
+        answer. Whether PayPal says yes or no doesn't matter, only that it
+        answers.
+        """
+        body = self.signature + 'METHOD=GetPalDetails'
+        if timeout is None:
+            raw = self.transport.request(body)
+        else:
+            raw = self.transport.request(body, timeout)
+        response = NVPResponse(raw)
+        if 'ACK' not in response:
+            raise PaymentsErrorFromGateway("no NVP answer from PayPal")
+        return response
+
+    def checkout_token(self, trans):
+        """ express checkouts are resumed by their token """
+        return trans.extensions.get('paypal_express_token')
+
+    def idempotency_key(self, trans):
+        """ the express token identifies an express payment, so the same one
+        is never paid for twice. Direct payments need the caller's own key.
+        """
+        if trans.type == 'Express':
+            return trans.extensions.get('paypal_express_token')
+        return None
+
+    def authorise(self, trans):
+        """Examines the type of transaction passed in and delegates to either
+        the express payments flow or the direct payments flow, where further
+        validation can take place.
+
+        If its not a type of transaction which this gateway can process then it
+        will throw its dummy out of the pram.
+        """
+        if trans.type == 'Express':
+            return self._authoriseExpress(trans)
+        elif trans.type == 'Direct':
+            return self._authoriseDirect(trans)
+        else: raise PaymentsValidationError(errors={
+                'type': 'should be Express or Direct, not %r' % trans.type})
+
+    def _authoriseExpress(self, trans):
+        """ calls authorise on payment setup via redirect to paypal
+        """
+        r = self.DoExpressCheckoutPayment(trans.paypal_express_token,
+                trans.pay_id, trans.amount)  
+        return self._authorised(trans, r)
+
+    def _authoriseDirect(self, trans):
+        """ charges the card details carried on the transaction, named as
+        DoDirectPayment's arguments are
+        """
+        r = self.DoDirectPayment(trans.amount, trans.ipaddress, trans.acct,
+                trans.expdate, trans.cvv2, trans.firstname, trans.lastname,
+                trans.cctype, trans.street, trans.city, trans.state,
+                trans.zipcode)
+        return self._authorised(trans, r)
+
+    def capture(self, authorization_id, amount):
+        """ settles an authorisation, i.e. one made by an express checkout """
+        return self.DoCapture(authorization_id, amount)
+
+    def void(self, authorization_id):
+        """ cancels an authorisation which won't be captured """
+        return self.DoVoid(authorization_id)
+
+    def authorisation_open(self, authorization_id):
+        """ whether an authorisation is still waiting to be captured or
+        voided, asking PayPal rather than the details cache as only the
+        truth will do here. Raises PaymentsErrorFromGateway if PayPal can't
+        say, as guessing either way could capture twice or not at all.
+        """
+        response = _wait(self._call('GetTransactionDetails',
+                self.templates['GetTransactionDetails'].encode(
+                        authorization_id), NVPResponse))
+        if response.get('ACK') not in ('Success', 'SuccessWithWarning'):
+            raise PaymentsErrorFromGateway(response.get('L_LONGMESSAGE0',
+                    'GetTransactionDetails failed'))
+        return response.get('PAYMENTSTATUS') == 'Pending' and \
+                response.get('PENDINGREASON') == 'authorization'
+
+    def search_transactions(self, start, end, filters):
+        """ the transactions from the start datetime up to the end one, UTC,
+        oldest first, and whether PayPal left some out as there were too
+        many to answer with
+        """
+        response = _wait(self.TransactionSearch(start,
+                end - datetime.timedelta(seconds=1), **filters))
+        if response.get('ACK') not in ('Success', 'SuccessWithWarning'):
+            raise PaymentsErrorFromGateway(response.get('L_LONGMESSAGE0',
+                    'TransactionSearch failed'))
+        records, truncated = [], False
+        for fields in response.lists():
+            if fields.get('ERRORCODE') == '11002': # results were truncated
+                truncated = True
+            if 'TRANSACTIONID' in fields:
+                records.append(dict((name, value) for name, value
+                        in fields.iteritems() if name not in _ERROR_FIELDS))
+        records.reverse() # PayPal answers newest first
+        return records, truncated
+
+    def _authorised(self, trans, response):
+        if self.details_cache is not None and 'TRANSACTIONID' in response:
+            self.details_cache.invalidate(response['TRANSACTIONID'])
+        trans._raw = response
+        trans.authorised = response.get('ACK') in ('Success',
+                                                   'SuccessWithWarning')
+        return trans
+
+    def _call(self, method, params_string, parse):
+        """ posts the encoded request for method to the NVP endpoint and
+        returns the response run through parse
+        """
+        expires = _current_deadline()
+        retries = self.retries if method in self.safe_methods else 0
+        attempt = 0
+        while True:
+            timeout = self._admit(expires)
+            started = time.time()
+            try:
+                raw = self._send(params_string, timeout)
+            except Exception, e:
+                self._record(method, started, params_string, None, e)
+                if attempt >= retries or not _retryable(e):
+                    raise
+                attempt += 1
+                self.sleep(self._backoff(attempt, expires))
+                continue
+            self._record(method, started, params_string, raw, None)
+            return parse(raw)
+
+    def _admit(self, expires):
+        """ waits for the limiter and checks the breaker, returning how long
+        the call has left
+        """
+        if self.limiter is None:
+            return self._admitted(expires, None)
+        return self._admitted(expires, self.limiter.acquire(expires))
+
+    def _admitted(self, expires, waited):
+        """ checks the breaker once the limiter, if there is one, has let a
+        call through after waited seconds, returning how long it has left
+        """
+        if self.limiter is None:
+            if self.breaker is not None:
+                self.breaker.before()
+            return _remaining(expires)
+        if self.metrics is not None:
+            self.metrics.record('limiter-wait', waited, False)
+        try:
+            if self.breaker is not None:
+                self.breaker.before()
+            return _remaining(expires)
+        except Exception:
+            self.limiter.cancel()
+            raise
+
+    def _send(self, params_string, timeout):
+        if timeout is None:
+            return self.transport.request(params_string)
+        return self.transport.request(params_string, timeout)
+
+    def _backoff(self, attempt, expires):
+        """ seconds to wait before a retry, growing with each attempt and
+        jittered so failed callers don't all come back at once, but never
+        past the deadline
+        """
+        delay = random.uniform(0, self.retry_backoff * 2 ** (attempt - 1))
+        if expires is not None:
+            delay = max(0, min(delay, expires - time.time()))
+        return delay
+
+    def _record(self, method, started, sent, raw, error):
+        duration = time.time() - started
+        if self.breaker is not None:
+            self.breaker.record(duration, error is not None)
+        if self.limiter is not None:
+            self.limiter.release(duration, self._congested(raw, error))
+        if self.metrics is not None:
+            self.metrics.record(method, duration, error is not None)
+        if self.audit is not None:
+            self.audit.record(method, sent, raw, error, duration)
+        if _has_receivers(gateway_call):
+            gateway_call.send(self, method=method, duration=duration,
+                    sent=len(sent), received=len(raw or ''),
+                    ack=nvp_fields(raw, 'ACK').get('ACK') if raw else None,
+                    error=error.__class__ if error is not None else None)
+
+    def _congested(self, raw, error):
+        """ whether PayPal timed out or pushed back on a call, not
+        answering with NVP at all, i.e. with a 503 page, counting
+        """
+        if error is not None:
+            return isinstance(error, socket.timeout)
+        fields = nvp_fields(raw, 'ACK', 'L_ERRORCODE0')
+        return 'ACK' not in fields or \
+                fields.get('L_ERRORCODE0') in self.throttle_codes
+
+    def _answer(self, response):
+        """ returns a response which didn't need a call to the gateway """
+        return response
+
+    # API METHODS
+
+    # PayPal python NVP API wrapper class.
+    # This is a sample to help others get started on working
+    # with the PayPal NVP API in Python. 
+    # This is not a complete reference! Be sure to understand
+    # what this class is doing before you try it on production servers!
+    # ...use at your own peril.
+
+    ## see https://www.paypal.com/IntegrationCenter/ic_nvp.html
+    ## and
+    ## https://www.paypal.com/en_US/ebook/PP_NVPAPI_DeveloperGuide/index.html
+    ## for more information.
+
+    # by Mike Atlas / LowSingle.com / MassWrestling.com, September 2007
+    # No License Expressed. Feel free to distribute, modify, 
+#  and use in any open or closed source project without credit to the author
+
+    def SetExpressCheckout(self, amount, return_url, cancel_url):
+        body = self.templates['SetExpressCheckout'].encode(amount,
+                return_url, cancel_url)
+        return self._call('SetExpressCheckout', body, _express_token)
+    
+    def DoExpressCheckoutPayment(self, token, payer_id, amt):
+        body = self.templates['DoExpressCheckoutPayment'].encode(token,
+                payer_id, amt)
+        return self._call('DoExpressCheckoutPayment', body, NVPResponse)
+    
+
+    # Get info on transaction
+    def GetTransactionDetails(self, tx_id):
+        body = self.templates['GetTransactionDetails'].encode(tx_id)
+        cache = self.details_cache
+        if cache is None:
+            return self._call('GetTransactionDetails', body, NVPResponse)
+        raw = cache.get(tx_id)
+        if raw is not None:
+            return self._answer(NVPResponse(raw))
+        return self._call('GetTransactionDetails', body,
+                lambda raw: NVPResponse(cache.store(tx_id, raw)))
+   
+    # Settle or cancel an authorisation
+    def DoCapture(self, authorization_id, amt):
+        body = self.templates['DoCapture'].encode(authorization_id, amt)
+        return self._call('DoCapture', body, NVPResponse)
+
+    def DoVoid(self, authorization_id):
+        body = self.templates['DoVoid'].encode(authorization_id)
+        return self._call('DoVoid', body, NVPResponse)
+
+    # Search for transactions, filters are any of TransactionSearch's optional
+    # fields, i.e. EMAIL, TRANSACTIONCLASS or STATUS
+    def TransactionSearch(self, startdate, enddate=None, **filters):
+        body = self.templates['TransactionSearch'].encode(
+                startdate.strftime(_TIMESTAMP),
+                enddate.strftime(_TIMESTAMP) if enddate else '')
+        if filters:
+            body += '&' + urllib.urlencode(sorted(filters.items()))
+        return self._call('TransactionSearch', body, NVPResponse)
+
+    # Direct payment
+    def DoDirectPayment(self, amt, ipaddress, acct, expdate, cvv2, firstname, lastname, cctype, street, city, state, zipcode):
+        body = self.templates['DoDirectPayment'].encode(amt, ipaddress, acct,
+                expdate, cvv2, firstname, lastname, cctype, street, city,
+                state, zipcode)
+        return self._call('DoDirectPayment', body, NVPResponse)
+
+
+class AsyncPayPalGateway(PayPalGateway):
+    """ PayPalGateway which doesn't block on PayPal. setupRedirect, authorise
+    and the API methods all return a PaymentsFuture straight away, and the
+    calls are made over an AsyncHTTPTransport of up to PAYMENT_ASYNC_POOL_SIZE
+    connections.
+
+    Waiting for the limiter, backing off before a retry and recording each
+    call, which with a limiter or audit log kept in a file means file I/O,
+    all happen on a thread of the gateway's own, never the caller's or the
+    transport's event loop.
+    """
+
+    transport_class = AsyncHTTPTransport
+
+    def _init_transport(self, app):
+        if app.config.get('PAYMENT_IO_MODE', 'threads') != 'threads':
+            raise PaymentsConfigurationError("AsyncPayments has its own "
+                    "event loop, use Payments with PAYMENT_IO_MODE")
+        self.transport = self.transport_class(self.API_ENDPOINT,
+                size=app.config.get('PAYMENT_ASYNC_POOL_SIZE', 100),
+                idle_timeout=app.config.get('PAYMENT_POOL_IDLE_TIMEOUT', 60),
+                connect_timeout=app.config.get('PAYMENT_CONNECT_TIMEOUT'),
+                read_timeout=app.config.get('PAYMENT_READ_TIMEOUT'))
+        self._scheduler = _Scheduler('payments-async')
+
+    def _setupExpressTransfer(self, trans):
+        return self.SetExpressCheckout(trans.amount, trans.return_url,
+                trans.cancel_url).then(
+                        lambda token: self._expressRedirect(trans, token))
+
+    def _authoriseExpress(self, trans):
+        return self.DoExpressCheckoutPayment(trans.paypal_express_token,
+                trans.pay_id, trans.amount).then(
+                        lambda response: self._authorised(trans, response))
+
+    def _authoriseDirect(self, trans):
+        return self.DoDirectPayment(trans.amount, trans.ipaddress, trans.acct,
+                trans.expdate, trans.cvv2, trans.firstname, trans.lastname,
+                trans.cctype, trans.street, trans.city, trans.state,
+                trans.zipcode).then(
+                        lambda response: self._authorised(trans, response))
+
+    def _call(self, method, params_string, parse):
+        expires = _current_deadline()
+        retries = self.retries if method in self.safe_methods else 0
+        result = PaymentsFuture()
+
+        # everything but the request itself runs on the scheduler
+        def attempt(number, asked):
+            try:
+                waited = None
+                if self.limiter is not None:
+                    wait = self.limiter.try_acquire(asked)
+                    if wait is not None:
+                        if expires is not None:
+                            wait = min(wait, _remaining(expires))
+                        return self._scheduler.call_later(wait, attempt,
+                                                          number, asked)
+                    waited = time.time() - asked
+                timeout = self._admitted(expires, waited)
+            except Exception:
+                return result.set_exception()
+            started = time.time()
+            self._send(params_string, timeout).add_done_callback(
+                    lambda future: self._scheduler.call_later(0, finish,
+                            number, started, future))
+
+        def finish(number, started, future):
+            error = future._exc_info
+            try:
+                self._record(method, started, params_string, future._result,
+                             error and error[1])
+            except Exception:
+                return result.set_exception()
+            if error is None:
+                result.set_result(future._result)
+            elif number < retries and _retryable(error[1]):
+                delay = self._backoff(number + 1, expires)
+                self._scheduler.call_later(delay, attempt, number + 1,
+                                           time.time() + delay)
+            else:
+                result.set_exception(error)
+
+        self._scheduler.call_later(0, attempt, 0, time.time())
+        return result.then(parse)
+
+    def _send(self, params_string, timeout):
+        return self.transport.request_async(params_string, timeout)
+
+    def _answer(self, response):
+        future = PaymentsFuture()
+        future.set_result(response)
+        return future
+
+PayPalGateway.async_gateway = AsyncPayPalGateway
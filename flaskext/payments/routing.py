@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+    flaskext.payments.routing
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    The gateways for many merchant accounts, kept only while they're in use,
+    and spreading payments over several gateways by how well each is doing.
+
+    :copyright: (c) 2010 by jgumbley.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import with_statement
+
+import collections, random, threading, time
+
+from flaskext.payments import PaymentsValidationError
+from flaskext.payments.transport import PaymentsFuture, _unsent
+
+class _AccountApp(object):
+    """ what a merchant account's gateway is made from in place of the app,
+    the app's config with the account's own settings over it
+    """
+
+    def __init__(self, app, settings):
+        self.app = app
+        self.config = dict(app.config)
+        self.config.update(settings)
+
+class MerchantAccounts(object):
+    """The gateways for many merchant accounts, each made by make(name) the
+    first time it's wanted, so with its own signature, connection pool and
+    so on. Only up to `size` are kept, the least recently used going first,
+    and any unused for `idle_timeout` seconds are let go too, so a lot of
+    accounts don't mean a lot of open connections.
+
+    acquire a gateway to use and release it after. One which is let go
+    while it's in use is only closed once it's been released.
+    """
+
+    def __init__(self, make, names, size=100, idle_timeout=600):
+        self.make = make
+        self.names = frozenset(names)
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self._active = collections.OrderedDict() # least recently used first
+        self._leases = {} # id(gateway) to [account, users, let go]
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __len__(self):
+        """ how many gateways are being kept """
+        return len(self._active)
+
+    def acquire(self, name):
+        if name not in self.names:
+            raise KeyError(name)
+        with self._lock:
+            closing = self._let_go(time.time() - self.idle_timeout)
+            gateway = self._active.pop(name, (None, 0))[0]
+            if gateway is None:
+                gateway = self.make(name)
+                self._leases[id(gateway)] = [name, 0, False]
+            self._active[name] = (gateway, time.time())
+            self._leases[id(gateway)][1] += 1
+            closing.extend(self._let_go(None))
+        for old in closing:
+            _close_gateway(old)
+        return gateway
+
+    def release(self, gateway):
+        with self._lock:
+            lease = self._leases[id(gateway)]
+            lease[1] -= 1
+            if lease[1] or not lease[2]:
+                return
+            del self._leases[id(gateway)]
+        _close_gateway(gateway)
+
+    def close(self):
+        """ lets every gateway go """
+        with self._lock:
+            closing = self._let_go(None, 0)
+        for gateway in closing:
+            _close_gateway(gateway)
+
+    def _let_go(self, cutoff, size=None):
+        """ drops gateways last used before cutoff, or beyond size, returning
+        those nobody is using to be closed
+        """
+        if size is None:
+            size = self.size
+        closing = []
+        while self._active:
+            name = next(iter(self._active))
+            gateway, used = self._active[name]
+            if len(self._active) <= size and (cutoff is None or
+                                              used >= cutoff):
+                break
+            del self._active[name]
+            lease = self._leases[id(gateway)]
+            if lease[1]:
+                lease[2] = True # closed when released
+            else:
+                del self._leases[id(gateway)]
+                closing.append(gateway)
+        return closing
+
+def _close_gateway(gateway):
+    close = getattr(gateway, 'close', None)
+    if close is not None:
+        close()
+
+class RouteStats(object):
+    """Rolling latency and error rate of the calls over a route, averaged
+    over roughly the last `window` of them, along with running totals.
+    """
+
+    def __init__(self, window=50):
+        self.alpha = 2.0 / (window + 1)
+        self.latency = None # seconds, None until there's been a call
+        self.error_rate = 0.0
+        self.calls = 0
+        self.failures = 0
+        self.failovers = 0 # calls which failed here and went elsewhere
+        self._lock = threading.Lock()
+
+    def record(self, duration, failed):
+        with self._lock:
+            self.calls += 1
+            self.failures += failed
+            if self.latency is None:
+                self.latency = duration
+            else:
+                self.latency += self.alpha * (duration - self.latency)
+            self.error_rate += self.alpha * (failed - self.error_rate)
+
+    def snapshot(self):
+        with self._lock:
+            return {'latency': self.latency, 'error_rate': self.error_rate,
+                    'calls': self.calls, 'failures': self.failures,
+                    'failovers': self.failovers}
+
+class _Route(object):
+    def __init__(self, name, gateway, weight, window):
+        self.name = name
+        self.gateway = gateway
+        self.weight = weight
+        self.stats = RouteStats(window)
+
+class GatewayRouter(object):
+    """Spreads payments over several gateways, the `routes` given as
+    (name, gateway, weight) triples, favouring whichever are doing best.
+
+    Each call goes to a route picked at random in proportion to its weight,
+    scaled down the slower it's been and the more it's failed lately.
+    Latency is counted from `latency_floor` seconds up, so differences
+    too small to matter don't outweigh the weights.
+    Routes failing more than `max_error_rate` of their calls, or with their
+    circuit breaker open, are only used once the others have failed too.
+    A call fails over to the next best route only when it certainly never
+    reached the gateway, i.e. the connection was refused or the breaker is
+    open, so nothing is ever paid for twice.
+
+    Express payments are pinned to the route which set them up, by their
+    `route`, as only it knows their token. Those set up before there were
+    routes go to the `default` gateway.
+    """
+
+    def __init__(self, routes, default, window=50, max_error_rate=0.5,
+                 latency_floor=0.05):
+        self.routes = [_Route(name, gateway, weight, window)
+                       for name, gateway, weight in routes]
+        self.by_name = dict((route.name, route) for route in self.routes)
+        self.default = default
+        self.max_error_rate = max_error_rate
+        self.latency_floor = latency_floor
+
+    def stats(self):
+        """ a snapshot of each route's RouteStats, by name """
+        return dict((route.name, route.stats.snapshot())
+                    for route in self.routes)
+
+    def call(self, trans, method):
+        """Calls the gateway method with the transaction over the route for
+        it, failing over if need be
+        """
+        pinned = getattr(trans, 'route', None)
+        if pinned is not None:
+            if pinned not in self.by_name:
+                raise PaymentsValidationError(errors={
+                    'route': "isn't one of the PAYMENT_ROUTES"})
+            routes = [self.by_name[pinned]]
+        elif trans.type == 'Express' and method != 'setupRedirect':
+            return getattr(self.default, method)(trans)
+        else:
+            routes = self.order()
+        return self._attempt(routes, trans, method)
+
+    def order(self):
+        """The routes to try in turn, a weighted pick of the healthy ones
+        first, then the rest of them best first, then the unhealthy ones
+        """
+        latencies = [route.stats.latency for route in self.routes
+                     if route.stats.latency is not None]
+        untried = min(latencies) if latencies else 1.0 # worth a try
+        healthy, unhealthy = [], []
+        for route in self.routes:
+            breaker = getattr(route.gateway, 'breaker', None)
+            if route.stats.error_rate > self.max_error_rate or \
+                    (breaker is not None and breaker.state == 'open'):
+                unhealthy.append(route)
+                continue
+            latency = route.stats.latency
+            if latency is None:
+                latency = untried
+            score = route.weight * (1 - route.stats.error_rate) \
+                    / (latency + self.latency_floor)
+            healthy.append((score, route))
+        healthy.sort(key=lambda (score, route): -score)
+        total = sum(score for score, route in healthy)
+        if total > 0:
+            pick = random.uniform(0, total)
+            for i, (score, route) in enumerate(healthy):
+                pick -= score
+                if pick <= 0:
+                    healthy.insert(0, healthy.pop(i))
+                    break
+        unhealthy.sort(key=lambda route: route.stats.error_rate)
+        return [route for score, route in healthy] + unhealthy
+
+    def _attempt(self, routes, trans, method):
+        route, rest = routes[0], routes[1:]
+        trans.route = route.name
+        started = time.time()
+        try:
+            result = getattr(route.gateway, method)(trans)
+        except Exception, e:
+            route.stats.record(time.time() - started, True)
+            if rest and _unsent(e):
+                route.stats.failovers += 1
+                return self._attempt(rest, trans, method)
+            raise
+        if not isinstance(result, PaymentsFuture):
+            route.stats.record(time.time() - started, False)
+            return result
+        outcome = PaymentsFuture()
+        def done(future):
+            error = future._exc_info
+            route.stats.record(time.time() - started, error is not None)
+            if error is not None and rest and _unsent(error[1]):
+                route.stats.failovers += 1
+                try:
+                    retried = self._attempt(rest, trans, method)
+                except Exception:
+                    return outcome.set_exception()
+                retried.add_done_callback(
+                        lambda future: outcome._finish(future._result,
+                                                       future._exc_info))
+            else:
+                outcome._finish(future._result, error)
+        result.add_done_callback(done)
+        return outcome
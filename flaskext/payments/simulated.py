@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+    flaskext.payments.simulated
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    A gateway for load testing which never leaves the process. It is the
+    PayPal gateway talking to a SimulatedTransport, which answers the NVP
+    requests as PayPal would, so everything above the socket runs just as
+    it does for real. Use it with PAYMENT_API = 'Simulated'.
+
+    :copyright: (c) 2010 by jgumbley.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import with_statement
+
+import errno, itertools, numbers, random, socket, threading, time, urllib
+
+from flaskext.payments import PaymentsFuture, nvp_fields
+from flaskext.payments.paypal import PayPalGateway, AsyncPayPalGateway
+
+class SimulatedTransport(object):
+    """Answers NVP requests in process with PayPal shaped responses, after
+    `latency` seconds give or take `jitter`.
+
+    `errors` maps what can go wrong to how often it does, 0 to 1. A PayPal
+    error code, i.e. '10001', is answered with ACK=Failure and that code;
+    'timeout' and 'reset' fail the request as the network would.
+    """
+
+    messages = {
+        '10001': ('Internal Error', 'Timeout processing request'),
+        '10002': ('Security error', 'Security header is not valid'),
+        '10417': ('Transaction cannot complete.',
+                  'Instruct the customer to use an alternative payment '
+                  'method'),
+        '10486': ('This transaction couldn\'t be completed.',
+                  'Please redirect your customer to PayPal'),
+        '10527': ('Invalid Data', 'This transaction cannot be processed. '
+                  'Please enter a valid credit card number and type'),
+    }
+
+    def __init__(self, latency=0.0, jitter=0.0, errors=None):
+        self.latency = latency
+        self.jitter = jitter
+        self._errors = []
+        share = 0.0
+        for error, rate in sorted((errors or {}).items()):
+            share += rate
+            self._errors.append((share, error))
+        self._ids = itertools.count(1)
+        self.calls = 0
+
+    def request(self, body, timeout=None):
+        delay = self._delay()
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise socket.timeout('timed out')
+        if delay > 0:
+            time.sleep(delay)
+        return self.respond(body)
+
+    def request_async(self, body, timeout=None):
+        future = PaymentsFuture()
+        def answer():
+            try:
+                future.set_result(self.respond(body))
+            except Exception:
+                future.set_exception()
+        delay = self._delay()
+        if timeout is not None and delay > timeout:
+            delay, answer = timeout, lambda: future.set_exception(
+                    socket.timeout('timed out'))
+        if delay > 0:
+            timer = threading.Timer(delay, answer)
+            timer.daemon = True
+            timer.start()
+        else:
+            answer()
+        return future
+
+    def close(self):
+        pass
+
+    def _delay(self):
+        if not self.jitter:
+            return self.latency
+        return self.latency + random.uniform(-self.jitter, self.jitter)
+
+    def respond(self, body):
+        """Returns the response body to the request body, or raises the
+        network error it's been picked to fail with
+        """
+        self.calls += 1
+        params = nvp_fields(body, 'METHOD', 'AMT', 'TOKEN', 'TRANSACTIONID',
+                            'AUTHORIZATIONID')
+        common = ('&TIMESTAMP=%s&CORRELATIONID=%012x&VERSION=54.0'
+                  '&BUILD=1420052' % (urllib.quote(time.strftime(
+                  '%Y-%m-%dT%H:%M:%SZ', time.gmtime())),
+                  random.getrandbits(48)))
+        error = self._error()
+        if error == 'timeout':
+            raise socket.timeout('timed out')
+        if error == 'reset':
+            raise socket.error(errno.ECONNRESET, 'Connection reset by peer')
+        if error is not None:
+            short, long = self.messages.get(error, ('Simulated error',
+                                                    'Simulated error'))
+            return ('ACK=Failure%s&L_ERRORCODE0=%s&L_SHORTMESSAGE0=%s'
+                    '&L_LONGMESSAGE0=%s&L_SEVERITYCODE0=Error'
+                    % (common, error, urllib.quote(short),
+                       urllib.quote(long)))
+        answer = getattr(self, 'answer' + str(params.get('METHOD')), None)
+        if answer is None:
+            return ('ACK=Failure%s&L_ERRORCODE0=81002'
+                    '&L_SHORTMESSAGE0=Unspecified%%20Method' % common)
+        return 'ACK=Success' + common + answer(params)
+
+    def _error(self):
+        if self._errors:
+            chance = random.random()
+            for share, error in self._errors:
+                if chance < share:
+                    return error
+        return None
+
+    def next_id(self):
+        return '%017X' % next(self._ids)
+
+    def answerSetExpressCheckout(self, params):
+        return '&TOKEN=EC%2d' + self.next_id()
+
+    def answerDoExpressCheckoutPayment(self, params):
+        return ('&TOKEN=%s&TRANSACTIONID=%s&TRANSACTIONTYPE=expresscheckout'
+                '&PAYMENTTYPE=instant&AMT=%s&CURRENCYCODE=USD'
+                '&PAYMENTSTATUS=Completed&PENDINGREASON=None'
+                % (urllib.quote(params.get('TOKEN', '')), self.next_id(),
+                   urllib.quote(params.get('AMT', ''))))
+
+    def answerDoDirectPayment(self, params):
+        return ('&TRANSACTIONID=%s&AMT=%s&AVSCODE=X&CVV2MATCH=M'
+                % (self.next_id(), urllib.quote(params.get('AMT', ''))))
+
+    def answerDoCapture(self, params):
+        return ('&AUTHORIZATIONID=%s&TRANSACTIONID=%s&PAYMENTSTATUS=Completed'
+                '&AMT=%s' % (urllib.quote(params.get('AUTHORIZATIONID', '')),
+                             self.next_id(),
+                             urllib.quote(params.get('AMT', ''))))
+
+    def answerDoVoid(self, params):
+        return '&AUTHORIZATIONID=%s' % urllib.quote(
+                params.get('AUTHORIZATIONID', ''))
+
+    def answerTransactionSearch(self, params):
+        return '' # nothing has happened in a simulation
+
+    def answerGetTransactionDetails(self, params):
+        return ('&TRANSACTIONID=%s&PAYERID=SIMULATEDPAYER&PAYERSTATUS=verified'
+                '&TRANSACTIONTYPE=cart&PAYMENTTYPE=instant&AMT=100%%2e00'
+                '&PAYMENTSTATUS=Completed&L_NAME0=Widget&L_QTY0=1'
+                '&L_AMT0=100%%2e00'
+                % urllib.quote(params.get('TRANSACTIONID', '')))
+
+class _Simulated:
+    """ what the simulated gateways do differently to the PayPal ones """
+
+    config_schema = dict(PayPalGateway.config_schema,
+        PAYPAL_API_ENDPOINT=(basestring, False),
+        PAYPAL_API_URL=(basestring, False),
+        PAYPAL_API_USER=(basestring, False),
+        PAYPAL_API_PWD=(basestring, False),
+        PAYPAL_API_SIGNATURE=(basestring, False),
+        PAYMENT_SIMULATED_LATENCY=(numbers.Real, False),
+        PAYMENT_SIMULATED_JITTER=(numbers.Real, False),
+        PAYMENT_SIMULATED_ERRORS=(dict, False),
+        PAYMENT_SIMULATED_URL=(basestring, False),
+    )
+
+    def _init_API(self, app):
+        self.signature_values = {
+        'USER' : 'simulated',
+        'PWD' : 'simulated',
+        'SIGNATURE' : 'simulated',
+        'VERSION' : '54.0',
+        }
+        self.API_ENDPOINT = 'simulated:'
+        self.PAYPAL_URL = app.config.get('PAYMENT_SIMULATED_URL',
+                '/simulated-checkout?token=')
+        self.signature = urllib.urlencode(self.signature_values) + "&"
+        self._init_templates()
+
+    def _init_transport(self, app):
+        """ PAYMENT_SIMULATED_LATENCY, _JITTER and _ERRORS are passed on to
+        SimulatedTransport
+        """
+        self.transport = SimulatedTransport(
+                app.config.get('PAYMENT_SIMULATED_LATENCY', 0.0),
+                app.config.get('PAYMENT_SIMULATED_JITTER', 0.0),
+                app.config.get('PAYMENT_SIMULATED_ERRORS'))
+
+class SimulatedGateway(_Simulated, PayPalGateway):
+    """ PayPalGateway answered in process by a SimulatedTransport """
+
+class AsyncSimulatedGateway(_Simulated, AsyncPayPalGateway):
+    """ AsyncPayPalGateway answered in process by a SimulatedTransport """
+
+SimulatedGateway.async_gateway = AsyncSimulatedGateway
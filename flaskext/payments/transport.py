@@ -0,0 +1,895 @@
+# -*- coding: utf-8 -*-
+"""
+    flaskext.payments.transport
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    How requests get to the gateway's endpoint. HTTPTransport keeps a pool of
+    keep-alive connections for threads to share, GreenHTTPTransport does the
+    same for gevent and eventlet workers, and AsyncHTTPTransport drives its
+    connections from an event loop of its own for calls made without
+    blocking. budget sets the deadline calls on a thread are made to.
+
+    :copyright: (c) 2010 by jgumbley.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import with_statement
+
+import asyncore, collections, errno, heapq, httplib, itertools, select
+import socket, ssl, sys, threading, time, traceback, urlparse
+
+from flaskext.payments import PaymentsConfigurationError, \
+     PaymentsErrorFromGateway, PaymentsCircuitOpen
+
+def _split_endpoint(endpoint):
+    """Splits a gateway endpoint url up into its scheme, host, port and the
+    path to post to, failing on anything but http and https.
+    """
+    url = urlparse.urlsplit(endpoint)
+    if url.scheme not in ('http', 'https'):
+        raise PaymentsConfigurationError(
+                "unsupported endpoint scheme %r" % url.scheme)
+    path = url.path or '/'
+    if url.query:
+        path += '?' + url.query
+    return url.scheme, url.hostname, url.port, path
+
+class HTTPTransport(object):
+    """Posts request bodies to a single gateway endpoint over a pool of
+    persistent (keep-alive) connections, so a checkout doesn't pay for a new
+    TCP connection and TLS handshake on every call to the gateway.
+
+    Safe to share between threads. At most `size` connections are open at
+    once, callers block until one is free. Connections left idle for longer
+    than `idle_timeout` seconds are closed rather than reused, as the far end
+    has most likely dropped them already.
+
+    :param endpoint: full url of the gateway API, http or https
+    :param size: maximum number of connections to hold open
+    :param idle_timeout: seconds an idle connection is kept for reuse
+    :param connect_timeout: seconds to wait for the connection to establish
+    :param read_timeout: seconds to wait on the socket for the response
+    """
+
+    def __init__(self, endpoint, size=4, idle_timeout=60,
+                 connect_timeout=None, read_timeout=None):
+        scheme, self.host, self.port, self.path = _split_endpoint(endpoint)
+        if scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._idle = [] # (last used, connection) pairs, most recent last
+        self._lock = threading.Lock()
+        self._free = size
+        self._slots = threading.Condition(threading.Lock())
+
+    def request(self, body, timeout=None):
+        """POSTs the url encoded body to the endpoint and returns the
+        response body as a string.
+
+        If a timeout is given the call is abandoned with socket.timeout after
+        roughly that many seconds, including any wait for a free connection,
+        whatever the pool's own connect and read timeouts.
+        """
+        expires = time.time() + timeout if timeout is not None else None
+        self._acquire(expires)
+        try:
+            conn, reused = self._checkout(expires)
+            sent = False
+            try:
+                self._send(conn, body, expires)
+                sent = True
+                data = self._receive(conn)
+            except socket.timeout:
+                conn.close() # the request may well have been acted on
+                raise
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if not reused or sent:
+                    raise # it may have been acted on, the caller decides
+                # a kept alive connection can be closed by the far end at any
+                # point while it sits in the pool, and if that's why none of
+                # the request could be written it's safe to give a fresh one
+                # a go
+                conn = self._connect(expires)
+                try:
+                    data = self._roundtrip(conn, body, expires)
+                except:
+                    conn.close()
+                    raise
+            except:
+                conn.close()
+                raise
+            self._checkin(conn)
+            return data
+        finally:
+            self._release()
+
+    def close(self):
+        """Closes all the idle connections held by the pool"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for used, conn in idle:
+            conn.close()
+
+    def warm(self, count, timeout=None):
+        """Opens connections until there are `count` idle in the pool, or as
+        many as it holds, so the first calls don't pay for the DNS lookup,
+        TCP connection and TLS handshake. Returns how many were opened.
+        """
+        expires = time.time() + timeout if timeout is not None else None
+        count = min(count, self.size)
+        opened = 0
+        while True:
+            with self._lock:
+                if len(self._idle) >= count:
+                    return opened
+            self._acquire(expires)
+            try:
+                self._checkin(self._connect(expires))
+                opened += 1
+            finally:
+                self._release()
+
+    def _acquire(self, expires):
+        with self._slots:
+            while not self._free:
+                if expires is None:
+                    self._slots.wait()
+                    continue
+                remaining = expires - time.time()
+                if remaining <= 0:
+                    raise socket.timeout('timed out waiting for a connection')
+                self._slots.wait(remaining)
+            self._free -= 1
+
+    def _release(self):
+        with self._slots:
+            self._free += 1
+            self._slots.notify()
+
+    def _checkout(self, expires):
+        cutoff = time.time() - self.idle_timeout
+        with self._lock:
+            stale = [c for used, c in self._idle if used < cutoff]
+            self._idle = [(used, c) for used, c in self._idle
+                          if used >= cutoff]
+            conn = self._idle.pop()[1] if self._idle else None
+        for c in stale:
+            c.close()
+        if conn is not None:
+            return conn, True
+        return self._connect(expires), False
+
+    def _checkin(self, conn):
+        if conn.sock is None:
+            return # server asked for the connection to be closed
+        with self._lock:
+            self._idle.append((time.time(), conn))
+
+    def _connect(self, expires):
+        conn = self.connection_class(self.host, self.port,
+                timeout=_within(self.connect_timeout, expires))
+        conn.connect()
+        return conn
+
+    def _roundtrip(self, conn, body, expires):
+        self._send(conn, body, expires)
+        return self._receive(conn)
+
+    def _send(self, conn, body, expires):
+        conn.sock.settimeout(_within(self.read_timeout, expires))
+        conn.request('POST', self.path, body,
+                {'Content-Type': 'application/x-www-form-urlencoded'})
+
+    def _receive(self, conn):
+        response = conn.getresponse(buffering=True)
+        data = response.read()
+        if response.will_close:
+            conn.close()
+        return data
+
+def _within(timeout, expires):
+    """Returns timeout cut down to what's left before expires, if that's
+    sooner, failing with socket.timeout if there's nothing left.
+    """
+    if expires is None:
+        return timeout
+    remaining = expires - time.time()
+    if remaining <= 0:
+        raise socket.timeout('timed out')
+    if timeout is None:
+        return remaining
+    return min(timeout, remaining)
+
+class GreenHTTPTransport(HTTPTransport):
+    """HTTPTransport for gevent or eventlet workers, `mode` saying which.
+    Waiting for a free connection, connecting, TLS and waiting on the
+    response all yield to the other green threads rather than holding up
+    the whole worker, whether or not the standard library has been monkey
+    patched, so thousands of checkouts can be in flight in one process.
+    A timeout given to request is held to by the library's Timeout.
+
+    Deadlines set with budget are kept per green thread from then on.
+    """
+
+    def __init__(self, endpoint, size=100, idle_timeout=60,
+                 connect_timeout=None, read_timeout=None, mode='gevent'):
+        HTTPTransport.__init__(self, endpoint, size, idle_timeout,
+                               connect_timeout, read_timeout)
+        self.green = _green_library(mode)
+        self.sleep = self.green.sleep
+        self._slots = self.green.Semaphore(size)
+        self.connection_class = _green_connection(self.connection_class,
+                                                  self.green)
+        _green_budget(self.green)
+
+    def request(self, body, timeout=None):
+        if timeout is None:
+            return HTTPTransport.request(self, body)
+        with self.green.Timeout(timeout, socket.timeout('timed out')):
+            return HTTPTransport.request(self, body, timeout)
+
+    def _acquire(self, expires):
+        if expires is None:
+            self._slots.acquire()
+            return
+        remaining = expires - time.time()
+        if remaining <= 0 or not self._slots.acquire(timeout=remaining):
+            raise socket.timeout('timed out waiting for a connection')
+
+    def _release(self):
+        self._slots.release()
+
+_Green = collections.namedtuple('_Green', 'Semaphore Timeout local sleep '
+                                'create_connection create_default_context')
+
+def _green_library(mode):
+    """ what GreenHTTPTransport needs from gevent or eventlet, which are only
+    imported by those who use them
+    """
+    if mode == 'gevent':
+        import gevent, gevent.local, gevent.lock, gevent.socket, gevent.ssl
+        return _Green(gevent.lock.Semaphore, gevent.Timeout,
+                      gevent.local.local, gevent.sleep,
+                      gevent.socket.create_connection,
+                      gevent.ssl.create_default_context)
+    if mode == 'eventlet':
+        import eventlet, eventlet.corolocal, eventlet.semaphore
+        from eventlet.green import socket as green_socket, ssl as green_ssl
+        return _Green(eventlet.semaphore.Semaphore, eventlet.Timeout,
+                      eventlet.corolocal.local, eventlet.sleep,
+                      green_socket.create_connection,
+                      green_ssl.create_default_context)
+    raise PaymentsConfigurationError("PAYMENT_IO_MODE should be 'threads', "
+                                     "'gevent' or 'eventlet', not %r" % mode)
+
+def _green_connection(base, green):
+    """ the httplib connection class base, connecting with green sockets """
+    context = green.create_default_context() \
+            if issubclass(base, httplib.HTTPSConnection) else None
+
+    class GreenConnection(base):
+        def connect(self):
+            self.sock = green.create_connection((self.host, self.port),
+                                                self.timeout,
+                                                self.source_address)
+            if self._tunnel_host:
+                self._tunnel()
+            if context is not None:
+                self.sock = context.wrap_socket(self.sock,
+                        server_hostname=self._tunnel_host or self.host)
+    return GreenConnection
+
+def _green_budget(green):
+    """ keeps budget's deadlines per green thread rather than per thread,
+    which every green thread in a worker shares unless it's patched
+    """
+    global _budget
+    if not isinstance(_budget, green.local):
+        _budget = green.local()
+
+# ------------------------------------------------------------------------
+
+class PaymentsFuture(object):
+    """The outcome of a gateway call made without blocking, filled in later
+    from the transport's event loop.
+
+    Callbacks added with `add_done_callback`, and functions chained on with
+    `then`, run on the event loop thread so should be quick and must not
+    block.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """Waits for the call to finish and returns what it came back with,
+        or raises whatever it failed with.
+        """
+        if not self._event.wait(timeout):
+            raise PaymentsErrorFromGateway(
+                    "no response from the gateway within %s seconds" % timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """Waits for the call to finish and returns the exception it failed
+        with, or None if it succeeded.
+        """
+        try:
+            self.result(timeout)
+        except Exception, e:
+            return e
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exc_info=None):
+        """Fails the call with an exception instance, an exc_info triple, or
+        by default the exception currently being handled.
+        """
+        if exc_info is None:
+            exc_info = sys.exc_info()
+        elif isinstance(exc_info, BaseException):
+            exc_info = (type(exc_info), exc_info, None)
+        self._finish(None, exc_info)
+
+    def add_done_callback(self, callback):
+        """Calls callback with this future once it is done, straight away if
+        it already is.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def then(self, fn):
+        """Returns a new future for the result of fn applied to this one's
+        result. Failures pass straight through without calling fn.
+        """
+        chained = PaymentsFuture()
+        def resolve(future):
+            if future._exc_info is not None:
+                chained._finish(None, future._exc_info)
+                return
+            try:
+                value = fn(future._result)
+            except Exception:
+                chained.set_exception()
+            else:
+                chained.set_result(value)
+        self.add_done_callback(resolve)
+        return chained
+
+    def _finish(self, result, exc_info):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._result, self._exc_info = result, exc_info
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                traceback.print_exc() # as a thread would, don't kill the loop
+
+class _Scheduler(object):
+    """Runs functions one after another on a thread of its own, each no
+    sooner than it was asked to be. For the work around calls made without
+    blocking which may itself block, i.e. on a limiter kept in a file, so it
+    holds up neither the caller nor the transport's event loop, and for
+    waiting out backoffs without a thread each. The thread is started by
+    the first call_later.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._due = [] # heap of (when, order, fn, args)
+        self._order = itertools.count()
+        self._changed = threading.Condition(threading.Lock())
+        self._thread = None
+
+    def call_later(self, delay, fn, *args):
+        with self._changed:
+            heapq.heappush(self._due, (time.time() + delay,
+                                       next(self._order), fn, args))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name=self.name)
+                self._thread.daemon = True
+                self._thread.start()
+            self._changed.notify()
+
+    def _run(self):
+        while True:
+            with self._changed:
+                while not self._due or self._due[0][0] > time.time():
+                    self._changed.wait(self._due[0][0] - time.time()
+                                       if self._due else None)
+                when, order, fn, args = heapq.heappop(self._due)
+            try:
+                fn(*args)
+            except Exception:
+                traceback.print_exc() # as a thread would, keep going
+
+class AsyncHTTPTransport(object):
+    """Non-blocking twin of HTTPTransport. Requests are handed to one event
+    loop thread which drives every connection through asyncore, so hundreds
+    of calls can be in flight at once without a thread each.
+
+    Connections are kept alive and reused in the same way, up to `size` of
+    them open at once, after which requests queue for the next free one.
+    `request_async` returns a PaymentsFuture for the response body, `request`
+    blocks on it so this can stand in for HTTPTransport as well.
+
+    The endpoint's host name is resolved on the loop thread when a connection
+    is opened, so it's best kept to the one or two the pool needs.
+    """
+
+    # how long the loop waits on sockets before checking timeouts again
+    tick = 0.05
+
+    def __init__(self, endpoint, size=100, idle_timeout=60,
+                 connect_timeout=None, read_timeout=None):
+        self.scheme, self.host, self.port, self.path = \
+                _split_endpoint(endpoint)
+        if self.port is None:
+            self.port = 443 if self.scheme == 'https' else 80
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._submitted = collections.deque() # appended to from any thread
+        # everything below is only touched from the loop thread
+        self._map = {}
+        self._waiting = collections.deque() # (body, future, retried, expires)
+        self._idle = [] # connections, most recently used last
+        self._busy = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._waker = None
+        self._closing = False
+
+    def request_async(self, body, timeout=None):
+        """Queues the url encoded body to be POSTed to the endpoint and
+        returns a future for the response body. If a timeout is given the
+        future fails with socket.timeout if there's no response in roughly
+        that many seconds, including any wait for a free connection.
+        """
+        future = PaymentsFuture()
+        expires = time.time() + timeout if timeout is not None else None
+        self._submitted.append((body, future, False, expires))
+        self._wake()
+        return future
+
+    def request(self, body, timeout=None):
+        return self.request_async(body, timeout).result()
+
+    def close(self):
+        """Stops the event loop, closing every connection and failing
+        anything still outstanding.
+        """
+        with self._lock:
+            thread = self._thread
+            self._closing = True
+        if thread is not None:
+            self._waker.wake()
+            if thread is not threading.current_thread():
+                thread.join()
+
+    def _wake(self):
+        with self._lock:
+            if self._thread is None:
+                self._closing = False
+                self._waker = _Waker(self._map)
+                self._thread = threading.Thread(target=self._run,
+                        name='payments-transport')
+                self._thread.daemon = True
+                self._thread.start()
+        self._waker.wake()
+
+    def _run(self):
+        use_poll = hasattr(select, 'poll')
+        while not self._closing:
+            self._service()
+            asyncore.loop(self.tick, use_poll, self._map, 1)
+        with self._lock:
+            self._thread = None
+        closed = PaymentsErrorFromGateway("transport closed")
+        for conn in list(self._busy) + self._idle:
+            conn.fail(closed, retry=False)
+        while self._submitted:
+            self._waiting.append(self._submitted.popleft())
+        while self._waiting:
+            self._waiting.popleft()[1].set_exception(closed)
+        self._waker.close()
+
+    def _service(self):
+        while self._submitted:
+            self._waiting.append(self._submitted.popleft())
+        now = time.time()
+        expired = [c for c in self._idle if c.last_used < now - self.idle_timeout]
+        for conn in expired:
+            self._discard(conn)
+            conn.close()
+        for conn in [c for c in self._busy
+                     if c.deadline is not None and c.deadline < now]:
+            conn.fail(socket.timeout('timed out'), retry=False)
+        if any(expires is not None and expires < now
+               for body, future, retried, expires in self._waiting):
+            waiting = self._waiting
+            self._waiting = collections.deque()
+            for request in waiting:
+                if request[3] is not None and request[3] < now:
+                    request[1].set_exception(socket.timeout(
+                            'timed out waiting for a connection'))
+                else:
+                    self._waiting.append(request)
+        self._assign()
+
+    def _assign(self):
+        while self._waiting and (self._idle or len(self._busy) < self.size):
+            body, future, retried, expires = self._waiting.popleft()
+            if self._idle:
+                conn = self._idle.pop()
+                conn.reused = not retried
+            else:
+                try:
+                    conn = _AsyncConnection(self)
+                except Exception:
+                    future.set_exception() # i.e. the host doesn't resolve
+                    continue
+            self._busy.add(conn)
+            conn.start(body, future, expires)
+
+    def _release(self, conn):
+        self._busy.discard(conn)
+        conn.last_used = time.time()
+        self._idle.append(conn)
+        self._assign()
+
+    def _discard(self, conn):
+        self._busy.discard(conn)
+        if conn in self._idle:
+            self._idle.remove(conn)
+        self._assign()
+
+    def _retry(self, body, future, expires):
+        self._waiting.appendleft((body, future, True, expires))
+
+    def _wrap(self, sock):
+        if hasattr(ssl, 'create_default_context'):
+            return ssl.create_default_context().wrap_socket(sock,
+                    server_hostname=self.host, do_handshake_on_connect=False)
+        return ssl.wrap_socket(sock, do_handshake_on_connect=False)
+
+class _Waker(asyncore.dispatcher):
+    """Lets other threads interrupt the event loop's wait when they've handed
+    it something to do, by writing to a loopback socket it is watching.
+    """
+
+    def __init__(self, map):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        self.writer = socket.create_connection(listener.getsockname())
+        self.writer.setblocking(0)
+        reader = listener.accept()[0]
+        listener.close()
+        asyncore.dispatcher.__init__(self, reader, map)
+
+    def wake(self):
+        try:
+            self.writer.send('x')
+        except socket.error:
+            pass # buffer full, so there's a wake up pending anyway
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self.writer.close()
+
+class _AsyncConnection(asyncore.dispatcher):
+    """One keep-alive connection to the endpoint, driven by the transport's
+    event loop, posting a request at a time and reading back the response.
+    """
+
+    def __init__(self, transport):
+        asyncore.dispatcher.__init__(self, map=transport._map)
+        self.transport = transport
+        self.reused = False
+        self.handshaking = False
+        self.want_write = False
+        self.future = None
+        self.body = None
+        self.outgoing = ''
+        self.incoming = ''
+        self.sent = False
+        self.received = False
+        self.head_read = False
+        self.length = None
+        self.chunked = False
+        self.keep_alive = True
+        self.last_used = time.time()
+        self.expires = None
+        self.deadline = None
+        if transport.connect_timeout is not None:
+            self.deadline = time.time() + transport.connect_timeout
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.connect((transport.host, transport.port))
+        except:
+            self.close()
+            raise
+
+    def start(self, body, future, expires=None):
+        transport = self.transport
+        self.body, self.future, self.expires = body, future, expires
+        self.outgoing = ('POST %s HTTP/1.1\r\n'
+                'Host: %s\r\n'
+                'Content-Type: application/x-www-form-urlencoded\r\n'
+                'Content-Length: %d\r\n'
+                '\r\n%s') % (transport.path, transport.host, len(body), body)
+        self.incoming = ''
+        self.sent = False
+        self.received = False
+        self.head_read = False
+        self.length = None
+        self.chunked = False
+        self.keep_alive = True
+        if self.connected and not self.handshaking:
+            self.deadline = self._read_deadline()
+        elif expires is not None:
+            self.deadline = min(self.deadline or expires, expires)
+
+    def _read_deadline(self):
+        """ when the next of the response is due by, the read timeout from
+        now or the request's own expiry if that's sooner
+        """
+        deadline = self.expires
+        if self.transport.read_timeout is not None:
+            deadline = min(deadline or sys.maxint,
+                           time.time() + self.transport.read_timeout)
+        return deadline
+
+    def fail(self, error, retry=True):
+        """Closes the connection and fails its request, unless it was to go
+        out on a reused connection the far end had already dropped before
+        any of it could be written, in which case it is put back for a fresh
+        connection to take. Anything else may have been acted on, so is left
+        to the caller.
+        """
+        future, body = self.future, self.body
+        self.future = self.body = None
+        self.close()
+        transport = self.transport
+        if future is not None:
+            if retry and self.reused and not self.sent:
+                transport._retry(body, future, self.expires)
+            else:
+                future.set_exception(error)
+        transport._discard(self)
+
+    # asyncore events
+
+    def readable(self):
+        return not self.handshaking or not self.want_write
+
+    def writable(self):
+        if self.connecting or not self.connected:
+            return True
+        if self.handshaking:
+            return self.want_write
+        return bool(self.outgoing)
+
+    def handle_connect(self):
+        if self.transport.scheme == 'https':
+            self.socket = self.transport._wrap(self.socket)
+            self.handshaking = True
+            self._handshake()
+        elif self.future is not None:
+            self.deadline = self._read_deadline()
+
+    def handle_write(self):
+        if self.handshaking:
+            return self._handshake()
+        sent = self.send(self.outgoing)
+        if sent:
+            self.sent = True
+        self.outgoing = self.outgoing[sent:]
+
+    def handle_read(self):
+        if self.handshaking:
+            return self._handshake()
+        while True:
+            try:
+                data = self.socket.recv(65536)
+            except ssl.SSLError, e:
+                if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                    return
+                raise
+            except socket.error, e:
+                if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    return
+                raise
+            if not data:
+                return self.handle_close()
+            if self.future is None:
+                # nothing asked for, the connection is no use any more
+                return self.fail(None)
+            self.received = True
+            self.deadline = self._read_deadline()
+            self.incoming += data
+            self._check_complete()
+            if not (isinstance(self.socket, ssl.SSLSocket)
+                    and self.socket.pending()):
+                return
+
+    def handle_close(self):
+        if self.future is not None and self.head_read \
+                and self.length is None and not self.chunked:
+            return self._complete(self.incoming) # body runs until close
+        self.fail(socket.error(errno.ECONNRESET,
+                               'connection closed by the gateway'))
+
+    def handle_error(self):
+        self.fail(sys.exc_info())
+
+    # response handling
+
+    def _handshake(self):
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLError, e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self.want_write = False
+                return
+            if e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self.want_write = True
+                return
+            raise
+        self.handshaking = self.want_write = False
+        if self.future is not None:
+            self.deadline = self._read_deadline()
+
+    def _check_complete(self):
+        if not self.head_read:
+            end = self.incoming.find('\r\n\r\n')
+            if end == -1:
+                return
+            self._parse_head(self.incoming[:end])
+            self.incoming = self.incoming[end + 4:]
+        if self.chunked:
+            body = _dechunk(self.incoming)
+            if body is not None:
+                self._complete(body)
+        elif self.length is not None and len(self.incoming) >= self.length:
+            self._complete(self.incoming[:self.length])
+
+    def _parse_head(self, head):
+        lines = head.split('\r\n')
+        version = lines[0].split(' ', 1)[0]
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.0':
+            keep_alive = connection == 'keep-alive'
+        else:
+            keep_alive = connection != 'close'
+        self.chunked = 'chunked' in headers.get('transfer-encoding', '')
+        if 'content-length' in headers and not self.chunked:
+            self.length = int(headers['content-length'])
+        elif not self.chunked:
+            keep_alive = False # the body is whatever comes before close
+        self.keep_alive = keep_alive
+        self.head_read = True
+
+    def _complete(self, body):
+        future = self.future
+        keep_alive = self.keep_alive
+        self.future = self.body = None
+        self.deadline = None
+        self.incoming = ''
+        self.reused = True
+        if keep_alive:
+            self.transport._release(self)
+        else:
+            self.close()
+            self.transport._discard(self)
+        future.set_result(body)
+
+def _dechunk(data):
+    """Decodes a chunked response body, or returns None if it hasn't all
+    arrived yet.
+    """
+    body = []
+    pos = 0
+    while True:
+        end = data.find('\r\n', pos)
+        if end == -1:
+            return None
+        size = int(data[pos:end].split(';', 1)[0], 16)
+        if size == 0:
+            if data.find('\r\n\r\n', end) == -1:
+                return None # waiting on the trailer
+            return ''.join(body)
+        start = end + 2
+        if len(data) < start + size + 2:
+            return None
+        body.append(data[start:start + size])
+        pos = start + size + 2
+
+# ------------------------------------------------------------------------
+
+_budget = threading.local()
+
+class budget(object):
+    """Context manager giving every call to the gateway made inside it, on
+    this thread, a share of a total budget of `seconds`. Nested budgets can
+    only shorten the one they're in. None leaves things as they are.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def __enter__(self):
+        self.outer = getattr(_budget, 'expires', None)
+        if self.seconds is not None:
+            expires = time.time() + self.seconds
+            if self.outer is None or expires < self.outer:
+                _budget.expires = expires
+        return self
+
+    def __exit__(self, *exc_info):
+        _budget.expires = self.outer
+
+def _current_deadline():
+    """ when the budget this thread is working to runs out, if there is one """
+    return getattr(_budget, 'expires', None)
+
+def _remaining(expires):
+    """ seconds left before expires, failing if there are none """
+    if expires is None:
+        return None
+    remaining = expires - time.time()
+    if remaining <= 0:
+        raise PaymentsErrorFromGateway("deadline exceeded before the gateway "
+                                       "answered")
+    return remaining
+
+def _retryable(error):
+    """ whether a failed call never got a usable answer, as opposed to one
+    the gateway gave or refused on our side
+    """
+    return isinstance(error, (socket.error, httplib.HTTPException))
+
+def _unsent(error):
+    """ whether a failed call certainly never reached the gateway, so can be
+    made somewhere else without any risk of paying twice
+    """
+    if isinstance(error, (PaymentsCircuitOpen, socket.gaierror)):
+        return True
+    return isinstance(error, socket.error) and error.errno in (
+            errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+    flaskext.payments.validation
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    The checks transactions have to pass before they go to a gateway, the
+    generic ones and those each gateway class lists for itself.
+
+    :copyright: (c) 2010 by jgumbley.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from __future__ import with_statement
+
+import decimal, itertools, numbers, re, threading, time
+
+from flaskext.payments import PaymentsConfigurationError
+
+_AMOUNT = re.compile(r'^\d+(\.\d{1,2})?$')
+_CARD_NUMBER = re.compile(r'^\d{12,19}$')
+_CARD_SEPARATORS = re.compile(r'[ -]')
+_EXPIRY = re.compile(r'^(\d\d)(\d{4})$')
+_CVV = re.compile(r'^\d{3,4}$')
+
+def _missing(value):
+    return value is None or value == ''
+
+def _required(value):
+    if _missing(value):
+        return 'is required'
+
+def _amount(value):
+    if _missing(value):
+        return 'is required'
+    if isinstance(value, bool):
+        return 'should be an amount, i.e. 10.00'
+    if not isinstance(value, numbers.Number):
+        value = str(value).strip()
+        if not _AMOUNT.match(value):
+            return 'should be an amount, i.e. 10.00'
+    try:
+        value = decimal.Decimal(str(value)) # as it will be sent
+    except decimal.InvalidOperation:
+        return 'should be an amount, i.e. 10.00'
+    if not value.is_finite() or value.as_tuple().exponent < -2:
+        return 'should be an amount, i.e. 10.00'
+    if not value > 0:
+        return 'should be more than nothing'
+
+def _card_number(value):
+    if _missing(value):
+        return 'is required'
+    digits = _CARD_SEPARATORS.sub('', str(value))
+    if not _CARD_NUMBER.match(digits):
+        return 'should be a card number of 12 to 19 digits'
+    total = 0
+    for i, digit in enumerate(reversed(digits)):
+        digit = int(digit)
+        if i % 2:
+            digit *= 2
+            if digit > 9:
+                digit -= 9
+        total += digit
+    if total % 10:
+        return 'fails the Luhn check'
+
+def _expiry(value):
+    if _missing(value):
+        return 'is required'
+    match = _EXPIRY.match(str(value).strip())
+    if match is None:
+        return 'should be the expiry date as MMYYYY'
+    month, year = int(match.group(1)), int(match.group(2))
+    if not 1 <= month <= 12:
+        return 'should be the expiry date as MMYYYY'
+    if (year, month) < time.gmtime()[:2]:
+        return 'has passed'
+
+def _cvv(value):
+    if _missing(value):
+        return 'is required'
+    if not _CVV.match(str(value).strip()):
+        return 'should be the 3 or 4 digit card security code'
+
+def _one_of(types):
+    def check(value):
+        return "should be one of %s, not %r" % (', '.join(types), value)
+    return check
+
+class ValidationRules(object):
+    """The checks a transaction has to pass before it goes to the gateway,
+    given as (field, rule) pairs. A rule is the name of one of the `named`
+    ones or a callable taking the field's value and returning what's wrong
+    with it, or None if nothing is. All but 'required' fail a missing value
+    too. Only the first problem with each field is reported.
+
+    Gateways list theirs by transaction type in `validation_rules`::
+
+        validation_rules = {
+            'Direct': [('amount', 'amount'), ('acct', 'card_number')],
+        }
+
+    and validation_rules() compiles them once for each gateway class.
+    """
+
+    named = {
+        'required': _required,
+        'amount': _amount,
+        'card_number': _card_number,
+        'expiry': _expiry,
+        'cvv': _cvv,
+    }
+
+    def __init__(self, rules):
+        self.rules = []
+        for field, rule in rules:
+            if isinstance(rule, basestring):
+                try:
+                    rule = self.named[rule]
+                except KeyError:
+                    raise PaymentsConfigurationError(
+                            "%r isn't a validation rule, the ones there are "
+                            "are %s" % (rule, ', '.join(sorted(self.named))))
+            self.rules.append((field, rule))
+
+    def check(self, trans):
+        """Returns a dict of field to problem, empty if the transaction is
+        valid
+        """
+        errors = {}
+        for field, rule in self.rules:
+            if field not in errors:
+                problem = rule(getattr(trans, field, None))
+                if problem:
+                    errors[field] = problem
+        return errors
+
+    def check_many(self, transactions):
+        """check for a list of transactions, running each rule down all of
+        them in turn
+        """
+        errors = [{} for trans in transactions]
+        for field, rule in self.rules:
+            values = [getattr(trans, field, None) for trans in transactions]
+            for problems, problem in itertools.izip(errors,
+                                                    itertools.imap(rule, values)):
+                if problem and field not in problems:
+                    problems[field] = problem
+        return errors
+
+_generic_rules = ValidationRules([('type', 'required'), ('amount', 'amount')])
+
+_compiled_rules = {}
+_compiled_lock = threading.Lock()
+
+def validation_rules(gateway_class):
+    """Returns a dict of transaction type to the ValidationRules for it for
+    a gateway class, compiled from its `validation_rules` the first time
+    it's asked for. Under None are the rules for a type the gateway doesn't
+    list, which just say so, or the generic ones if it lists none at all.
+    """
+    with _compiled_lock:
+        compiled = _compiled_rules.get(gateway_class)
+        if compiled is None:
+            rules = getattr(gateway_class, 'validation_rules', None) or {}
+            compiled = dict((type, ValidationRules(type_rules))
+                            for type, type_rules in rules.iteritems())
+            if compiled:
+                compiled[None] = ValidationRules(
+                        [('type', _one_of(sorted(compiled)))])
+            else:
+                compiled[None] = _generic_rules
+            _compiled_rules[gateway_class] = compiled
+        return compiled
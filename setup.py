@@ -22,8 +22,14 @@ setup(
     author_email='your-email-here@example.com',
     description='<enter short description here>',
     long_description=__doc__,
-    packages=['flaskext'],
+    packages=['flaskext', 'flaskext.payments'],
     namespace_packages=['flaskext'],
+    entry_points={
+        'flaskext.payments.gateways': [
+            'PayPal = flaskext.payments.paypal:PayPalGateway',
+            'Simulated = flaskext.payments.simulated:SimulatedGateway',
+        ],
+    },
     zip_safe=False,
     platforms='any',
     install_requires=[
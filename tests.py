@@ -2,11 +2,24 @@
 
 from __future__ import with_statement
 
-import unittest
+import datetime, decimal, errno, json, os, shutil, socket, StringIO, sys, tempfile, threading, time, unittest, urllib, urlparse
 
 from flask import Flask, g
-from flaskext.payments import Payments, Transaction
+from flaskext.payments import Payments, Transaction, HTTPTransport
+from flaskext.payments import NVPResponse, NVPTemplate, nvp_fields
+from flaskext.payments import AsyncPayments, AsyncHTTPTransport, PaymentsFuture
+from flaskext.payments import RateLimiter, MemoryCache
+from flaskext.payments import gateway_call, payment_operation
+from flask.signals import signals_available
 from flaskext.payments import PaymentsValidationError, PaymentsConfigurationError
+from flaskext.payments import PaymentsErrorFromGateway, CircuitBreaker, budget
+from flaskext.payments import GatewayRegistry, check_config
+from flaskext.payments import SQLiteCache, CaptureQueue, PaymentsQueueFull
+from flaskext.payments import AdaptiveLimiter, ValidationRules
+from flaskext.payments import MerchantAccounts, AuditLog, GatewayRouter
+from flaskext.payments import PaymentsCircuitOpen, BatchCheckpoint
+from flaskext.payments.simulated import SimulatedTransport
+from flaskext.payments.ipn import IPNListener, _IPNJournal
 
 class InstantiatingTestCase(unittest.TestCase):
 
@@ -61,6 +74,50 @@ class PayPalTestCase(PaymentsTestCase):
         # need to keep personal API details out of scm
         self.app.config.from_pyfile('yourpaypal.settings')
 
+class FakeTransport(object):
+    """Stands in for the HTTP transport, recording what the gateway sends and
+    replying with canned NVP responses
+    """
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.sent = []
+
+    def request(self, body):
+        self.sent.append(body)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+class OfflinePayPalTestCase(PaymentsTestCase):
+    """ PayPal configured with dummy credentials, talking to a fake transport
+    rather than the sandbox
+    """
+    PAYMENT_API = 'PayPal'
+
+    PAYPAL_API_ENDPOINT = 'https://api-3t.sandbox.paypal.com/nvp'
+    PAYPAL_API_URL = 'https://www.sandbox.paypal.com/webscr&cmd=_express-checkout&token='
+    PAYPAL_API_USER = 'user'
+    PAYPAL_API_PWD = 'pwd'
+    PAYPAL_API_SIGNATURE = 'sig'
+
+    def loadPrivateConfig(self):
+        pass
+
+    def respond(self, *responses):
+        self.transport = FakeTransport(*responses)
+        self.payments.gateway.transport = self.transport
+
+class EchoTransport(object):
+    """ Answers GetTransactionDetails with the id it was asked about, failing
+    for any id starting 'bad'
+    """
+    def request(self, body):
+        tx_id = dict(urlparse.parse_qsl(body))['TRANSACTIONID']
+        if tx_id.startswith('bad'):
+            raise socket.error('connection reset')
+        return 'ACK=Success&TRANSACTIONID=%s' % tx_id
+
 def getValidWPPExpressTransaction():
     """Convenience helper to get a valid WPP Express Transaction as a starting
     point
@@ -72,6 +129,24 @@ def getValidWPPExpressTransaction():
     trans.cancel_url = 'http://www.jgumbley.com'
     return trans
 
+def getValidDirectTransaction():
+    """Likewise for a WPP Direct Transaction, with PayPal's test card"""
+    trans = Transaction()
+    trans.type = 'Direct'
+    trans.amount = 100
+    trans.ipaddress = '127.0.0.1'
+    trans.acct = '4111111111111111'
+    trans.expdate = '122030'
+    trans.cvv2 = '123'
+    trans.firstname = 'Test'
+    trans.lastname = 'User'
+    trans.cctype = 'Visa'
+    trans.street = '1 Main St'
+    trans.city = 'San Jose'
+    trans.state = 'CA'
+    trans.zipcode = '95131'
+    return trans
+
 import webbrowser
 class WalkingSkeleton(PayPalTestCase):
     """These tests are not really unit tests as such they are just designed to test
@@ -96,3 +171,1353 @@ class WalkingSkeleton(PayPalTestCase):
         # now call authorise
         trans = self.payments.authorise(trans)
         assert trans.authorised == True
+
+
+import httplib, struct, threading, BaseHTTPServer, SocketServer
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.clients.append(self.client_address)
+        if self.server.resets:
+            # took the request, then goes without a word, but for a reset
+            self.server.resets -= 1
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                       struct.pack('ii', 1, 0))
+            self.connection.close()
+            self.close_connection = 1
+            return
+        if self.server.hangups:
+            # took the request, then closes the connection without answering
+            self.server.hangups -= 1
+            self.close_connection = 1
+            return
+        body = self.server.reply
+        # in one write, so Nagle doesn't hold the body back
+        self.wfile.write('HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s'
+                         % (len(body), body))
+
+    def log_message(self, *args):
+        pass
+
+class LocalServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+class TransportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalServer(('127.0.0.1', 0), KeepAliveHandler)
+        self.server.clients = []
+        self.server.reply = 'ACK=Success'
+        self.server.resets = 0
+        self.server.hangups = 0
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.endpoint = 'http://127.0.0.1:%d/nvp' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_reused(self):
+        transport = HTTPTransport(self.endpoint, read_timeout=5)
+        self.assertEqual(transport.request('METHOD=A'), 'ACK=Success')
+        self.assertEqual(transport.request('METHOD=B'), 'ACK=Success')
+        transport.close()
+        self.assertEqual(self.server.clients[0], self.server.clients[1])
+
+    def test_idle_connection_evicted(self):
+        transport = HTTPTransport(self.endpoint, idle_timeout=-1)
+        transport.request('METHOD=A')
+        transport.request('METHOD=B')
+        transport.close()
+        self.assertNotEqual(self.server.clients[0], self.server.clients[1])
+
+    def test_dropped_idle_connection_retried(self):
+        transport = HTTPTransport(self.endpoint, read_timeout=5)
+        transport.request('METHOD=A')
+        transport._idle[0][1].sock.shutdown(socket.SHUT_RDWR)
+        self.assertEqual(transport.request('METHOD=B'), 'ACK=Success')
+        transport.close()
+        self.assertEqual(len(self.server.clients), 2)
+
+    def test_reset_after_request_not_retried(self):
+        transport = HTTPTransport(self.endpoint, read_timeout=5)
+        transport.request('METHOD=A')
+        self.server.resets = 1
+        self.assertRaises(socket.error, transport.request, 'METHOD=B')
+        transport.close()
+        self.assertEqual(len(self.server.clients), 2)
+
+    def test_hangup_after_request_not_retried(self):
+        transport = HTTPTransport(self.endpoint, read_timeout=5)
+        transport.request('METHOD=A')
+        self.server.hangups = 1
+        self.assertRaises(httplib.BadStatusLine, transport.request,
+                          'METHOD=DoDirectPayment&AMT=100')
+        transport.close()
+        self.assertEqual(len(self.server.clients), 2)
+
+    def test_payment_not_reposted_after_reset(self):
+        app = Flask(__name__)
+        app.config.update(TESTING=True, PAYMENT_API='PayPal',
+                PAYPAL_API_ENDPOINT=self.endpoint, PAYPAL_API_URL='url=',
+                PAYPAL_API_USER='user', PAYPAL_API_PWD='pwd',
+                PAYPAL_API_SIGNATURE='sig', PAYMENT_READ_TIMEOUT=5,
+                PAYMENT_RETRY_BACKOFF=0)
+        payments = Payments(app)
+        self.server.reply = 'TOKEN=EC%2d123&ACK=Success'
+        payments.setupRedirect(getValidWPPExpressTransaction())
+        self.server.resets = 1
+        self.assertRaises(socket.error, payments.authorise,
+                          getValidDirectTransaction())
+        self.assertEqual(len(self.server.clients), 2)
+        # where the safe methods are simply asked again
+        self.server.resets = 1
+        trans = payments.setupRedirect(getValidWPPExpressTransaction())
+        payments.gateway.transport.close()
+        self.assertEqual(trans.paypal_express_token, 'EC-123')
+        self.assertEqual(len(self.server.clients), 4)
+
+    def test_warm(self):
+        transport = HTTPTransport(self.endpoint, size=4, read_timeout=5)
+        self.assertEqual(transport.warm(3), 3)
+        self.assertEqual(transport.warm(3), 0)
+        warmed = [conn.sock.getsockname() for used, conn in transport._idle]
+        transport.request('METHOD=A')
+        transport.close()
+        self.assert_(self.server.clients[0] in warmed)
+
+    def test_prewarmed_in_background(self):
+        app = Flask(__name__)
+        app.config.update(TESTING=True, PAYMENT_API='PayPal',
+                PAYPAL_API_ENDPOINT=self.endpoint, PAYPAL_API_URL='url=',
+                PAYPAL_API_USER='user', PAYPAL_API_PWD='pwd',
+                PAYPAL_API_SIGNATURE='sig', PAYMENT_PREWARM=2)
+        payments = Payments(app)
+        for i in range(100):
+            if payments.gateway_health.warmed == 2:
+                break
+            time.sleep(0.02)
+        self.assertEqual(payments.health()['warmed'], 2)
+        self.assert_(payments.health()['ready'])
+        payments.gateway.transport.close()
+
+class AsyncTransportTestCase(TransportTestCase):
+
+    def test_many_requests_in_flight(self):
+        transport = AsyncHTTPTransport(self.endpoint, size=50, read_timeout=5)
+        futures = [transport.request_async('N=%d' % i) for i in range(200)]
+        results = [future.result(10) for future in futures]
+        transport.close()
+        self.assertEqual(results, ['ACK=Success'] * 200)
+        self.assert_(len(set(self.server.clients)) <= 50)
+
+    def test_async_reset_after_request_not_retried(self):
+        transport = AsyncHTTPTransport(self.endpoint, size=1, read_timeout=5)
+        transport.request_async('METHOD=A').result(5)
+        self.server.resets = 1
+        future = transport.request_async('METHOD=B')
+        self.assert_(isinstance(future.exception(5), socket.error))
+        transport.close()
+        self.assertEqual(len(self.server.clients), 2)
+
+    def test_async_hangup_after_request_not_retried(self):
+        transport = AsyncHTTPTransport(self.endpoint, size=1, read_timeout=5)
+        transport.request_async('METHOD=A').result(5)
+        self.server.hangups = 1
+        future = transport.request_async('METHOD=DoDirectPayment&AMT=100')
+        self.assert_(isinstance(future.exception(5), socket.error))
+        transport.close()
+        self.assertEqual(len(self.server.clients), 2)
+
+    def test_connection_refused(self):
+        unused = socket.socket()
+        unused.bind(('127.0.0.1', 0))
+        endpoint = 'http://127.0.0.1:%d/nvp' % unused.getsockname()[1]
+        unused.close()
+        transport = AsyncHTTPTransport(endpoint)
+        future = transport.request_async('METHOD=A')
+        self.assert_(isinstance(future.exception(5), socket.error))
+        transport.close()
+
+    def test_async_payments(self):
+        self.server.reply = 'TOKEN=EC%2d123&ACK=Success'
+        app = Flask(__name__)
+        app.config.update(TESTING=True, PAYMENT_API='PayPal',
+                PAYPAL_API_ENDPOINT=self.endpoint, PAYPAL_API_URL='url=',
+                PAYPAL_API_USER='user', PAYPAL_API_PWD='pwd',
+                PAYPAL_API_SIGNATURE='sig')
+        payments = AsyncPayments(app)
+        future = payments.setupRedirect(getValidWPPExpressTransaction())
+        trans = future.result(5)
+        payments.gateway.transport.close()
+        self.assertEqual(trans.redirect_url, 'url=EC-123')
+
+    def test_async_limiter_waited_on_elsewhere(self):
+        self.server.reply = 'TOKEN=EC%2d123&ACK=Success'
+        directory = tempfile.mkdtemp()
+        app = Flask(__name__)
+        app.config.update(TESTING=True, PAYMENT_API='PayPal',
+                PAYPAL_API_ENDPOINT=self.endpoint, PAYPAL_API_URL='url=',
+                PAYPAL_API_USER='user', PAYPAL_API_PWD='pwd',
+                PAYPAL_API_SIGNATURE='sig',
+                PAYMENT_LIMITER={'initial': 1, 'minimum': 1, 'maximum': 1,
+                                 'path': os.path.join(directory, 'limit')})
+        payments = AsyncPayments(app)
+        limiter = payments.gateway.limiter
+        try:
+            limiter.acquire() # the only place
+            started = time.time()
+            future = payments.setupRedirect(getValidWPPExpressTransaction())
+            self.assert_(time.time() - started < 0.05)
+            time.sleep(0.05)
+            self.assertFalse(future.done())
+            released = []
+            release = limiter.release
+            def recorded(duration, congested=False):
+                released.append(threading.current_thread().name)
+                release(duration, congested)
+            limiter.release(0)
+            limiter.release = recorded
+            self.assertEqual(future.result(5).redirect_url, 'url=EC-123')
+            self.assertEqual(released, ['payments-async'])
+        finally:
+            payments.gateway.transport.close()
+            shutil.rmtree(directory)
+
+try:
+    import gevent, gevent.pool
+except ImportError:
+    gevent = None
+
+class GreenTransportTestCase(TransportTestCase):
+
+    def paypal(self, payments_class=Payments, **config):
+        app = Flask(__name__)
+        app.config.update(TESTING=True, PAYMENT_API='PayPal',
+                PAYPAL_API_ENDPOINT=self.endpoint, PAYPAL_API_URL='url=',
+                PAYPAL_API_USER='user', PAYPAL_API_PWD='pwd',
+                PAYPAL_API_SIGNATURE='sig', **config)
+        return payments_class(app)
+
+    def test_unknown_mode(self):
+        self.assertRaises(PaymentsConfigurationError, self.paypal,
+                          PAYMENT_IO_MODE='fibers')
+        self.assertRaises(PaymentsConfigurationError, self.paypal,
+                          AsyncPayments, PAYMENT_IO_MODE='gevent')
+
+    @unittest.skipIf(gevent is None, 'gevent is not installed')
+    def test_many_greenlets_in_flight(self):
+        self.server.reply = 'TOKEN=EC%2d123&ACK=Success'
+        payments = self.paypal(PAYMENT_IO_MODE='gevent', PAYMENT_POOL_SIZE=50,
+                               PAYMENT_READ_TIMEOUT=5)
+        pool = gevent.pool.Pool(200)
+        trans = pool.map(lambda i: payments.setupRedirect(
+                getValidWPPExpressTransaction()), range(200))
+        payments.gateway.transport.close()
+        self.assertEqual(set(t.redirect_url for t in trans), set(['url=EC-123']))
+        self.assert_(len(set(self.server.clients)) <= 50)
+
+class GatewayTransportTestCase(OfflinePayPalTestCase):
+
+    def test_api_methods_use_transport(self):
+        self.respond('TOKEN=EC%2d123&ACK=Success')
+        trans = self.payments.setupRedirect(getValidWPPExpressTransaction())
+        self.assertEqual(trans.paypal_express_token, 'EC-123')
+        self.assert_('METHOD=SetExpressCheckout' in self.transport.sent[0])
+
+    def test_pool_configured_from_app(self):
+        self.app.config['PAYMENT_POOL_SIZE'] = 9
+        self.app.config['PAYMENT_READ_TIMEOUT'] = 2.5
+        transport = Payments(self.app).gateway.transport
+        self.assertEqual(transport.size, 9)
+        self.assertEqual(transport.read_timeout, 2.5)
+
+class NVPParsingTestCase(unittest.TestCase):
+
+    RAW = ('ACK=Failure&CORRELATIONID=abc%3D%3D&L_ERRORCODE0=10002'
+           '&L_SHORTMESSAGE0=Security%20error&L_ERRORCODE1=10001'
+           '&L_SHORTMESSAGE1=Internal%20Error&NOTE=a=b')
+
+    def test_values_unquoted(self):
+        response = NVPResponse(self.RAW)
+        self.assertEqual(response['CORRELATIONID'], 'abc==')
+        self.assertEqual(response['NOTE'], 'a=b')
+        self.assertEqual(len(response), 7)
+
+    def test_indexed_lists(self):
+        self.assertEqual(NVPResponse(self.RAW).lists(), [
+            {'ERRORCODE': '10002', 'SHORTMESSAGE': 'Security error'},
+            {'ERRORCODE': '10001', 'SHORTMESSAGE': 'Internal Error'}])
+
+    def test_fast_path(self):
+        self.assertEqual(nvp_fields(self.RAW, 'ACK', 'NOTE', 'TOKEN'),
+                         {'ACK': 'Failure', 'NOTE': 'a=b'})
+        self.assertEqual(nvp_fields('TOKEN=EC%2d1', 'TOKEN'),
+                         {'TOKEN': 'EC-1'})
+
+class NVPTemplateTestCase(OfflinePayPalTestCase):
+
+    def test_same_as_urlencode(self):
+        template = NVPTemplate('USER=u%40x&', {'METHOD': 'X',
+                'B': 'a b&c=d', 'A': None, 'Z%': 100, 'C': None}, 'C', 'A')
+        self.assertEqual(template.encode('http://example.com/?a=1&b=2', '50%'),
+                         'USER=u%40x&' + urllib.urlencode({'METHOD': 'X',
+                         'B': 'a b&c=d', 'A': '50%', 'Z%': 100,
+                         'C': 'http://example.com/?a=1&b=2'}))
+
+    def test_gateway_requests_unchanged(self):
+        self.respond('TOKEN=EC%2d1&ACK=Success')
+        self.payments.gateway.SetExpressCheckout(100, 'http://a/?b=c',
+                                                 'http://d/')
+        self.assertEqual(self.transport.sent[0],
+            self.payments.gateway.signature + urllib.urlencode({
+                'METHOD' : "SetExpressCheckout",
+                'NOSHIPPING' : 1,
+                'PAYMENTACTION' : 'Authorization',
+                'RETURNURL' : 'http://a/?b=c',
+                'CANCELURL' : 'http://d/', 
+                'AMT' : 100,
+            }))
+
+class DirectPaymentTestCase(OfflinePayPalTestCase):
+
+    def test_direct_authorise(self):
+        self.respond('ACK=Success&TRANSACTIONID=tx1&AMT=100%2e00')
+        trans = self.payments.authorise(getValidDirectTransaction())
+        self.assert_(trans.authorised)
+        self.assertEqual(trans._raw['TRANSACTIONID'], 'tx1')
+        self.assert_('METHOD=DoDirectPayment' in self.transport.sent[0])
+
+    def test_direct_declined(self):
+        self.respond('ACK=Failure&L_ERRORCODE0=10417')
+        trans = self.payments.authorise(getValidDirectTransaction())
+        self.assertFalse(trans.authorised)
+        self.assertEqual(trans._raw['L_ERRORCODE0'], '10417')
+
+class BatchLookupTestCase(OfflinePayPalTestCase):
+
+    def test_results_streamed_with_errors(self):
+        self.payments.gateway.transport = EchoTransport()
+        ids = ['tx%d' % i for i in range(50)] + ['bad1']
+        results = dict((r.key, r) for r in
+                self.payments.get_transaction_details_many(ids, concurrency=5))
+        self.assertEqual(sorted(results), sorted(ids))
+        self.assertEqual(results['tx7'].result['TRANSACTIONID'], 'tx7')
+        self.assert_(not results['bad1'].ok)
+        self.assert_(isinstance(results['bad1'].error, socket.error))
+
+    def test_rate_limited(self):
+        self.payments.gateway.transport = EchoTransport()
+        started = time.time()
+        list(self.payments.get_transaction_details_many(
+                ['tx%d' % i for i in range(11)], concurrency=4, rate=100))
+        self.assert_(time.time() - started >= 0.09)
+
+    def test_rate_limiter_bursts(self):
+        limiter = RateLimiter(10, burst=5)
+        started = time.time()
+        for i in range(5):
+            limiter.acquire()
+        self.assert_(time.time() - started < 0.05)
+
+class DetailsCacheTestCase(OfflinePayPalTestCase):
+    PAYMENT_DETAILS_CACHE = 'memory'
+
+    COMPLETED = 'ACK=Success&TRANSACTIONID=tx1&PAYMENTSTATUS=Completed'
+
+    def test_repeat_lookups_cached(self):
+        self.respond(self.COMPLETED)
+        gateway = self.payments.gateway
+        self.assertEqual(gateway.GetTransactionDetails('tx1')['ACK'], 'Success')
+        self.assertEqual(gateway.GetTransactionDetails('tx1')['ACK'], 'Success')
+        self.assertEqual(len(self.transport.sent), 1)
+        self.assertEqual((gateway.details_cache.hits,
+                          gateway.details_cache.misses), (1, 1))
+
+    def test_failures_not_cached(self):
+        self.respond('ACK=Failure', self.COMPLETED)
+        gateway = self.payments.gateway
+        gateway.GetTransactionDetails('tx1')
+        self.assertEqual(gateway.GetTransactionDetails('tx1')['ACK'], 'Success')
+
+    def test_authorise_invalidates(self):
+        self.respond(self.COMPLETED, 'ACK=Success&TRANSACTIONID=tx1',
+                     self.COMPLETED)
+        self.payments.gateway.GetTransactionDetails('tx1')
+        trans = getValidWPPExpressTransaction()
+        trans.paypal_express_token = 'EC-1'
+        trans.pay_id = 'payer'
+        self.payments.authorise(trans)
+        self.payments.gateway.GetTransactionDetails('tx1')
+        self.assertEqual(len(self.transport.sent), 3)
+
+    def test_least_recently_used_evicted(self):
+        cache = MemoryCache(size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')),
+                         (1, None, 3))
+
+import pickle
+class TransactionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.trans = getValidWPPExpressTransaction()
+        self.trans.paypal_express_token = 'EC-123'
+        self.trans._raw = NVPResponse('ACK=Success&TRANSACTIONID=tx1')
+
+    def test_gateway_fields_kept_as_extensions(self):
+        self.assertEqual(self.trans.extensions, {'paypal_express_token': 'EC-123'})
+        self.assertEqual(self.trans.paypal_express_token, 'EC-123')
+        self.assert_(not hasattr(self.trans, '__dict__'))
+        self.assertRaises(AttributeError, getattr, self.trans, 'pay_token')
+
+    def test_bytes_round_trip(self):
+        data = self.trans.to_bytes()
+        trans = Transaction.from_bytes(data)
+        self.assertEqual(trans.items(), self.trans.items())
+        self.assertEqual(trans._raw, None)
+        trans = Transaction.from_bytes(self.trans.to_bytes(include_raw=True))
+        self.assertEqual(trans._raw['TRANSACTIONID'], 'tx1')
+        self.assert_(len(data) < len(pickle.dumps(self.trans)))
+
+    def test_card_details_left_out(self):
+        data = getValidDirectTransaction().to_bytes(include_card=False)
+        trans = Transaction.from_bytes(data)
+        self.assertEqual(trans.firstname, 'Test')
+        self.assert_('4111' not in data and not trans.holds_card())
+
+    def test_unknown_version(self):
+        self.assertRaises(ValueError, Transaction.from_bytes, '\x09[]')
+
+    def test_pickles(self):
+        trans = pickle.loads(pickle.dumps(self.trans))
+        self.assertEqual(trans.paypal_express_token, 'EC-123')
+
+class InstrumentationTestCase(OfflinePayPalTestCase):
+    PAYMENT_METRICS = True
+
+    def test_latency_histograms(self):
+        self.respond('TOKEN=EC%2d1&ACK=Success', 'ACK=Failure')
+        trans = self.payments.setupRedirect(getValidWPPExpressTransaction())
+        trans.pay_id = 'payer'
+        self.payments.authorise(trans)
+        metrics = self.payments.metrics.snapshot()
+        self.assertEqual(sorted(metrics), ['DoExpressCheckoutPayment',
+                'SetExpressCheckout', 'authorise', 'setupRedirect'])
+        self.assertEqual(metrics['authorise']['count'], 1)
+        self.assertEqual(metrics['authorise']['p99'], 0.005)
+
+    @unittest.skipUnless(signals_available, 'needs blinker')
+    def test_signals(self):
+        calls, operations = [], []
+        def on_call(sender, **kwargs):
+            calls.append(kwargs)
+        def on_operation(sender, **kwargs):
+            operations.append(kwargs)
+        self.respond('TOKEN=EC%2d1&ACK=Success')
+        with gateway_call.connected_to(on_call):
+            with payment_operation.connected_to(on_operation):
+                self.payments.setupRedirect(getValidWPPExpressTransaction())
+        self.assertEqual(calls[0]['method'], 'SetExpressCheckout')
+        self.assertEqual(calls[0]['ack'], 'Success')
+        self.assertEqual(calls[0]['received'], 24)
+        self.assertEqual(calls[0]['error'], None)
+        self.assertEqual(operations[0]['operation'], 'setupRedirect')
+
+class ResilienceTestCase(OfflinePayPalTestCase):
+    PAYMENT_RETRY_BACKOFF = 0
+
+    def test_safe_methods_retried(self):
+        self.respond(socket.error('reset'), socket.timeout('timed out'),
+                     'TOKEN=EC%2d1&ACK=Success')
+        trans = self.payments.setupRedirect(getValidWPPExpressTransaction())
+        self.assertEqual(trans.paypal_express_token, 'EC-1')
+        self.assertEqual(len(self.transport.sent), 3)
+
+    def test_payments_not_retried(self):
+        self.respond(socket.error('reset'), 'ACK=Success')
+        trans = getValidWPPExpressTransaction()
+        trans.pay_id = 'payer'
+        trans.paypal_express_token = 'EC-1'
+        self.assertRaises(socket.error, self.payments.authorise, trans)
+        self.assertEqual(len(self.transport.sent), 1)
+
+    def test_deadline(self):
+        self.respond('TOKEN=EC%2d1&ACK=Success')
+        with budget(1):
+            with budget(0.01):
+                time.sleep(0.02)
+                self.assertRaises(PaymentsErrorFromGateway,
+                    self.payments.setupRedirect,
+                    getValidWPPExpressTransaction())
+        self.assertEqual(self.transport.sent, [])
+
+    def test_circuit_breaker(self):
+        gateway = self.payments.gateway
+        gateway.breaker = CircuitBreaker(window=4, min_calls=4, cooldown=0.05)
+        gateway.retries = 0
+        self.respond(*[socket.error('reset')] * 4 + ['TOKEN=EC%2d1&ACK=Success'])
+        for i in range(4):
+            self.assertRaises(socket.error, self.payments.setupRedirect,
+                              getValidWPPExpressTransaction())
+        self.assertEqual(gateway.breaker.state, 'open')
+        self.assertRaises(PaymentsErrorFromGateway, self.payments.setupRedirect,
+                          getValidWPPExpressTransaction())
+        self.assertEqual(len(self.transport.sent), 4)
+        time.sleep(0.06)
+        self.payments.setupRedirect(getValidWPPExpressTransaction())
+        self.assertEqual(gateway.breaker.state, 'closed')
+
+class SlowTransport(FakeTransport):
+
+    def request(self, body):
+        time.sleep(0.05)
+        return FakeTransport.request(self, body)
+
+class SingleFlightTestCase(OfflinePayPalTestCase):
+
+    def express(self):
+        trans = getValidWPPExpressTransaction()
+        trans.pay_id = 'payer'
+        trans.paypal_express_token = 'EC-1'
+        return trans
+
+    def test_concurrent_authorise_coalesced(self):
+        self.payments.gateway.transport = transport = SlowTransport(
+                'ACK=Success&TRANSACTIONID=tx1')
+        results = []
+        def pay():
+            results.append(self.payments.authorise(self.express()))
+        threads = [threading.Thread(target=pay) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(transport.sent), 1)
+        self.assertEqual([trans.authorised for trans in results], [True] * 5)
+        self.assertEqual(len(set(map(id, results))), 5)
+
+    def test_repeat_answered_from_store(self):
+        self.respond('ACK=Success&TRANSACTIONID=tx1')
+        self.payments.authorise(self.express())
+        trans = self.payments.authorise(self.express())
+        self.assertEqual(trans._raw['TRANSACTIONID'], 'tx1')
+        self.assertEqual(len(self.transport.sent), 1)
+
+    def test_store_looked_in_outside_lock(self):
+        flights = self.payments.flights
+        looked = []
+        get = flights.backend.get
+        def slow_get(key):
+            looked.append(flights._lock.locked())
+            time.sleep(0.05)
+            return get(key)
+        flights.backend.get = slow_get
+        self.payments.gateway.transport = transport = SlowTransport(
+                'ACK=Success&TRANSACTIONID=tx1')
+        threads = [threading.Thread(target=self.payments.authorise,
+                                    args=(self.express(),)) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(looked, [False])
+        self.assertEqual(len(transport.sent), 1)
+        self.assert_(self.payments.authorise(self.express()).authorised)
+        self.assertEqual(looked, [False, False])
+        self.assertEqual(len(transport.sent), 1)
+
+    def test_failures_not_kept(self):
+        self.respond(socket.error('reset'), 'ACK=Success&TRANSACTIONID=tx1')
+        self.assertRaises(socket.error, self.payments.authorise,
+                          self.express())
+        self.assert_(self.payments.authorise(self.express()).authorised)
+
+    def test_declines_not_kept(self):
+        self.respond('ACK=Failure&L_ERRORCODE0=10486',
+                     'ACK=Success&TRANSACTIONID=tx1')
+        self.assertFalse(self.payments.authorise(self.express()).authorised)
+        self.assert_(self.payments.authorise(self.express()).authorised)
+        self.assertEqual(len(self.transport.sent), 2)
+
+    def test_card_details_not_kept(self):
+        self.respond('ACK=Success&TRANSACTIONID=tx1')
+        self.payments.authorise(getValidDirectTransaction(),
+                                idempotency_key='order-1')
+        trans = self.payments.authorise(getValidDirectTransaction(),
+                                        idempotency_key='order-1')
+        self.assertEqual(trans._raw['TRANSACTIONID'], 'tx1')
+        self.assertFalse(trans.holds_card())
+
+    def test_idempotency_key(self):
+        self.respond('ACK=Success&TRANSACTIONID=tx1',
+                     'ACK=Success&TRANSACTIONID=tx2')
+        trans = getValidDirectTransaction()
+        self.payments.authorise(trans, idempotency_key='order-1')
+        self.payments.authorise(trans, idempotency_key='order-1')
+        self.payments.authorise(trans, idempotency_key='order-2')
+        self.assertEqual(len(self.transport.sent), 2)
+
+class GatewayRegistryTestCase(unittest.TestCase):
+
+    def test_imported_only_when_loaded(self):
+        registry = GatewayRegistry('flaskext.payments.test-gateways')
+        registry.register('Missing', 'flaskext.no_such_gateway:Gateway')
+        registry.register('Echo', 'tests:EchoTransport')
+        self.assertEqual(registry.names(), ['Echo', 'Missing'])
+        self.assert_(registry.load('Echo') is EchoTransport)
+        self.assertRaises(ImportError, registry.load, 'Missing')
+
+    def test_unknown_gateway(self):
+        app = Flask(__name__)
+        app.config['PAYMENT_API'] = 'Cheque'
+        try:
+            Payments(app)
+        except PaymentsConfigurationError, e:
+            self.assert_("'Cheque' isn't a known gateway" in str(e))
+            self.assert_('PayPal' in str(e))
+        else:
+            self.fail('no error for an unknown gateway')
+
+    def test_config_schema(self):
+        schema = {'KEY': (basestring, True), 'SIZE': (int, False)}
+        check_config({'KEY': 'k', 'SIZE': None}, schema, 'Test')
+        self.assertRaises(PaymentsConfigurationError, check_config,
+                          {'SIZE': 1}, schema, 'Test')
+        try:
+            check_config({'KEY': 'k', 'SIZE': '8'}, schema, 'Test')
+        except PaymentsConfigurationError, e:
+            self.assertEqual(str(e), "SIZE should be int, not '8'")
+        else:
+            self.fail('no error for a setting of the wrong type')
+
+class CheckoutStoreTestCase(OfflinePayPalTestCase):
+
+    def test_save_and_resume(self):
+        self.respond('TOKEN=EC%2d1&ACK=Success')
+        trans = self.payments.setupRedirect(getValidWPPExpressTransaction())
+        token = self.payments.save_checkout(trans)
+        self.assertEqual(token, 'EC-1')
+        resumed = self.payments.resume_checkout(token)
+        self.assertEqual(resumed.paypal_express_token, 'EC-1')
+        self.assertEqual(resumed.amount, 100)
+        self.payments.forget_checkout(token)
+        self.assertEqual(self.payments.resume_checkout(token), None)
+
+    def test_needs_token(self):
+        self.assertRaises(PaymentsValidationError, self.payments.save_checkout,
+                          getValidWPPExpressTransaction())
+
+    def test_sqlite(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'checkouts.db')
+            cache = SQLiteCache(path)
+            cache.set('a', '\x01\x00b', 60)
+            cache.set('expired', 'b', -1)
+            self.assertEqual(SQLiteCache(path).get('a'), '\x01\x00b')
+            self.assertEqual(cache.get('expired'), None)
+            cache.delete('a')
+            self.assertEqual(cache.get('a'), None)
+        finally:
+            shutil.rmtree(directory)
+
+class DeferredCaptureTestCase(OfflinePayPalTestCase):
+    PAYMENT_DEFERRED_CAPTURE = True
+
+    def test_authorise_deferred(self):
+        self.respond('ACK=Success&TRANSACTIONID=tx1')
+        finished = []
+        self.payments.on_capture(lambda capture_id, status:
+                                 finished.append((capture_id, status.state)))
+        trans = getValidWPPExpressTransaction()
+        trans.pay_id = 'payer'
+        trans.paypal_express_token = 'EC-1'
+        trans = self.payments.authorise(trans)
+        self.assertEqual(trans.capture_id, 'EC-1')
+        self.assert_(self.payments.captures.join(5))
+        status = self.payments.status('EC-1')
+        self.assertEqual(status.state, 'authorised')
+        self.assertEqual(status.transaction._raw['TRANSACTIONID'], 'tx1')
+        self.assertEqual(finished, [('EC-1', 'authorised')])
+
+    def test_declined(self):
+        self.respond('ACK=Failure&L_ERRORCODE0=10417')
+        trans = self.payments.authorise(getValidDirectTransaction())
+        self.assert_(self.payments.captures.join(5))
+        status = self.payments.status(trans.capture_id)
+        self.assertEqual(status.state, 'declined')
+        self.assertFalse(status.transaction.authorised)
+
+    def test_card_details_not_journalled(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'captures.db')
+            queue = CaptureQueue(None, workers=0, path=path)
+            capture_id = queue.submit(getValidDirectTransaction())
+            self.assertEqual(CaptureQueue(None, workers=0,
+                                          path=path).status(capture_id), None)
+            queue = CaptureQueue(lambda trans, key: trans, workers=1,
+                                 path=path)
+            capture_id = queue.submit(getValidDirectTransaction())
+            self.assert_(queue.join(5))
+            trans = CaptureQueue(None, workers=0,
+                                 path=path).status(capture_id).transaction
+            self.assertEqual(trans.amount, 100)
+            self.assertFalse(trans.holds_card())
+            with open(path, 'rb') as journal:
+                self.assert_('4111111111111111' not in journal.read())
+        finally:
+            shutil.rmtree(directory)
+
+    def test_running_not_run_again_after_restart(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'captures.db')
+            queue = CaptureQueue(None, workers=0, path=path)
+            capture_id = queue.submit(getValidWPPExpressTransaction())
+            queue._journal.save(capture_id, None, 'running',
+                                getValidWPPExpressTransaction().to_bytes(),
+                                None)
+            captured = []
+            queue = CaptureQueue(lambda trans, key: captured.append(trans),
+                                 workers=1, path=path)
+            self.assert_(queue.join(5))
+            self.assertEqual(captured, [])
+            status = queue.status(capture_id)
+            self.assertEqual(status.state, 'unknown')
+            self.assert_(status.done)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_join_times_out(self):
+        queue = CaptureQueue(lambda trans, key: trans, workers=0)
+        queue.submit(Transaction())
+        self.assertEqual(queue.join(0.2), False)
+
+    def test_back_pressure(self):
+        queue = CaptureQueue(lambda trans, key: trans, workers=0, depth=1)
+        queue.submit(Transaction())
+        self.assertRaises(PaymentsQueueFull, queue.submit, Transaction())
+
+    def test_pending_survive_restart(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'captures.db')
+            queue = CaptureQueue(None, workers=0, path=path)
+            capture_id = queue.submit(getValidWPPExpressTransaction())
+            def capture(trans, key):
+                trans.authorised = True
+                return trans
+            queue = CaptureQueue(capture, workers=1, path=path)
+            self.assert_(queue.join(5))
+            status = queue.status(capture_id)
+            self.assertEqual(status.state, 'authorised')
+            self.assertEqual(status.transaction.amount, 100)
+        finally:
+            shutil.rmtree(directory)
+
+class SimulatedGatewayTestCase(PaymentsTestCase):
+    PAYMENT_API = 'Simulated'
+    PAYMENT_RETRY_BACKOFF = 0
+
+    def loadPrivateConfig(self):
+        pass
+
+    def test_express_flow(self):
+        trans = self.payments.setupRedirect(getValidWPPExpressTransaction())
+        self.assert_(trans.paypal_express_token.startswith('EC-'))
+        trans.pay_id = 'payer'
+        trans = self.payments.authorise(trans)
+        self.assert_(trans.authorised)
+        self.assertEqual(trans._raw['PAYMENTSTATUS'], 'Completed')
+
+    def test_injected_errors(self):
+        gateway = self.payments.gateway
+        gateway.transport = SimulatedTransport(errors={'10417': 1.0})
+        response = gateway.DoDirectPayment(*['1'] * 12)
+        self.assertEqual(response['ACK'], 'Failure')
+        self.assertEqual(response['L_ERRORCODE0'], '10417')
+        gateway.transport = SimulatedTransport(errors={'reset': 1.0})
+        self.assertRaises(socket.error, gateway.SetExpressCheckout,
+                          100, 'http://a/', 'http://b/')
+        self.assertEqual(gateway.transport.calls, 3) # retried twice
+
+    def test_health(self):
+        health = self.payments.health()
+        self.assert_(health['ready'])
+        self.assert_(health['latency'] >= 0)
+        self.payments.gateway.transport = SimulatedTransport(
+                errors={'timeout': 1.0})
+        self.assert_(self.payments.health()['ready']) # not old enough
+        health = self.payments.health(max_age=0)
+        self.assertEqual((health['ready'], health['error']),
+                         (False, 'timeout: timed out'))
+
+class AdaptiveLimiterTestCase(unittest.TestCase):
+
+    def test_concurrency_limit(self):
+        limiter = AdaptiveLimiter(initial=2)
+        limiter.acquire()
+        limiter.acquire()
+        self.assertRaises(PaymentsErrorFromGateway, limiter.acquire,
+                          time.time() + 0.02)
+        limiter.release(0.01)
+        limiter.acquire(time.time() + 0.02)
+
+    def test_aimd(self):
+        limiter = AdaptiveLimiter(initial=10, latency_target=0.5)
+        for i in range(10):
+            limiter.acquire()
+            limiter.release(0.01)
+        self.assertEqual(limiter.limit, 10) # 10.9 or so
+        for i in range(5):
+            limiter.acquire()
+            limiter.release(0.01)
+        self.assertEqual(limiter.limit, 11)
+        limiter.acquire()
+        limiter.release(1.0) # too slow
+        self.assertEqual(limiter.limit, 5)
+
+    def test_rate(self):
+        limiter = AdaptiveLimiter(rate=100)
+        started = time.time()
+        for i in range(6):
+            limiter.acquire()
+            limiter.release(0)
+        self.assert_(time.time() - started >= 0.045)
+
+    def test_shared_between_processes(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'limit')
+            first = AdaptiveLimiter(initial=2, path=path)
+            second = AdaptiveLimiter(initial=2, path=path)
+            first.acquire()
+            second.acquire()
+            self.assertRaises(PaymentsErrorFromGateway, first.acquire,
+                              time.time() + 0.02)
+            state = json.load(open(path))
+            state['flight'] = {'999999999': 2} # died holding two
+            json.dump(state, open(path, 'w'))
+            first.acquire(time.time() + 0.02)
+        finally:
+            shutil.rmtree(directory)
+
+class GatewayLimiterTestCase(OfflinePayPalTestCase):
+    PAYMENT_LIMITER = {'initial': 8}
+    PAYMENT_METRICS = True
+
+    def test_throttling_backs_off(self):
+        self.respond('ACK=Failure&L_ERRORCODE0=10001')
+        self.payments.gateway.GetTransactionDetails('tx1')
+        self.assertEqual(self.payments.gateway.limiter.limit, 4)
+        self.assertEqual(self.payments.metrics.snapshot()['limiter-wait']
+                         ['count'], 1)
+
+class SettleManyTestCase(OfflinePayPalTestCase):
+
+    def setUp(self):
+        OfflinePayPalTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.directory, 'dispatch.ckpt')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        OfflinePayPalTestCase.tearDown(self)
+
+    def test_void_many(self):
+        self.payments.gateway.transport = EchoVoidTransport()
+        results = dict((result.key, result) for result in
+                       self.payments.void_many(['A1', 'A2', 'bad']))
+        self.assertEqual(results['A1'].result['AUTHORIZATIONID'], 'A1')
+        self.assert_(isinstance(results['bad'].error, socket.error))
+
+    def test_resumes_without_capturing_twice(self):
+        self.payments.gateway.transport = transport = EchoVoidTransport()
+        items = [('A1', '10.00'), ('bad', '5.00'), ('A3', '1.00')]
+        list(self.payments.capture_many(items, checkpoint=self.checkpoint))
+        self.assertEqual(len(transport.sent), 3)
+        # the capture of 'bad' went through though we didn't hear back
+        transport.open = False
+        results = dict((result.key, result) for result in
+                       self.payments.capture_many(items,
+                                                  checkpoint=self.checkpoint))
+        self.assertEqual(results['A1'].result['AUTHORIZATIONID'], 'A1')
+        self.assertEqual(results['bad'].result, None)
+        methods = [dict(urlparse.parse_qsl(body))['METHOD']
+                   for body in transport.sent[3:]]
+        self.assertEqual(methods, ['GetTransactionDetails'])
+
+    def test_unknown_authorisation_left_started(self):
+        self.payments.gateway.transport = transport = EchoVoidTransport()
+        items = [('bad', '5.00')]
+        list(self.payments.capture_many(items, checkpoint=self.checkpoint))
+        transport.open = None
+        result, = self.payments.capture_many(items,
+                                             checkpoint=self.checkpoint)
+        self.assert_(isinstance(result.error, PaymentsErrorFromGateway))
+        self.assertEqual(BatchCheckpoint(self.checkpoint).get('bad')[0],
+                         'started')
+
+class EchoVoidTransport(object):
+    """ Answers DoCapture and DoVoid with the authorisation they were for,
+    and GetTransactionDetails as open or not, or failing if open is None,
+    failing for 'bad'
+    """
+    open = True
+
+    def __init__(self):
+        self.sent = []
+
+    def request(self, body):
+        self.sent.append(body)
+        params = dict(urlparse.parse_qsl(body))
+        if params['METHOD'] == 'GetTransactionDetails':
+            if self.open is None:
+                return 'ACK=Failure&L_ERRORCODE0=10001'
+            if self.open:
+                return 'ACK=Success&PAYMENTSTATUS=Pending' \
+                       '&PENDINGREASON=authorization'
+            return 'ACK=Success&PAYMENTSTATUS=Completed'
+        if params['AUTHORIZATIONID'] == 'bad':
+            raise socket.error('connection reset')
+        return 'ACK=Success&AUTHORIZATIONID=' + params['AUTHORIZATIONID']
+
+class SearchTransport(object):
+    """ Answers TransactionSearch with a transaction an hour, newest first,
+    truncating at `limit` as PayPal does at 100
+    """
+    def __init__(self, limit=3):
+        self.limit = limit
+        self.searches = []
+
+    def request(self, body):
+        params = dict(urlparse.parse_qsl(body))
+        parse = lambda value: datetime.datetime.strptime(value,
+                                                         '%Y-%m-%dT%H:%M:%SZ')
+        start, end = parse(params['STARTDATE']), parse(params['ENDDATE'])
+        self.searches.append((start, end, params.get('STATUS')))
+        hours = [hour for hour in range(48)
+                 if start <= datetime.datetime(2010, 6, 1) +
+                             datetime.timedelta(hours=hour) <= end]
+        fields = [('ACK', 'Success')]
+        if len(hours) > self.limit:
+            hours = hours[len(hours) - self.limit:]
+            fields = [('ACK', 'SuccessWithWarning'), ('L_ERRORCODE0', '11002')]
+        for index, hour in enumerate(reversed(hours)):
+            fields += [('L_TRANSACTIONID%d' % index, 'tx%02d' % hour),
+                       ('L_AMT%d' % index, '1.00')]
+        return urllib.urlencode(fields)
+
+class TransactionSearchTestCase(OfflinePayPalTestCase):
+    START = datetime.datetime(2010, 6, 1)
+    END = datetime.datetime(2010, 6, 3)
+
+    def test_windows_split_until_complete(self):
+        self.payments.gateway.transport = transport = SearchTransport()
+        ids = [record['TRANSACTIONID'] for record in
+               self.payments.iter_transactions(self.START, self.END,
+                                               STATUS='Success')]
+        self.assertEqual(ids, ['tx%02d' % hour for hour in range(48)])
+        self.assert_(len(transport.searches) > 2)
+        self.assertEqual(set(search[2] for search in transport.searches),
+                         set(['Success']))
+
+    def test_truncated_second_raises(self):
+        self.payments.gateway.transport = SearchTransport(limit=0)
+        self.assertRaises(PaymentsErrorFromGateway, list,
+                self.payments.iter_transactions(self.START,
+                        self.START + datetime.timedelta(hours=1)))
+
+    def test_export(self):
+        self.payments.gateway.transport = SearchTransport()
+        out = StringIO.StringIO()
+        count = self.payments.export_transactions(out, self.START,
+                self.START + datetime.timedelta(hours=2), format='jsonl')
+        self.assertEqual(count, 2)
+        self.assertEqual(json.loads(out.getvalue().splitlines()[1]),
+                         {'TRANSACTIONID': 'tx01', 'AMT': '1.00'})
+        out = StringIO.StringIO()
+        self.payments.export_transactions(out, self.START,
+                self.START + datetime.timedelta(hours=1))
+        self.assertEqual(out.getvalue().splitlines()[1],
+                         ',,,,,tx00,,1.00,,,')
+
+class ValidationTestCase(OfflinePayPalTestCase):
+
+    def test_invalid_never_sent(self):
+        self.respond()
+        trans = getValidDirectTransaction()
+        trans.acct = '4111111111111112'
+        trans.expdate = '132030'
+        del trans.extensions['city']
+        try:
+            self.payments.authorise(trans)
+        except PaymentsValidationError, e:
+            self.assertEqual(e.errors, {'acct': 'fails the Luhn check',
+                'expdate': 'should be the expiry date as MMYYYY',
+                'city': 'is required'})
+        else:
+            self.fail('invalid transaction authorised')
+        self.assertEqual(self.transport.sent, [])
+
+    def test_rules(self):
+        rules = ValidationRules([('amount', 'amount'), ('acct', 'card_number'),
+                                 ('expdate', 'expiry'), ('cvv2', 'cvv')])
+        trans = getValidDirectTransaction()
+        self.assertEqual(rules.check(trans), {})
+        trans.amount, trans.acct, trans.expdate, trans.cvv2 = \
+                '10.001', '4111 1111 1111 1111', '012000', '12'
+        self.assertEqual(rules.check(trans), {
+            'amount': 'should be an amount, i.e. 10.00',
+            'expdate': 'has passed',
+            'cvv2': 'should be the 3 or 4 digit card security code'})
+        trans.amount = '0.00'
+        self.assertEqual(rules.check(trans)['amount'],
+                         'should be more than nothing')
+
+    def test_numeric_amounts(self):
+        rules = ValidationRules([('amount', 'amount')])
+        trans = getValidDirectTransaction()
+        for amount in [100, 10.5, decimal.Decimal('10.00'), 1e3]:
+            trans.amount = amount
+            self.assertEqual(rules.check(trans), {}, amount)
+        for amount in [decimal.Decimal('10.999'), 10.999, float('inf'),
+                       float('nan'), decimal.Decimal('Infinity')]:
+            trans.amount = amount
+            self.assertEqual(rules.check(trans),
+                    {'amount': 'should be an amount, i.e. 10.00'}, amount)
+
+    def test_unknown_type(self):
+        trans = getValidWPPExpressTransaction()
+        trans.type = 'Cheque'
+        self.assertRaises(PaymentsValidationError, self.payments.setupRedirect,
+                          trans)
+
+    def test_validate_many(self):
+        self.respond()
+        bad = getValidWPPExpressTransaction()
+        bad.return_url = None
+        batch = [getValidDirectTransaction(), bad,
+                 getValidWPPExpressTransaction(), Transaction()]
+        results = list(self.payments.validate_many(batch, chunk=3))
+        self.assertEqual(results, [{}, {'return_url': 'is required'}, {},
+                {'type': 'should be one of Direct, Express, not None'}])
+        self.assertEqual(self.transport.sent, [])
+
+class ClosingGateway(object):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+class MerchantAccountsTestCase(OfflinePayPalTestCase):
+
+    PAYMENT_ACCOUNTS = {
+        'shop-a': {'PAYPAL_API_USER': 'a', 'PAYPAL_API_PWD': 'a-pwd',
+                   'PAYPAL_API_SIGNATURE': 'a-sig'},
+        'shop-b': {'PAYPAL_API_USER': 'b'},
+    }
+
+    def setUp(self):
+        OfflinePayPalTestCase.setUp(self)
+        self.transports = {}
+        make = self.payments.accounts.make
+        def fake(name):
+            gateway = make(name)
+            gateway.transport = self.transports[name] = FakeTransport(
+                    'ACK=Success&TRANSACTIONID=%s' % name)
+            return gateway
+        self.payments.accounts.make = fake
+
+    def test_routed_by_account(self):
+        self.respond('ACK=Success&TRANSACTIONID=default')
+        trans = getValidDirectTransaction()
+        trans.account = 'shop-a'
+        trans = self.payments.authorise(trans)
+        self.assertEqual(trans._raw['TRANSACTIONID'], 'shop-a')
+        sent = dict(urlparse.parse_qsl(self.transports['shop-a'].sent[0]))
+        self.assertEqual((sent['USER'], sent['PWD']), ('a', 'a-pwd'))
+        trans = self.payments.authorise(getValidDirectTransaction())
+        self.assertEqual(trans._raw['TRANSACTIONID'], 'default')
+        self.assertEqual(self.transports.keys(), ['shop-a'])
+
+    def test_unknown_account(self):
+        trans = getValidDirectTransaction()
+        trans.account = 'shop-z'
+        self.assertRaises(PaymentsValidationError, self.payments.authorise,
+                          trans)
+
+    def test_account_settings_checked(self):
+        self.app.config['PAYMENT_ACCOUNTS'] = {'shop-c': {
+            'PAYPAL_API_USER': None}}
+        self.assertRaises(PaymentsConfigurationError, Payments, self.app)
+
+    def test_least_recently_used_let_go(self):
+        accounts = MerchantAccounts(lambda name: ClosingGateway(),
+                                    ['a', 'b', 'c'], size=2)
+        a = accounts.acquire('a')
+        b = accounts.acquire('b')
+        accounts.release(b)
+        accounts.acquire('c')
+        self.assertEqual(len(accounts), 2)
+        self.assert_(not a.closed) # still in use
+        accounts.release(a)
+        self.assert_(a.closed)
+        self.assert_(accounts.acquire('a') is not a)
+        self.assert_(b.closed)
+
+    def test_idle_let_go(self):
+        accounts = MerchantAccounts(lambda name: ClosingGateway(),
+                                    ['a', 'b'], idle_timeout=0)
+        a = accounts.acquire('a')
+        accounts.release(a)
+        time.sleep(0.01)
+        accounts.acquire('b')
+        self.assert_(a.closed)
+        self.assertEqual(len(accounts), 1)
+
+class IPNVerifier(object):
+    """ stands in for PayPal's IPN endpoint, verifying everything it's sent
+    but those for txn_id forged, after answering the first `outages` with
+    an error page
+    """
+    outages = 0
+
+    def __init__(self, endpoint, **kwargs):
+        self.endpoint = endpoint
+        self.sent = []
+
+    def request_async(self, body, timeout=None):
+        self.sent.append(body)
+        future = PaymentsFuture()
+        if self.outages:
+            self.outages -= 1
+            future.set_result('<html><body>502 Bad Gateway</body></html>')
+        else:
+            future.set_result('INVALID' if 'txn_id=forged' in body
+                              else 'VERIFIED')
+        return future
+
+class TestIPNListener(IPNListener):
+    transport_class = IPNVerifier
+
+class IPNTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.events = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def listener(self, **config):
+        app = Flask(__name__)
+        app.config.update(TESTING=True, PAYPAL_API_ENDPOINT=
+                'https://api-3t.sandbox.paypal.com/nvp', **config)
+        ipn = TestIPNListener()
+        ipn.on('refunded', 'reversed')(self.events.append)
+        ipn.init_app(app) # with the handler there for what's journalled
+        return app, ipn
+
+    def test_verified_and_deduplicated(self):
+        app, ipn = self.listener()
+        client = app.test_client()
+        for body in ['txn_id=tx1&payment_status=Refunded&ipn_track_id=a',
+                     'txn_id=tx1&payment_status=Refunded&ipn_track_id=a',
+                     'txn_id=forged&payment_status=Refunded',
+                     'txn_id=tx2&payment_status=Completed']:
+            response = client.post('/payments/ipn', data=body,
+                    content_type='application/x-www-form-urlencoded')
+            self.assertEqual(response.status_code, 200)
+        self.assert_(ipn.join(2))
+        self.assertEqual([(e.type, e.txn_id) for e in self.events],
+                         [('refunded', 'tx1')])
+        self.assertEqual(ipn.invalid, 1)
+        self.assertEqual(ipn.transport.endpoint,
+                         'https://ipnpb.sandbox.paypal.com/cgi-bin/webscr')
+        self.assert_(ipn.transport.sent[0].startswith(
+                'cmd=_notify-validate&txn_id=tx1&'))
+
+    def post(self, app, body):
+        return app.test_client().post('/payments/ipn', data=body,
+                content_type='application/x-www-form-urlencoded')
+
+    def test_error_page_tried_again(self):
+        app, ipn = self.listener(PAYMENT_IPN_RETRY_BACKOFF=0)
+        ipn.transport.outages = 2
+        self.post(app, 'txn_id=tx1&payment_status=Refunded')
+        self.assert_(ipn.join(2))
+        self.assertEqual([e.txn_id for e in self.events], ['tx1'])
+        self.assertEqual(ipn.invalid, 0)
+        self.assertEqual(len(ipn.transport.sent), 3)
+
+    def test_failed_handler_tried_again(self):
+        app, ipn = self.listener(PAYMENT_IPN_RETRY_BACKOFF=0)
+        calls = []
+        @ipn.on('reversed')
+        def flaky(event):
+            calls.append(event.txn_id)
+            if len(calls) == 1:
+                raise IOError('database away')
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            self.post(app, 'txn_id=tx1&payment_status=Reversed')
+            self.assert_(ipn.join(2))
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(calls, ['tx1', 'tx1'])
+
+    def test_queue_full_turned_away(self):
+        app, ipn = self.listener(PAYMENT_IPN_QUEUE_DEPTH=0)
+        response = app.test_client().post('/payments/ipn', data='txn_id=tx1',
+                content_type='application/x-www-form-urlencoded')
+        self.assertEqual(response.status_code, 503)
+
+    def test_queue_survives_restart(self):
+        path = os.path.join(self.directory, 'ipn.db')
+        _IPNJournal(path).add('txn_id=tx3&payment_status=Reversed')
+        app, ipn = self.listener(PAYMENT_IPN_QUEUE_PATH=path)
+        self.assert_(ipn.join(2))
+        self.assertEqual([e.txn_id for e in self.events], ['tx3'])
+        self.assertEqual(_IPNJournal(path).pending(), [])
+
+class AuditLogTestCase(OfflinePayPalTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.PAYMENT_AUDIT_PATH = os.path.join(self.directory, 'gateway')
+        OfflinePayPalTestCase.setUp(self)
+
+    def tearDown(self):
+        OfflinePayPalTestCase.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def test_calls_recorded_redacted(self):
+        self.respond('ACK=Success&TRANSACTIONID=tx1&AMT=100%2e00')
+        self.payments.authorise(getValidDirectTransaction())
+        self.payments.audit.flush()
+        entries = self.payments.audit.lookup('tx1')
+        self.assertEqual(len(entries), 1)
+        request = entries[0]['request']
+        self.assertEqual(entries[0]['method'], 'DoDirectPayment')
+        self.assertEqual(request['ACCT'], '************1111')
+        self.assertEqual((request['PWD'], request['CVV2']),
+                         ('[redacted]', '[redacted]'))
+        self.assertEqual(entries[0]['response']['AMT'], '100.00')
+
+    def test_segments_rotated(self):
+        log = AuditLog(os.path.join(self.directory, 'small'),
+                       index=['TRANSACTIONID'], segment_size=200,
+                       fsync=False)
+        for i in range(20):
+            log.record('GetTransactionDetails', 'TRANSACTIONID=tx%d' % i,
+                       'ACK=Success&TRANSACTIONID=tx%d' % i, None, 0.01)
+        log.record('GetTransactionDetails', 'TRANSACTIONID=tx5', None,
+                   socket.timeout('timed out'), 1.0)
+        log.flush()
+        self.assert_(len(os.listdir(log.path)) > 3)
+        entries = log.lookup('tx5')
+        self.assertEqual([entry['error'] for entry in entries],
+                         [None, 'timeout: timed out'])
+        self.assertEqual(log.lookup('tx99'), [])
+
+class RouteGateway(object):
+    """ a gateway answering authorise with its name, or failing with the
+    errors it's given one at a time first
+    """
+    def __init__(self, name, *errors):
+        self.name = name
+        self.errors = list(errors)
+        self.calls = 0
+
+    def authorise(self, trans):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        trans.authorised_by = self.name
+        return trans
+
+    setupRedirect = authorise
+
+class GatewayRouterTestCase(unittest.TestCase):
+
+    def router(self, *gateways, **kwargs):
+        default = RouteGateway('default')
+        return GatewayRouter([(g.name, g, kwargs.get(g.name, 1))
+                              for g in gateways], default)
+
+    def test_weighted_split(self):
+        a, b = RouteGateway('a'), RouteGateway('b')
+        router = self.router(a, b, a=3)
+        for route in router.routes:
+            route.stats.record(0.1, False)
+        for i in range(400):
+            router.call(getValidDirectTransaction(), 'authorise')
+        self.assert_(200 < a.calls < 380, a.calls)
+
+    def test_fails_over_when_unsent(self):
+        refused = socket.error(errno.ECONNREFUSED, 'Connection refused')
+        a, b = RouteGateway('a', refused), RouteGateway('b')
+        router = self.router(a, b)
+        router.order = lambda: router.routes
+        trans = router.call(getValidDirectTransaction(), 'authorise')
+        self.assertEqual((trans.route, trans.authorised_by), ('b', 'b'))
+        self.assertEqual(router.stats()['a']['failovers'], 1)
+
+    def test_no_failover_once_sent(self):
+        a = RouteGateway('a', socket.timeout('timed out'))
+        b = RouteGateway('b', socket.timeout('timed out'))
+        router = self.router(a, b)
+        self.assertRaises(socket.timeout, router.call,
+                          getValidDirectTransaction(), 'authorise')
+        self.assertEqual(a.calls + b.calls, 1)
+
+    def test_unhealthy_avoided(self):
+        a, b = RouteGateway('a'), RouteGateway('b')
+        router = self.router(a, b)
+        for i in range(20):
+            router.by_name['a'].stats.record(0.1, True)
+            router.by_name['b'].stats.record(1.0, False)
+        self.assertEqual([route.name for route in router.order()],
+                         ['b', 'a'])
+
+    def test_express_pinned(self):
+        a, b = RouteGateway('a'), RouteGateway('b')
+        router = self.router(a, b)
+        trans = router.call(getValidWPPExpressTransaction(), 'setupRedirect')
+        pinned = trans.route
+        for i in range(10):
+            self.assertEqual(router.call(trans, 'authorise').authorised_by,
+                             pinned)
+        self.assertEqual(router.call(getValidWPPExpressTransaction(),
+                                     'authorise').authorised_by, 'default')
+
+class RoutedPaymentsTestCase(OfflinePayPalTestCase):
+
+    PAYMENT_ROUTES = {
+        'east': {'PAYPAL_API_USER': 'east'},
+        'west': {'PAYPAL_API_USER': 'west', 'PAYMENT_ROUTE_WEIGHT': 2},
+    }
+
+    def test_breaker_open_fails_over(self):
+        router = self.payments.router
+        east, west = router.by_name['east'], router.by_name['west']
+        east.gateway.transport = FakeTransport(
+                PaymentsCircuitOpen('circuit open'))
+        west.gateway.transport = FakeTransport('ACK=Success&TRANSACTIONID=w')
+        router.order = lambda: [east, west]
+        trans = self.payments.authorise(getValidDirectTransaction())
+        self.assertEqual((trans.route, trans._raw['TRANSACTIONID']),
+                         ('west', 'w'))
+        self.assertEqual(west.weight, 2)
+